@@ -0,0 +1,406 @@
+"""
+ asyncio version of the IRC server programmed in python for a CS494 project
+ Note: needs python 3.5 or newer, uses uvloop when it is installed
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ Connections are accepted with asyncio.start_server and each one gets
+ a coroutine that reads from it. Everything else (registration,
+ commands, channels, write buffers and slow consumers) is done by the
+ functions in chat_server.py, which only see a StreamConnection where
+ they would normally see a socket and an AsyncioLoop where they would
+ normally see the event loop from chat_events.py
+"""
+import asyncio   # for the event loop and streams
+import socket    # for socket errors
+import logging   # for logging
+import signal    # for signal interrupts
+import argparse  # for command line options
+import errno     # for socket error codes
+
+try:
+    import uvloop  # faster drop-in event loop
+except ImportError:
+    uvloop = None
+
+import chat_server
+
+from chat_events import TimerWheel, READ, WRITE
+from chat_metrics import http_response
+from chat_logging import setup_logging
+
+# bytes asyncio may buffer for a client before writes count as blocked,
+# after that data waits in the client's queue in chat_server
+TRANSPORT_BUFFER = 64 * 1024
+
+
+class StreamConnection(object):
+    """Stands in for a client socket
+
+    send() behaves like send() on a non-blocking socket,
+    it fails with EAGAIN while asyncio's buffer is full
+    """
+
+    def __init__(self, reader, writer):
+        """
+        :param reader: asyncio StreamReader
+        :param writer: asyncio StreamWriter
+        """
+
+        self.reader = reader
+        self.writer = writer
+        self.transport = writer.transport
+        self.transport.set_write_buffer_limits(high=TRANSPORT_BUFFER)
+
+        # cleared while reads are paused for a slow consumer
+        self.readable = asyncio.Event()
+        self.readable.set()
+
+        # waiting for the buffer to drain
+        self.draining = False
+
+    def send(self, data):
+        """Hand data to asyncio
+
+        :param data: bytes to send
+        :return: number of bytes taken
+        """
+
+        # connection was lost, uvloop raises if we write anyway
+        if self.transport.is_closing():
+            raise socket.error(errno.EPIPE, 'connection is closed')
+
+        # asyncio paused writing on this connection
+        if self.transport.get_write_buffer_size() > TRANSPORT_BUFFER:
+            raise socket.error(errno.EAGAIN, 'asyncio buffer is full')
+
+        self.writer.write(data)
+        return len(data)
+
+    def close(self):
+        """Close the connection once asyncio's buffer is written"""
+
+        self.writer.close()
+
+        # wake up the reader so it sees we're done
+        self.readable.set()
+
+
+class AsyncioLoop(object):
+    """Gives chat_server the event loop interface it expects
+
+    chat_server asks for READ and WRITE events through modify().
+    READ toggles whether the reader coroutine reads, WRITE starts
+    a task that waits for asyncio's buffer to drain and then lets
+    chat_server flush the client's queue
+    """
+
+    def __init__(self, loop):
+        """
+        :param loop: asyncio event loop
+        """
+
+        self.loop = loop
+
+    def register(self, sock, events, handler=None):
+        self.modify(sock, events)
+
+    def modify(self, sock, events, handler=None):
+        if events & READ:
+            sock.readable.set()
+        else:
+            sock.readable.clear()
+
+        if events & WRITE and not sock.draining:
+            sock.draining = True
+            self.loop.create_task(wait_writable(sock))
+
+    def unregister(self, sock):
+        pass
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        # asyncio's TimerHandle can be cancelled just like ours
+        return self.loop.call_later(delay, callback, *args)
+
+    def close(self):
+        pass
+
+
+async def wait_writable(conn):
+    """Coroutine flushes a client's queue once asyncio's buffer drains
+
+    :param conn: StreamConnection object
+    """
+
+    try:
+        await conn.writer.drain()
+    except (ConnectionError, OSError):
+        pass
+
+    conn.draining = False
+
+    if conn in chat_server.accounts:
+        chat_server.client_ready(conn, WRITE)
+
+
+async def handle_client(reader, writer):
+    """Coroutine runs for as long as a client is connected
+
+    :param reader: asyncio StreamReader
+    :param writer: asyncio StreamWriter
+    """
+
+    accounts = chat_server.accounts
+    conn = StreamConnection(reader, writer)
+
+    # Add to connection list
+    chat_server.CONNECTION_LIST.append(conn)
+
+    # create an account, in the accounts dictionary
+    accounts[conn] = chat_server.Session(
+        writer.get_extra_info('peername')[0])
+    accounts[conn].state = 'awaiting nick'
+
+    # give up on clients that never send a username
+    accounts[conn].timer = chat_server.timer_wheel.call_later(
+        chat_server.REGISTRATION_TIMEOUT,
+        chat_server.registration_expired, conn)
+
+    try:
+        while conn in accounts:
+
+            # reads are paused until the client catches up
+            await conn.readable.wait()
+
+            # client is gone or about to be logged off
+            if conn not in accounts or accounts[conn].closing:
+                return
+
+            data = await reader.read(chat_server.RECV_BUFFER)
+
+            # logged off while we waited
+            if conn not in accounts:
+                return
+
+            # no data means the client hung up
+            if not data:
+                chat_server.logoff(conn)
+                return
+
+            chat_server.receive(conn, data)
+
+    except:
+        if conn in accounts:
+            chat_server.logoff(conn)
+
+
+async def serve_metrics(reader, writer):
+    """Coroutine answers one HTTP request for the metrics
+
+    :param reader: asyncio StreamReader
+    :param writer: asyncio StreamWriter
+    """
+
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        writer.close()
+        return
+
+    writer.write(http_response(request, chat_server.METRICS))
+    writer.close()
+
+
+async def serve(loop, port):
+    """Coroutine runs the server until SIGINT or SIGTERM
+
+    :param loop: asyncio event loop
+    :param port: port to listen on
+    """
+
+    server = await asyncio.start_server(
+        handle_client, '0.0.0.0', port,
+        backlog=chat_server.LISTEN_BACKLOG, reuse_address=True)
+
+    if chat_server.METRICS_PORT is not None:
+        chat_server.enable_metrics()
+        await asyncio.start_server(serve_metrics, '127.0.0.1',
+                                   chat_server.METRICS_PORT)
+        logging.info('Metrics on http://127.0.0.1:%d/metrics',
+                     chat_server.METRICS_PORT)
+
+    if chat_server.STORE_DIR is not None:
+        chat_server.enable_store()
+
+    # wait for a signal
+    stop = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            signum, lambda: stop.done() or stop.set_result(None))
+
+    await stop
+
+    # log everyone off in one go
+    chat_server.logoff_many(chat_server.CONNECTION_LIST)
+
+    server.close()
+    await server.wait_closed()
+
+    # write out the rest of the channel logs
+    if chat_server.STORE is not None:
+        chat_server.STORE.close()
+
+    logging.info('Server shutting down')
+
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='IRC chat server (asyncio)')
+    parser.add_argument('--port', type=int, default=chat_server.PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--loop', choices=['asyncio', 'uvloop'],
+                        default='uvloop' if uvloop else 'asyncio',
+                        help='event loop (default: %(default)s)')
+    parser.add_argument('--casefold-nicks', action='store_true',
+                        help='usernames differing only in case clash')
+    parser.add_argument('--registration-timeout', type=float,
+                        default=chat_server.REGISTRATION_TIMEOUT,
+                        help='seconds a client has to send its username '
+                             '(default: %(default)s)')
+    parser.add_argument('--ping-interval', type=float,
+                        default=chat_server.PING_INTERVAL,
+                        help='seconds a client may be quiet before it is '
+                             'pinged, 0 to never ping (default: %(default)s)')
+    parser.add_argument('--ping-timeout', type=float,
+                        default=chat_server.PING_TIMEOUT,
+                        help='seconds a client has to answer a ping '
+                             '(default: %(default)s)')
+    parser.add_argument('--high-watermark', type=int,
+                        default=chat_server.HIGH_WATERMARK,
+                        help='bytes queued before a client is a slow '
+                             'consumer (default: %(default)s)')
+    parser.add_argument('--low-watermark', type=int,
+                        default=chat_server.LOW_WATERMARK,
+                        help='bytes queued before a slow consumer is back '
+                             'to normal (default: %(default)s)')
+    parser.add_argument('--slow-consumer', default=chat_server.SLOW_CONSUMER,
+                        choices=['drop', 'disconnect', 'pause'],
+                        help='what to do with slow consumers '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on this local port')
+    parser.add_argument('--log-format', choices=['text', 'json'],
+                        default='text',
+                        help='server log format (default: %(default)s)')
+    parser.add_argument('--log-rate', type=float, default=0,
+                        help='most times per second the same kind of '
+                             'message is logged, 0 for no limit')
+    parser.add_argument('--log-sync', action='store_true',
+                        help='write the log from the event loop instead '
+                             'of a background thread')
+    parser.add_argument('--history-lines', type=int,
+                        default=chat_server.HISTORY_LINES,
+                        help='messages each channel keeps for /history '
+                             '(default: %(default)s)')
+    parser.add_argument('--history-bytes', type=int,
+                        default=chat_server.HISTORY_BYTES,
+                        help='bytes each channel may use for them '
+                             '(default: %(default)s)')
+    parser.add_argument('--history-replay', type=int,
+                        default=chat_server.HISTORY_REPLAY,
+                        help='messages replayed to someone joining a channel '
+                             '(default: %(default)s)')
+    parser.add_argument('--store-dir', default=chat_server.STORE_DIR,
+                        help='write channel logs to this directory')
+    parser.add_argument('--store-retention', type=float,
+                        default=chat_server.STORE_RETENTION,
+                        help='seconds channel logs are kept, 0 for ever '
+                             '(default: %(default)s)')
+    parser.add_argument('--flood-lines', type=float,
+                        default=chat_server.FLOOD_LINES,
+                        help='lines per second each client may send, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--flood-bytes', type=float,
+                        default=chat_server.FLOOD_BYTES,
+                        help='bytes per second each client may send, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--channel-lines', type=float,
+                        default=chat_server.CHANNEL_LINES,
+                        help='lines per second sent to each channel, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--channel-bytes', type=float,
+                        default=chat_server.CHANNEL_BYTES,
+                        help='bytes per second sent to each channel, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--flood-burst', type=float,
+                        default=chat_server.FLOOD_BURST,
+                        help='seconds worth of those limits that may be '
+                             'used at once (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.loop == 'uvloop' and uvloop is None:
+        parser.error('uvloop is not installed')
+
+    chat_server.PORT = args.port
+    chat_server.CASEFOLD_NICKS = args.casefold_nicks
+    chat_server.REGISTRATION_TIMEOUT = args.registration_timeout
+    chat_server.PING_INTERVAL = args.ping_interval
+    chat_server.PING_TIMEOUT = args.ping_timeout
+    chat_server.HIGH_WATERMARK = args.high_watermark
+    chat_server.LOW_WATERMARK = args.low_watermark
+    chat_server.SLOW_CONSUMER = args.slow_consumer
+    chat_server.METRICS_PORT = args.metrics_port
+    chat_server.HISTORY_LINES = args.history_lines
+    chat_server.HISTORY_BYTES = args.history_bytes
+    chat_server.HISTORY_REPLAY = args.history_replay
+    chat_server.STORE_DIR = args.store_dir
+    chat_server.STORE_RETENTION = args.store_retention
+    chat_server.FLOOD_LINES = args.flood_lines
+    chat_server.FLOOD_BYTES = args.flood_bytes
+    chat_server.CHANNEL_LINES = args.channel_lines
+    chat_server.CHANNEL_BYTES = args.channel_bytes
+    chat_server.FLOOD_BURST = args.flood_burst
+
+    # for logging information on the server
+    setup_logging(json_output=args.log_format == 'json',
+                  rate=args.log_rate, threaded=not args.log_sync)
+
+    if args.loop == 'uvloop':
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # chat_server talks to asyncio through this
+    chat_server.event_loop = AsyncioLoop(loop)
+    chat_server.timer_wheel = TimerWheel(chat_server.event_loop)
+
+    server_ip = socket.gethostbyname(socket.gethostname())
+
+    # information that might be useful to clients
+    logging.info('Chat server started [%s:%s]', server_ip, args.port)
+    logging.info('Event loop: %s', args.loop)
+
+    loop.run_until_complete(serve(loop, args.port))
+    loop.close()
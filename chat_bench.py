@@ -0,0 +1,2239 @@
+"""
+ Benchmarks for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ Usage: python chat_bench.py <benchmark> [options]
+ Run python chat_bench.py --help for the list of benchmarks
+"""
+from __future__ import print_function
+
+import os          # for paths
+import socket      # for socket pairs
+import argparse    # for command line options
+import time        # for timing
+import sys         # for sys calls
+import subprocess  # for running the server
+import select      # for waiting on sockets
+import errno       # for socket error codes
+import threading   # for fake servers
+
+try:
+    import tracemalloc  # for measuring allocations (python 3.4+)
+except ImportError:
+    tracemalloc = None
+
+from chat_events import EventLoop, TimerWheel, READ, WRITE
+from chat_events import available_backends
+
+try:
+    import resource  # for raising the open file limit (unix only)
+except ImportError:
+    resource = None
+
+
+def raise_fd_limit():
+    """Function raises the soft open file limit up to the hard limit
+
+    :return: the new soft limit
+    """
+
+    if resource is None:
+        return 1024
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 65536
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def report(title, header, rows):
+    """Function prints a table of benchmark results
+
+    :param title: benchmark title
+    :param header: list of column names
+    :param rows: list of row tuples
+    """
+
+    print('\n%s' % title)
+    print(' '.join('%14s' % h for h in header))
+    for row in rows:
+        print(' '.join('%14s' % (('%.2f' % c) if isinstance(c, float) else c)
+                       for c in row))
+
+
+def bench_loop(args):
+    """Benchmark event loop latency against number of idle connections
+
+    One socket pair is kept busy while N idle socket pairs are
+    registered with the loop. We time how long it takes for the busy
+    socket's handler to run after a byte is written to it.
+    """
+
+    limit = raise_fd_limit()
+    rows = []
+
+    for backend in args.backends or available_backends():
+        for count in args.counts:
+
+            # two descriptors per pair plus some slack
+            if count * 2 + 64 > limit:
+                rows.append((backend, count, 'fd limit', '-'))
+                continue
+
+            # select can't watch descriptors above FD_SETSIZE
+            if backend == 'select' and count * 2 + 64 > 1024:
+                rows.append((backend, count, 'FD_SETSIZE', '-'))
+                continue
+
+            loop = EventLoop(backend)
+            idle = []
+            for i in range(count):
+                a, b = socket.socketpair()
+                loop.register(a, READ, lambda sock, events: None)
+                idle.append((a, b))
+
+            busy, peer = socket.socketpair()
+            got = []
+
+            def on_busy(sock, events):
+                got.append(sock.recv(1))
+
+            loop.register(busy, READ, on_busy)
+
+            start = time.time()
+            for i in range(args.rounds):
+                peer.send(b'x')
+                while not got:
+                    loop.run_once()
+                del got[:]
+            elapsed = time.time() - start
+
+            loop.close()
+            busy.close()
+            peer.close()
+            for a, b in idle:
+                a.close()
+                b.close()
+
+            usec = elapsed / args.rounds * 1e6
+            rows.append((backend, count, usec, args.rounds / elapsed))
+
+    report('Event loop wakeup latency vs idle connections',
+           ('backend', 'connections', 'usec/wakeup', 'wakeups/sec'), rows)
+
+
+class FakeSocket(object):
+    """Stand-in for a client socket that just counts what it is sent"""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += 1
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class BlockedSocket(FakeSocket):
+    """Stand-in for a client socket whose send buffer is full"""
+
+    def send(self, data):
+        raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+
+
+class NullLoop(object):
+    """Stand-in for the event loop that ignores everything"""
+
+    def modify(self, sock, events, handler=None):
+        pass
+
+    def unregister(self, sock):
+        pass
+
+    def call_soon(self, callback, *args):
+        pass
+
+
+def populate(chat_server, count, channel_size, sock_class=FakeSocket):
+    """Function fills the server state with fake connected clients
+
+    Clients are spread across channels of channel_size members each
+    and every client has its only channel as current channel
+
+    :param chat_server: chat_server module
+    :param count: number of clients
+    :param channel_size: clients per channel
+    :param sock_class: class of the fake sockets
+    :return: list of fake sockets
+    """
+
+    socks = []
+
+    for i in range(count):
+        sock = sock_class()
+        channel = '#chan%d' % (i // channel_size)
+
+        chat_server.CONNECTION_LIST.append(sock)
+        chat_server.USERS[chat_server.nick_key('user%d' % i)] = sock
+        account = chat_server.Session('127.0.0.1')
+        account.username = 'user%d' % i
+        account.channels.append(channel)
+        chat_server.accounts[sock] = account
+        if channel not in chat_server.CHANNELS:
+            chat_server.CHANNELS[channel] = chat_server.Channel(channel)
+        chat_server.CHANNELS[channel].members.add(sock)
+        chat_server.set_current(sock, channel)
+        socks.append(sock)
+
+    return socks
+
+
+def reset(chat_server):
+    """Function empties the server state
+
+    :param chat_server: chat_server module
+    """
+
+    chat_server.accounts.clear()
+    chat_server.CHANNELS.clear()
+    chat_server.USERS.clear()
+    del chat_server.CONNECTION_LIST[:]
+
+
+def broadcast_scan(chat_server, sock, message):
+    """The original broadcast_data, kept here for comparison
+
+    Walks every connection twice looking for sockets whose
+    current channel matches the sender's
+    """
+
+    accounts = chat_server.accounts
+    valid_users = []
+
+    for s in chat_server.CONNECTION_LIST:
+        if s != chat_server.server_socket and s != sock:
+            if accounts[s].current != '':
+                valid_users.append(s)
+
+    for s in valid_users:
+        if accounts[s].current == accounts[sock].current:
+            s.send(message)
+
+
+def bench_broadcast(args):
+    """Benchmark channel fan-out cost with and without the channel index
+
+    Every connection is in a channel of --channel-size members and
+    a sample of senders each broadcast one message to their channel
+    """
+
+    import chat_server
+
+    rows = []
+
+    for count in args.counts:
+        reset(chat_server)
+        socks = populate(chat_server, count, args.channel_size)
+        senders = socks[::max(1, count // args.messages)][:args.messages]
+
+        start = time.time()
+        for sock in senders:
+            broadcast_scan(chat_server, sock, 'hello\r\n')
+        scan = (time.time() - start) / len(senders)
+
+        start = time.time()
+        for sock in senders:
+            chat_server.broadcast_data(sock, 'hello\r\n')
+        index = (time.time() - start) / len(senders)
+
+        rows.append((count, scan * 1e6, index * 1e6, scan / index))
+
+    reset(chat_server)
+
+    report('Channel fan-out (%d members per channel)' % args.channel_size,
+           ('connections', 'scan usec', 'index usec', 'speedup'), rows)
+
+
+def privatemsg_scan(chat_server, user_list, sock, msg):
+    """The original user lookup in privatemsg, kept here for comparison
+
+    Scans the list of usernames and then every account
+    to find the socket that owns the username
+    """
+
+    accounts = chat_server.accounts
+    user = msg.split()[1]
+
+    if user in user_list:
+        for key in accounts:
+            if accounts[key].username == user:
+                key.send('\n<private message from %s>%s\r\n'
+                         % (accounts[sock].username, msg[5+len(user):]))
+                break
+
+
+def bench_privmsg(args):
+    """Benchmark /msg throughput with many connected users
+
+    Random pairs of users send each other private messages
+    """
+
+    import random
+    import chat_server
+
+    rows = []
+
+    for count in args.counts:
+        reset(chat_server)
+        socks = populate(chat_server, count, 10)
+        user_list = chat_server.usernames()
+
+        rand = random.Random(1)
+        pairs = []
+        for i in range(args.messages):
+            sender = rand.choice(socks)
+            target = chat_server.accounts[rand.choice(socks)].username
+            pairs.append((sender, target, 'hello there'))
+
+        # the scan is slow, so only time a slice of the messages
+        sample = pairs[:max(1, args.messages // 20)]
+        start = time.time()
+        for sock, target, msg in sample:
+            privatemsg_scan(chat_server, user_list, sock,
+                            '/msg %s %s' % (target, msg))
+        scan = len(sample) / (time.time() - start)
+
+        start = time.time()
+        for sock, target, msg in pairs:
+            chat_server.privatemsg(sock, target, msg)
+        index = len(pairs) / (time.time() - start)
+
+        rows.append((count, scan, index, index / scan))
+
+    reset(chat_server)
+
+    report('/msg throughput',
+           ('users', 'scan msg/s', 'index msg/s', 'speedup'), rows)
+
+
+def start_server(port, *options, **kwargs):
+    """Function runs chat_server.py in a child process
+
+    :param port: port for the server to listen on
+    :param options: extra command line options for the server
+    :param log: file for the server's log (log=None throws it away)
+    :return: Popen object, the server is accepting connections
+    """
+
+    return start_script('chat_server.py', port, *options, **kwargs)
+
+
+def start_script(script, port, *options, **kwargs):
+    """Function runs a server script in a child process
+
+    :param script: chat_server.py or chat_aio.py
+    :param port: port for the server to listen on
+    :param options: extra command line options for the server
+    :param log: file for the server's log (log=None throws it away)
+    :return: Popen object, the server is accepting connections
+    """
+
+    log = kwargs.get('log') or open('/dev/null', 'w')
+    server = subprocess.Popen([sys.executable, script,
+                               '--port', str(port)] + list(options),
+                              stderr=log)
+
+    # wait until it is listening
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+
+    server.kill()
+    raise RuntimeError('chat server did not start')
+
+
+def stop_server(server):
+    """Function stops a server started with start_server
+
+    :param server: Popen object
+    """
+
+    server.terminate()
+    server.wait()
+
+
+def connect(port, username):
+    """Function connects to the server and registers a username
+
+    :param port: server port
+    :param username: username to register
+    :return: connected socket
+    """
+
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.send(username.encode())
+
+    # wait for the welcome message
+    data = b''
+    while b'/help' not in data:
+        data += sock.recv(4096)
+
+    return sock
+
+
+def drain(sock, timeout=0):
+    """Function reads whatever a socket has waiting
+
+    :param sock: socket object
+    :param timeout: seconds to wait for the first data
+    :return: data read
+    """
+
+    data = b''
+    while select.select([sock], [], [], timeout)[0]:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        timeout = 0
+    return data
+
+
+def bench_pipeline(args):
+    """Benchmark chat line throughput for clients that pipeline lines
+
+    A sender writes --lines chat lines to a channel, --batch lines
+    per send(), and we time how long until a second client in the
+    channel has received all of them
+    """
+
+    server = start_server(args.port)
+    rows = []
+
+    try:
+        for batch in args.batches:
+            tx = connect(args.port, 'tx%d' % batch)
+            rx = connect(args.port, 'rx%d' % batch)
+            rx.send(b'/join #bench\r\n')
+            drain(rx, 0.5)
+            tx.send(b'/join #bench\r\n')
+            drain(tx, 0.5)
+            drain(rx, 0.2)
+
+            marker = ('<tx%d> ' % batch).encode()
+            received = 0
+            start = time.time()
+
+            for first in range(0, args.lines, batch):
+                last = min(first + batch, args.lines)
+                tx.sendall(b''.join(b'm%d\r\n' % i
+                                    for i in range(first, last)))
+                received += drain(rx).count(marker)
+
+            while received < args.lines:
+                data = drain(rx, 5)
+                if not data:
+                    break
+                received += data.count(marker)
+
+            elapsed = time.time() - start
+            rows.append((batch, received, args.lines / elapsed))
+
+            tx.close()
+            rx.close()
+    finally:
+        stop_server(server)
+
+    report('Pipelined chat lines (%d lines)' % args.lines,
+           ('lines/send', 'delivered', 'lines/sec'), rows)
+
+
+def bench_flood(args):
+    """Benchmark flood control, its cost per line and what it buys
+
+    First --lines chat lines from --clients clients in channels of 10
+    are handled in process with flood control off, with a per client
+    budget and with per client and per channel budgets, all of them too
+    big to run out, so we only see the accounting. Then --flooders
+    clients flood a channel of a live server as fast as they can while
+    another client times --probes /who round trips, without and with
+    the --limits options, ten a second
+    """
+
+    import multiprocessing
+    import chat_server
+
+    reset(chat_server)
+    chat_server.event_loop = NullLoop()
+    socks = populate(chat_server, args.clients, 10)
+    for sock in socks:
+        chat_server.accounts[sock].state = 'registered'
+    data = 'x' * args.size + '\r\n'
+
+    rows = []
+    for name, client, channel in (('off', 0, 0), ('client', 1e9, 0),
+                                  ('client + channel', 1e9, 1e9)):
+        chat_server.FLOOD_LINES = chat_server.FLOOD_BYTES = client
+        chat_server.CHANNEL_LINES = chat_server.CHANNEL_BYTES = channel
+
+        start = time.time()
+        for i in range(args.lines):
+            chat_server.handle_data(socks[i % len(socks)], data)
+        elapsed = time.time() - start
+
+        for sock in socks:
+            chat_server.accounts[sock].outbuf = None
+        rows.append((name, args.lines / elapsed,
+                     elapsed / args.lines * 1e6))
+
+    chat_server.FLOOD_LINES = chat_server.FLOOD_BYTES = 0
+    chat_server.CHANNEL_LINES = chat_server.CHANNEL_BYTES = 0
+    reset(chat_server)
+
+    report('Chat lines from %d clients in channels of 10' % args.clients,
+           ('flood control', 'lines/sec', 'usec/line'), rows)
+
+    rows = []
+    for options in ([], args.limits.split()):
+        server = start_server(args.port, *options)
+        stop = multiprocessing.Event()
+        flooded = multiprocessing.Value('l', 0)
+
+        try:
+            probe = connect(args.port, 'probe')
+            flooders = [multiprocessing.Process(
+                target=flood, args=(args.port, 'flooder%d' % i, stop,
+                                    flooded)) for i in range(args.flooders)]
+            drain(probe, 0.2)
+
+            for process in flooders:
+                process.start()
+            time.sleep(0.5)
+
+            start = time.time()
+            times = []
+            for i in range(args.probes):
+                sent = time.time()
+                probe.send(b'/who\r\n')
+                reply = b''
+                while b'Users currently' not in reply:
+                    reply += probe.recv(65536)
+                times.append(time.time() - sent)
+
+                # slow enough to stay within any sensible budget
+                time.sleep(0.1)
+            elapsed = time.time() - start
+
+            stop.set()
+            for process in flooders:
+                process.join()
+        finally:
+            stop.set()
+            stop_server(server)
+
+        times.sort()
+        rows.append((' '.join(options) or 'no limits',
+                     times[len(times) // 2] * 1e3,
+                     times[int(len(times) * 0.99)] * 1e3,
+                     flooded.value / elapsed))
+
+    report('/who round trips while %d clients flood a channel'
+           % args.flooders,
+           ('limits', 'p50 msec', 'p99 msec', 'flood lines/sec'), rows)
+
+
+def flood(port, username, stop, flooded):
+    """Function floods #flood as fast as the server takes it, in a
+    process of its own so it doesn't slow down whoever is measuring
+
+    :param port: server port
+    :param username: username to register
+    :param stop: multiprocessing Event that ends the flood
+    :param flooded: multiprocessing Value counting the flood lines
+                    that made it to this client
+    """
+
+    sock = connect(port, username)
+    sock.send(b'/join #flood\r\n')
+    sock.setblocking(0)
+    batch = b'spam spam spam spam\r\n' * 100
+
+    while not stop.is_set():
+        select.select([sock], [sock], [], 0.1)
+        try:
+            sock.send(batch)
+        except socket.error:
+            pass
+        try:
+            received = sock.recv(65536).count(b'> spam')
+            with flooded.get_lock():
+                flooded.value += received
+        except socket.error:
+            pass
+
+    sock.close()
+
+
+def bench_connect(args):
+    """Benchmark how fast the server registers new clients
+
+    --silent connections that never send a username are opened first,
+    then --clients clients connect (at most --concurrency at a time),
+    send a username and wait for the welcome message
+    """
+
+    raise_fd_limit()
+    server = start_server(args.port, '--registration-timeout', '600')
+
+    address = ('127.0.0.1', args.port)
+    silent = [socket.create_connection(address) for i in range(args.silent)]
+
+    try:
+        welcomed, elapsed = register_clients(args.port, args.clients,
+                                             args.concurrency)
+    finally:
+        stop_server(server)
+        for sock in silent:
+            sock.close()
+
+    report('Client registration',
+           ('silent', 'clients', 'welcomed', 'seconds', 'connects/sec'),
+           [(args.silent, args.clients, welcomed, elapsed,
+             welcomed / elapsed)])
+
+
+def register_clients(port, count, concurrency, connected=None):
+    """Function connects clients to a running server as fast as it takes them
+
+    At most concurrency clients are registering at a time, each one
+    sends a username and waits for the welcome message. The clients
+    stay connected until we are done
+
+    :param port: server port
+    :param count: number of clients
+    :param concurrency: clients registering at once
+    :param connected: called once everyone is welcomed, before they go
+    :return: (clients welcomed, seconds)
+    """
+
+    loop = EventLoop()
+    address = ('127.0.0.1', port)
+    clients = []
+    state = {'started': 0, 'welcomed': 0}
+
+    def start_client():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.connect_ex(address)
+        name = 'c%d' % state['started']
+        state['started'] += 1
+        clients.append(sock)
+        loop.register(sock, WRITE, lambda s, e: on_connected(s, name))
+
+    def on_connected(sock, name):
+        sock.send(name.encode())
+        loop.modify(sock, READ, on_welcome)
+
+    def on_welcome(sock, events):
+        if b'/help' in sock.recv(4096):
+            loop.unregister(sock)
+            state['welcomed'] += 1
+            if state['started'] < count:
+                start_client()
+
+    try:
+        start = time.time()
+        for i in range(min(concurrency, count)):
+            start_client()
+
+        while state['welcomed'] < count:
+            if not loop.run_once(10):
+                break
+        elapsed = time.time() - start
+
+        if connected is not None:
+            connected()
+    finally:
+        loop.close()
+        for sock in clients:
+            sock.close()
+
+    return state['welcomed'], elapsed
+
+
+def parse_chains(chat_server, sock, data):
+    """The original parse_data/parse_data2 if-chains, kept for comparison
+
+    Chat lines get /PRIVMSG stuck on the front and are then picked
+    out with find(), everything else is split and walked through
+    elif chains on the length and the first word
+    """
+
+    if data.find('/') != 0:
+        data = '/PRIVMSG ' + data
+
+    if data.find('/PRIVMSG') == 0:
+        if len(chat_server.accounts[sock].channels) == 0:
+            chat_server.send_to(sock, 'Must join channel')
+        elif data[9]:
+            chat_server.chatmessage(sock, data[9:])
+    elif data.find('/msg') == 0:
+        if len(data.split()) >= 3:
+            chat_server.privatemsg(sock, data.split()[1],
+                                   data[6 + len(data.split()[1]):])
+        else:
+            chat_server.send_to(sock, 'Invalid command')
+    else:
+        message = data.split()
+        if len(message) == 1:
+            for verb in ('/help', '/who', '/list', '/exit'):
+                if message[0] == verb:
+                    break
+            if message[0] == '/nick':
+                chat_server.changenick(sock)
+        elif len(message) == 2:
+            for verb in ('/help', '/whois', '/who', '/join', '/leave'):
+                if message[0] == verb:
+                    break
+            if message[0] == '/current':
+                chat_server.switchcurrent(sock, message[1])
+
+
+def bench_parse(args):
+    """Benchmark the command parser
+
+    Replies and broadcasts are stubbed out so only the
+    parsing and the handlers' own work is timed
+    """
+
+    import chat_server
+
+    reset(chat_server)
+    socks = populate(chat_server, 1000, 10)
+    sock = socks[0]
+
+    # only time the parsing, not the network side
+    chat_server.send_to = lambda sock, data: None
+    chat_server.broadcast_data = lambda sock, data: None
+
+    lines = [
+        ('chat line', 'hello everyone, how is it going?'),
+        ('/PRIVMSG', '/PRIVMSG hello everyone, how is it going?'),
+        ('/msg', '/msg user7 hello there, how is it going?'),
+        ('/nick', '/nick'),
+        ('/current', '/current #chan0'),
+    ]
+
+    rows = []
+    for name, line in lines:
+        start = time.time()
+        for i in range(args.rounds):
+            parse_chains(chat_server, sock, line)
+        chains = args.rounds / (time.time() - start)
+
+        start = time.time()
+        for i in range(args.rounds):
+            chat_server.parse_data(sock, line)
+        table = args.rounds / (time.time() - start)
+
+        rows.append((name, chains, table, table / chains))
+
+    report('Command parsing',
+           ('line', 'chains/sec', 'table/sec', 'speedup'), rows)
+
+
+def bench_metrics(args):
+    """Benchmark the cost of having metrics on
+
+    Lines are handled by parse_data with replies going to fake
+    sockets, first with metrics off and then with them on. Each
+    rate is the best of a few repeats since the difference is small.
+    Then the fan-out load from the workers benchmark is run against
+    a real server started with and without --metrics-port
+    """
+
+    import chat_server
+
+    reset(chat_server)
+    socks = populate(chat_server, 1000, 10)
+    sock = socks[0]
+    for s in socks:
+        chat_server.accounts[s].state = 'registered'
+
+    chat_server.event_loop = EventLoop()
+
+    lines = [
+        ('chat line', 'hello everyone, how is it going?'),
+        ('/msg', '/msg user7 hello there, how is it going?'),
+        ('/current', '/current #chan0'),
+        ('invalid', '/bogus'),
+    ]
+
+    timings = []
+    for enabled in (False, True):
+        if enabled:
+            chat_server.enable_metrics()
+
+        rates = []
+        for name, line in lines:
+            best = None
+            for repeat in range(args.repeats):
+                start = time.time()
+                for i in range(args.rounds):
+                    chat_server.parse_data(sock, line)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            rates.append(args.rounds / best)
+        timings.append(rates)
+
+    rows = []
+    for (name, line), off, on in zip(lines, timings[0], timings[1]):
+        rows.append((name, off, on, (off - on) / off * 100))
+
+    chat_server.event_loop.close()
+    reset(chat_server)
+
+    report('Line handling with metrics off and on',
+           ('line', 'off lines/sec', 'on lines/sec', 'overhead %'), rows)
+    print('(%d bytes of metrics text)' % len(chat_server.METRICS.render()))
+
+    raise_fd_limit()
+    rows = []
+
+    for name, options in (('off', []),
+                          ('on', ['--metrics-port', str(args.port + 1)])):
+        server = start_server(args.port, *options)
+        try:
+            connected, expected, received, elapsed = fanout(
+                args.port, args.clients, args.channel_size, args.lines)
+        finally:
+            stop_server(server)
+
+        rows.append((name, received, elapsed, received / elapsed))
+
+    report('Server fan-out with metrics off and on '
+           '(%d clients, channels of %d, %d lines each)'
+           % (args.clients, args.channel_size, args.lines),
+           ('metrics', 'delivered', 'seconds', 'msgs/sec'), rows)
+
+
+def log_cost(rounds, log):
+    """Function times a logging call with the root logger as it is set up
+
+    :param rounds: number of calls
+    :param log: function that logs one line
+    :return: microseconds per call on the calling thread
+    """
+
+    import logging
+
+    start = time.time()
+    for i in range(rounds):
+        log()
+    elapsed = time.time() - start
+
+    # write out whatever the writer thread still has
+    for handler in logging.getLogger().handlers[:]:
+        handler.close()
+        logging.getLogger().removeHandler(handler)
+
+    return elapsed / rounds * 1e6
+
+
+def bench_logging(args):
+    """Benchmark the server log on the registration path
+
+    First the line logged for every registration is timed with many
+    users online: the old eager 'Updated user list: [...]' line written
+    from the event loop against the new one, which only has the count,
+    written directly and through the background writer. Then clients
+    register with a real server writing its log to a file in each of
+    the log modes
+    """
+
+    import logging
+    import tempfile
+    import chat_server
+    from chat_logging import setup_logging
+
+    rows = []
+
+    for count in args.counts:
+        reset(chat_server)
+        populate(chat_server, count, 10)
+        name = 'user0'
+
+        with tempfile.TemporaryFile('w+') as log:
+            setup_logging(threaded=False, stream=log)
+            eager = log_cost(args.rounds, lambda: logging.info(
+                'Updated user list: %s' % chat_server.usernames()))
+
+            setup_logging(threaded=False, stream=log)
+            lazy = log_cost(args.rounds, lambda: logging.info(
+                'Client %s is known as %s, %d users online', '127.0.0.1',
+                name, len(chat_server.USERS)))
+
+            setup_logging(stream=log)
+            queued = log_cost(args.rounds, lambda: logging.info(
+                'Client %s is known as %s, %d users online', '127.0.0.1',
+                name, len(chat_server.USERS)))
+
+        rows.append((count, eager, lazy, queued))
+
+    reset(chat_server)
+
+    report('Logging one registration, usec on the event loop',
+           ('users', 'user list', 'count', 'count, queued'), rows)
+
+    raise_fd_limit()
+    rows = []
+
+    modes = [
+        ('event loop', ['--log-sync']),
+        ('writer thread', []),
+        ('json', ['--log-format', 'json']),
+        ('10/sec limit', ['--log-rate', '10']),
+    ]
+
+    for name, options in modes:
+        with tempfile.TemporaryFile() as log:
+            server = start_server(args.port, *options, log=log)
+            try:
+                welcomed, elapsed = register_clients(
+                    args.port, args.clients, args.concurrency)
+            finally:
+                stop_server(server)
+            size = log.seek(0, 2) or log.tell()
+
+        rows.append((name, welcomed, elapsed, welcomed / elapsed, size))
+
+    report('Client registration with the log written to a file '
+           '(%d clients)' % args.clients,
+           ('log', 'welcomed', 'seconds', 'connects/sec', 'log bytes'), rows)
+
+
+def bench_frames(args):
+    """Benchmark memory used to queue one message for a big channel
+
+    Every member's socket is blocked so the message stays in the write
+    buffers. Encoding per recipient (what a naive python 3 port would
+    do) is compared with broadcast_data, which queues one shared frame
+    """
+
+    import chat_server
+    from collections import deque
+
+    reset(chat_server)
+    chat_server.event_loop = NullLoop()
+    socks = populate(chat_server, args.members + 1, args.members + 1,
+                     BlockedSocket)
+    sender = socks[0]
+    message = u'\n<user0> %s\r\n' % ('x' * args.size)
+
+    def queued():
+        frames = set()
+        for sock in socks[1:]:
+            for frame in chat_server.accounts[sock].outbuf or ():
+                frames.add(id(frame))
+        return len(frames)
+
+    # the buffers are there already so only the frames are counted
+    def empty_queues():
+        for sock in socks[1:]:
+            chat_server.accounts[sock].outbuf = deque()
+            chat_server.accounts[sock].outlen = 0
+
+    def per_recipient():
+        for sock in socks[1:]:
+            chat_server.send_to(sock, message.encode('utf-8'))
+
+    def shared():
+        chat_server.broadcast_data(sender, message)
+
+    rows = []
+    for name, fanout in (('per recipient', per_recipient),
+                         ('shared frame', shared)):
+        empty_queues()
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+        start = time.time()
+        fanout()
+        elapsed = time.time() - start
+
+        if tracemalloc is not None:
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            per_member = '%.1f' % (float(size) / args.members)
+        else:
+            per_member = 'n/a'
+
+        rows.append((name, queued(), per_member, elapsed * 1e3))
+
+    reset(chat_server)
+
+    report('Queueing a %d byte message for %d members'
+           % (len(message), args.members),
+           ('fan-out', 'frames queued', 'bytes/member', 'msec'), rows)
+    if tracemalloc is None:
+        print('(bytes/member needs tracemalloc, run with python 3)')
+
+
+def bench_history(args):
+    """Benchmark channel history memory and its cost on the hot path
+
+    --channels channels each get --messages messages of --size bytes,
+    more than the limits keep, and the memory they hold on to is
+    measured per channel for each pair of --history-lines/--history-bytes
+    limits. Then chat lines are broadcast with history off and on
+    """
+
+    import chat_server
+
+    rows = []
+
+    for lines, size_limit in args.limits:
+        chat_server.HISTORY_LINES = lines
+        chat_server.HISTORY_BYTES = size_limit
+        channels = [chat_server.Channel('#chan%d' % i)
+                    for i in range(args.channels)]
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+        for channel in channels:
+            for i in range(args.messages):
+                channel.remember(chat_server.make_frame(
+                    u'\n<user%d> %s\r\n' % (i, 'x' * args.size)))
+
+        if tracemalloc is not None:
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            per_channel = '%.0f' % (float(used) / args.channels)
+        else:
+            per_channel = 'n/a'
+
+        rows.append((lines, size_limit, len(channels[0].history),
+                     channels[0].history_bytes, per_channel))
+
+    report('History of %d channels after %d messages of %d bytes each'
+           % (args.channels, args.messages, args.size),
+           ('lines limit', 'bytes limit', 'lines kept', 'bytes counted',
+            'bytes/channel'), rows)
+    if tracemalloc is None:
+        print('(bytes/channel needs tracemalloc, run with python 3)')
+
+    reset(chat_server)
+    socks = populate(chat_server, 1000, 10)
+    chat_server.event_loop = NullLoop()
+    line = 'x' * args.size
+
+    rows = []
+    for lines in (0, 50):
+        chat_server.HISTORY_LINES = lines
+        start = time.time()
+        for i in range(args.rounds):
+            chat_server.chatmessage(socks[i % len(socks)], line)
+        elapsed = time.time() - start
+        rows.append(('off' if lines == 0 else '%d lines' % lines,
+                     args.rounds / elapsed))
+
+    for sock in socks:
+        chat_server.accounts[sock].outbuf = None
+    reset(chat_server)
+
+    report('Chat lines to channels of 10',
+           ('history', 'lines/sec'), rows)
+
+
+def bench_store(args):
+    """Benchmark the on-disk channel logs
+
+    Messages are appended for --channels channels and we time the
+    appends (what broadcast_data pays) and how long until the writer
+    thread has them on disk. Then one channel gets --messages messages
+    a millisecond apart in segments of --segment-bytes and we time
+    queries for --span seconds at random times, against reading the
+    whole channel. Last, a channel that rotated every --small seconds
+    is compacted
+    """
+
+    import random
+    import shutil
+    import tempfile
+    import chat_store
+
+    directory = tempfile.mkdtemp()
+    frame = ('\n<someone> %s\r\n' % ('x' * args.size)).encode('utf-8')
+
+    try:
+        # writes
+        store = chat_store.MessageLog(os.path.join(directory, 'writes'))
+        channels = ['#chan%d' % i for i in range(args.channels)]
+
+        start = time.time()
+        for i in range(args.appends):
+            store.append(channels[i % args.channels], frame)
+        appended = time.time() - start
+        store.close()
+        written = time.time() - start
+
+        report('Writing %d messages of %d bytes to %d channels'
+               % (args.appends, len(frame), args.channels),
+               ('usec/append', 'appends/sec', 'seconds to disk', 'MB/sec'),
+               [(appended / args.appends * 1e6, args.appends / appended,
+                 written, store.bytes / written / 1e6)])
+
+        # queries
+        path = os.path.join(directory, 'queries')
+        store = chat_store.MessageLog(path, segment_bytes=args.segment_bytes)
+        first = time.time() - args.messages / 1000.0
+        for i in range(args.messages):
+            store.pending.append(('#big', first + i / 1000.0, frame))
+        store.close()
+
+        segments = list_segments_count(chat_store, path, '#big')
+        last = first + args.messages / 1000.0
+
+        rows = []
+        for span in args.spans:
+            times = []
+            found = 0
+            for i in range(args.queries):
+                since = random.uniform(first, last - span)
+                start = time.time()
+                found += len(chat_store.query(path, '#big', since,
+                                              since + span))
+                times.append(time.time() - start)
+            times.sort()
+            rows.append(('%g sec' % span, found / args.queries,
+                         sum(times) / len(times) * 1e3,
+                         times[int(len(times) * 0.99)] * 1e3))
+
+        start = time.time()
+        total = len(chat_store.query(path, '#big'))
+        rows.append(('everything', total, (time.time() - start) * 1e3, '-'))
+
+        report('Queries over %d messages in %d segments'
+               % (args.messages, segments),
+               ('range', 'messages', 'avg msec', 'p99 msec'), rows)
+
+        # compaction
+        path = os.path.join(directory, 'compact')
+        store = chat_store.MessageLog(path, segment_seconds=args.small)
+        now = time.time()
+        for i in range(args.messages // 10):
+            store.pending.append(('#quiet', now - 86400 + i * 86400.0 /
+                                  (args.messages // 10), frame))
+        store.close()
+
+        before = list_segments_count(chat_store, path, '#quiet')
+        store = chat_store.MessageLog(path, retention=43200)
+        start = time.time()
+        store.compact()
+        elapsed = time.time() - start
+        store.close()
+        after = list_segments_count(chat_store, path, '#quiet')
+
+        report('Compacting a day of messages in %g second segments, '
+               'keeping 12 hours' % args.small,
+               ('segments before', 'segments after', 'messages left',
+                'msec'),
+               [(before, after, len(chat_store.query(path, '#quiet')),
+                 elapsed * 1e3)])
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_snapshot(args):
+    """Benchmark snapshots and takeovers
+
+    --clients fake clients in channels of --channel-size, each channel
+    with --messages messages of history, and we time taking a snapshot
+    (channels only, as saved every --snapshot-interval, and with every
+    client, as handed over), writing it and loading it back. Then
+    --live clients connect to a real server started with --handoff and
+    we take it over from here, timing how long the clients go unserved:
+    from asking for the takeover to having everything restored
+    """
+
+    import shutil
+    import tempfile
+    import chat_server
+    import chat_snapshot
+
+    reset(chat_server)
+    socks = populate(chat_server, args.clients, args.channel_size)
+    line = 'x' * args.size
+    for channel in chat_server.CHANNELS.values():
+        for i in range(args.messages):
+            channel.remember(chat_server.make_frame(
+                u'\n<user%d> %s\r\n' % (i, line)))
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'state.snap')
+
+    rows = []
+    try:
+        for title, clients in (('channels', ()), ('channels + clients',
+                                                  socks)):
+            start = time.time()
+            data = chat_server.snapshot_state(clients)
+            taken = time.time() - start
+
+            start = time.time()
+            chat_snapshot.write_snapshot(path, data)
+            written = time.time() - start
+
+            start = time.time()
+            chat_snapshot.decode_state(chat_snapshot.read_snapshot(path))
+            loaded = time.time() - start
+
+            rows.append((title, len(data) / 1e6, taken * 1e3, written * 1e3,
+                         loaded * 1e3))
+    finally:
+        shutil.rmtree(directory)
+        reset(chat_server)
+
+    report('Snapshot of %d clients in %d channels with %d messages each'
+           % (args.clients, len(socks) // args.channel_size, args.messages),
+           ('snapshot', 'MB', 'take msec', 'write msec', 'load msec'), rows)
+
+    bench_restart(args)
+
+    if not chat_snapshot.can_pass_sockets():
+        print('(takeovers need python 3.3 or newer)')
+        return
+
+    raise_fd_limit()
+    handoff = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+    server = start_server(args.port, '--handoff', handoff)
+    clients = []
+
+    try:
+        for i in range(args.live):
+            sock = connect(args.port, 'live%d\r\n' % i)
+            sock.send(('/join #chan%d\r\n' % (i // args.channel_size))
+                      .encode())
+            clients.append(sock)
+
+        # wait until everyone is in their channel (select() can't
+        # take this many sockets so plain blocking reads it is)
+        for sock in clients:
+            data = b''
+            while b'Joined' not in data:
+                data += sock.recv(4096)
+
+        start = time.time()
+        data, listener, taken = chat_snapshot.request_takeover(handoff)
+        received = time.time() - start
+        chat_server.start_server(listener=listener)
+        chat_server.restore_state(data, taken)
+        restored = time.time() - start
+        server.wait()
+
+        # the clients are ours now
+        clients[0].send(b'/who\r\n')
+        while not drain(clients[0]):
+            chat_server.event_loop.run_once(0.1)
+
+        report('Taking over %d connected clients' % args.live,
+               ('snapshot KB', 'handed over msec', 'restored msec'),
+               [(len(data) / 1e3, received * 1e3, restored * 1e3)])
+    finally:
+        for sock in clients:
+            sock.close()
+        if server.poll() is None:
+            stop_server(server)
+        if chat_server.event_loop is not None:
+            chat_server.event_loop.close()
+        shutil.rmtree(os.path.dirname(handoff))
+
+
+def bench_restart(args):
+    """Check that history outlives a restart
+
+    A server started with --snapshot is told --messages lines in a
+    channel and stopped, then one more is started and stopped with
+    nobody joining, and the first client to join the channel on the
+    server after that should be replayed the last of them
+    """
+
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    options = ('--snapshot', os.path.join(directory, 'state.snap'),
+               '--history-replay', str(args.messages))
+    server = None
+
+    try:
+        server = start_server(args.port, *options)
+        sock = connect(args.port, 'talker\r\n')
+        sock.send(b'/join #restart\r\n')
+        for i in range(args.messages):
+            sock.send(('line %d\r\n' % i).encode())
+        sock.send(b'/history #restart\r\n')
+
+        # everything is in the history once /history shows it
+        data = b''
+        while b'End of history' not in data:
+            data += drain(sock, 1)
+        sock.close()
+        stop_server(server)
+
+        # the history has to outlive a snapshot nobody joined it for
+        server = start_server(args.port, *options)
+        stop_server(server)
+
+        start = time.time()
+        server = start_server(args.port, *options)
+        sock = connect(args.port, 'joiner\r\n')
+        sock.send(b'/join #restart\r\n')
+
+        data = b''
+        while b'End of history' not in data and b'No history' not in data:
+            chunk = drain(sock, 1)
+            if not chunk:
+                break
+            data += chunk
+        elapsed = time.time() - start
+        sock.close()
+    finally:
+        if server is not None:
+            stop_server(server)
+        shutil.rmtree(directory)
+
+    replayed = data.count(b'> line ')
+    report('Joining after a restart',
+           ('sent', 'replayed', 'msec'),
+           [(args.messages, replayed, elapsed * 1e3)])
+    if replayed != args.messages:
+        print('(history was lost in the restart)')
+
+
+def list_segments_count(chat_store, directory, channel):
+    """Function counts a channel's segments
+
+    :param chat_store: chat_store module
+    :param directory: log directory
+    :param channel: channel name
+    :return: number of segments
+    """
+
+    segments = chat_store.list_segments(
+        chat_store.channel_path(directory, channel))
+    return sum(len(s) for s in segments.values())
+
+
+def account_dict(ip):
+    """The original new_account, kept here for comparison
+
+    Every connection was a dictionary with a write buffer of its own
+    """
+
+    from collections import deque
+
+    return {
+        'username': '', 'ip': ip, 'state': 'accepted', 'timer': None,
+        'channels': [], 'current': '', 'inbuf': '', 'skipline': False,
+        'outbuf': deque(), 'outlen': 0, 'events': READ, 'throttled': False,
+        'paused': False, 'closing': False, 'dropped': 0
+    }
+
+
+def bench_sessions(args):
+    """Benchmark memory and access cost of the per-connection accounts
+
+    --count idle clients are registered (a username, no channels) with
+    the original account dictionaries and with Sessions, and we measure
+    the bytes each one holds on to, counting its entries in accounts,
+    USERS and CONNECTION_LIST but not the socket. Then we time reading
+    an attribute of every account the way broadcast_data and friends
+    do. Last, --live real clients connect to a server and we see how
+    much its resident memory grows per connection, sockets and all
+    """
+
+    import chat_server
+
+    layouts = (('dictionary', account_dict), ('Session', chat_server.Session))
+    rows = []
+
+    for name, make in layouts:
+        reset(chat_server)
+        socks = [FakeSocket() for i in range(args.count)]
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+
+        for i, sock in enumerate(socks):
+            # every accept() gives us a new string for the address
+            account = make(''.join(['127.0.0.', '1']))
+            chat_server.CONNECTION_LIST.append(sock)
+            chat_server.accounts[sock] = account
+            username = 'user%d' % i
+            chat_server.USERS[username] = sock
+            if isinstance(account, dict):
+                account['username'] = username
+                account['state'] = 'registered'
+            else:
+                account.username = username
+                account.state = 'registered'
+
+        if tracemalloc is not None:
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            per_connection = '%.0f' % (float(size) / args.count)
+        else:
+            per_connection = 'n/a'
+
+        accounts = chat_server.accounts
+        start = time.time()
+        for i in range(args.rounds):
+            if isinstance(accounts[socks[0]], dict):
+                for sock in socks:
+                    accounts[sock]['current']
+            else:
+                for sock in socks:
+                    accounts[sock].current
+        elapsed = time.time() - start
+
+        rows.append((name, per_connection,
+                     elapsed / (args.rounds * args.count) * 1e9))
+
+    reset(chat_server)
+
+    report('%d idle connections' % args.count,
+           ('account', 'bytes/connection', 'nsec/lookup'), rows)
+    if tracemalloc is None:
+        print('(bytes/connection needs tracemalloc, run with python 3)')
+
+    if not args.live:
+        return
+
+    raise_fd_limit()
+    server = start_server(args.port)
+    try:
+        before = server_rss(server.pid)
+        rss = []
+        welcomed, elapsed = register_clients(
+            args.port, args.live, args.concurrency,
+            lambda: rss.append(server_rss(server.pid)))
+        after = rss[0] if rss else before
+    finally:
+        stop_server(server)
+
+    report('Server with %d idle clients' % welcomed,
+           ('RSS before KB', 'RSS after KB', 'bytes/connection'),
+           [(before // 1024, after // 1024,
+             float(after - before) / max(welcomed, 1))])
+
+
+def bench_timers(args):
+    """Benchmark connection timeouts on the loop's heap and on a wheel
+
+    --timers timers are armed --delay seconds out, one per connection
+    like the registration and keepalive timeouts, first on the event
+    loop's heap and then on a TimerWheel. We time arming them, putting
+    every one off (cancel and arm again), and an event loop wakeup
+    with all of them pending, next to scanning every connection on
+    each wakeup to find the quiet ones. Last the same number of timers
+    spread over --spread seconds are left to expire, which the wheel
+    does in --tick second steps
+    """
+
+    rows = []
+    expiry = []
+
+    def nothing():
+        pass
+
+    for name in ('heap', 'wheel', 'scan'):
+        loop = EventLoop()
+        if name == 'wheel':
+            call_later = TimerWheel(loop, args.tick).call_later
+        else:
+            call_later = loop.call_later
+
+        # arm one per connection
+        start = time.time()
+        if name == 'scan':
+            seen = dict((i, start) for i in range(args.timers))
+            timers = []
+        else:
+            timers = [call_later(args.delay, nothing)
+                      for i in range(args.timers)]
+        arm = time.time() - start
+
+        # put every one off
+        start = time.time()
+        if name == 'scan':
+            now = time.time()
+            for i in seen:
+                seen[i] = now
+        else:
+            for i, timer in enumerate(timers):
+                timer.cancel()
+                timers[i] = call_later(args.delay, nothing)
+        rearm = time.time() - start
+
+        # wakeups with everything pending and nothing due
+        start = time.time()
+        for i in range(args.rounds):
+            loop.run_once(0)
+            if name == 'scan':
+                limit = time.time() - args.delay
+                for i in seen:
+                    if seen[i] < limit:
+                        nothing()
+        wakeup = time.time() - start
+
+        rows.append((name, arm / args.timers * 1e9,
+                     rearm / args.timers * 1e9, wakeup / args.rounds * 1e6,
+                     len(loop.timers)))
+
+        if name == 'scan':
+            break
+
+        # let timers spread evenly over --spread seconds expire
+        late = []
+
+        def expired(due):
+            late.append(time.time() - due)
+
+        loop = EventLoop()
+        if name == 'wheel':
+            call_later = TimerWheel(loop, args.tick).call_later
+        else:
+            call_later = loop.call_later
+
+        # a second to arm them all before the first is due
+        start = time.time() + 1
+        for i in range(args.timers):
+            due = start + args.spread * i / args.timers
+            call_later(due - time.time(), expired, due)
+
+        wakeups = 0
+        cpu = sum(os.times()[:2])
+        while len(late) < args.timers:
+            loop.run_once()
+            wakeups += 1
+        cpu = sum(os.times()[:2]) - cpu
+
+        late.sort()
+        expiry.append((name, wakeups, cpu * 1e3,
+                       late[len(late) // 2] * 1e3, late[-1] * 1e3))
+
+    report('%d timers %.0f seconds out' % (args.timers, args.delay),
+           ('timers', 'nsec/arm', 'nsec/re-arm', 'usec/wakeup',
+            'heap size'), rows)
+    report('%d timers expiring over %.1f seconds (wheel tick %.3f)' %
+           (args.timers, args.spread, args.tick),
+           ('timers', 'wakeups', 'cpu msec', 'p50 late msec',
+            'max late msec'), expiry)
+
+
+def fake_server(port, payload, expected, received):
+    """Function serves one client from a thread: sends it payload
+    and reads from it until expected bytes came or it hangs up
+
+    :param port: port to listen on
+    :param payload: bytes to send
+    :param expected: bytes to read, None to read until it hangs up
+    :param received: list the number of bytes read is added to
+    :return: thread, listening already
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+
+    def serve():
+        conn, addr = listener.accept()
+        listener.close()
+        conn.sendall(payload)
+        conn.shutdown(socket.SHUT_WR)
+        size = 0
+        while expected is None or size < expected:
+            data = conn.recv(262144)
+            if not data:
+                break
+            size += len(data)
+        received.append(size)
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return thread
+
+
+def bench_client(args):
+    """Benchmark the client reading a burst of messages and sending lines
+
+    A fake server sends --messages messages of --size bytes and the
+    client shows them on /dev/null, the way the old client did (recv
+    512 bytes, print what has a CR-LF in it) and with ChatClient and
+    Terminal, and as JSON lines like a --bot. Then --lines lines are
+    sent, one blocking send() per line as before and queued with
+    ChatClient.send()
+    """
+
+    import chat_client
+
+    message = b'\n<sender> ' + b'x' * max(0, args.size - 13) + b'\r\n'
+    payload = message * args.messages
+    line = b'y' * (args.size - 2)
+    rows = []
+
+    out = open(os.devnull, 'wb')
+
+    # the old client's loop
+    received = []
+    thread = fake_server(args.port, payload, None, received)
+    sock = socket.create_connection(('127.0.0.1', args.port))
+    shown = writes = 0
+    start = time.time()
+    while True:
+        data = sock.recv(512)
+        if not data:
+            break
+        if data.find(b'\r\n') > -1:
+            out.write(data + b'\n')
+            out.flush()
+            shown += data.count(message)
+            writes += 1
+    elapsed = time.time() - start
+    sock.close()
+    thread.join()
+    rows.append(('recv(512)', args.messages / elapsed, shown, writes))
+
+    # ChatClient, output batched per wakeup
+    class Counted(object):
+        def __init__(self):
+            self.writes = 0
+
+        def write(self, data):
+            self.writes += 1
+            out.write(data)
+
+        def flush(self):
+            out.flush()
+
+    whole = message.strip().decode()
+    sinks = (('ChatClient', chat_client.Terminal),
+             ('ChatClient --bot', chat_client.JSONOutput))
+
+    for name, sink in sinks:
+        received = []
+        thread = fake_server(args.port, payload, None, received)
+        stream = Counted()
+        shown = []
+        loop = EventLoop()
+        output = sink(loop, stream)
+
+        def show(client, text):
+            if text == whole:
+                shown.append(1)
+            output.show(client, text)
+
+        start = time.time()
+        chat_client.connect('127.0.0.1', args.port, 'bench', show,
+                            loop=loop).run()
+        elapsed = time.time() - start
+        loop.close()
+        thread.join()
+        rows.append((name, args.messages / elapsed, len(shown),
+                     stream.writes))
+
+    report('%d messages of %d bytes shown' % (args.messages, args.size),
+           ('client', 'messages/sec', 'shown whole', 'writes'), rows)
+
+    rows = []
+    expected = args.lines * (len(line) + 2)
+
+    # one blocking send per line
+    received = []
+    thread = fake_server(args.port, b'', expected, received)
+    sock = socket.create_connection(('127.0.0.1', args.port))
+    start = time.time()
+    for i in range(args.lines):
+        sock.send(line + b'\r\n')
+    thread.join()
+    elapsed = time.time() - start
+    sock.close()
+    rows.append(('send per line', args.lines / elapsed, received[0]))
+
+    # queued and sent together, once the server took the username
+    received = []
+    thread = fake_server(args.port, b'\nUsername authenticated!\r\n',
+                         expected + 7, received)
+    loop = EventLoop()
+    client = chat_client.connect('127.0.0.1', args.port, 'bench', loop=loop)
+    start = time.time()
+    for i in range(args.lines):
+        client.send(line)
+    while thread.is_alive():
+        loop.run_once(0.01)
+    elapsed = time.time() - start
+    client.close()
+    loop.close()
+    rows.append(('ChatClient', args.lines / elapsed, received[0] - 7))
+
+    report('%d lines of %d bytes sent' % (args.lines, args.size),
+           ('client', 'lines/sec', 'bytes'), rows)
+
+
+def bench_multiplex(args):
+    """Benchmark a client process per user against one chat_client.py
+    with a session per user
+
+    Every client is a --bot that stays on. The time is until the server
+    welcomed them all, the memory is what the client processes use
+    once it did, with pages shared between processes split among them
+    """
+
+    raise_fd_limit()
+    server = start_script('chat_server.py', args.port)
+    devnull = open(os.devnull, 'wb')
+    client = [sys.executable, 'chat_client.py', '127.0.0.1', str(args.port)]
+    rows = []
+
+    runs = (('process each', [client + ['p%d' % (i + 1), '--bot', '--stay']
+                              for i in range(args.clients)]),
+            ('sessions', [client + ['s', '--sessions', str(args.clients),
+                                    '--bot', '--stay']]))
+
+    try:
+        for name, commands in runs:
+            start = time.time()
+            procs = [subprocess.Popen(command, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=devnull)
+                     for command in commands]
+
+            # every process says when each of its users is welcomed
+            for proc in procs:
+                welcomed = 0
+                while welcomed < args.clients // len(procs):
+                    line = proc.stdout.readline()
+                    if not line:
+                        raise RuntimeError('%s: client exited' % name)
+                    if b'Username authenticated!' in line:
+                        welcomed += 1
+            elapsed = time.time() - start
+
+            memory = sum(process_memory(proc.pid) for proc in procs)
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+            rows.append((name, len(procs), elapsed, memory / 1e6,
+                         memory / 1e3 / args.clients))
+    finally:
+        stop_server(server)
+
+    report('%d users on one host' % args.clients,
+           ('client', 'processes', 'seconds', 'MB', 'KB per user'), rows)
+
+
+def process_memory(pid):
+    """Function reads a process' memory, shared pages split between
+    the processes sharing them (Linux only)
+
+    :param pid: process id
+    :return: bytes, the resident memory where that isn't known
+    """
+
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as rollup:
+            for line in rollup:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return server_rss(pid)
+
+
+def server_rss(pid):
+    """Function reads a process' resident memory (Linux only)
+
+    :param pid: process id
+    :return: bytes
+    """
+
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def count_members_scan(chat_server, channel):
+    """The original member count in leavechannel, kept here for comparison
+
+    Walks every account to see if anyone is still in the channel
+    """
+
+    accounts = chat_server.accounts
+    count = 0
+
+    for key in accounts:
+        if channel in accounts[key].channels:
+            count += 1
+
+    return count
+
+
+def bench_netsplit(args):
+    """Benchmark everyone disconnecting at once
+
+    Every user joins --channels channels of about --channel-size
+    members. Then each user leaves all its channels and is
+    disconnected, which is what logoff does apart from logging.
+    The scan column also runs the original member count after every
+    part, which made this O(users^2 x channels)
+    """
+
+    import chat_server
+
+    chat_server.event_loop = NullLoop()
+    rows = []
+
+    for count in args.counts:
+        timings = []
+
+        for scan in (False, True):
+
+            # the scan is quadratic, don't wait forever
+            if scan and count > args.scan_limit:
+                timings.append('-')
+                continue
+
+            reset(chat_server)
+            socks = []
+            channels = max(1, count * args.channels // args.channel_size)
+            for i in range(count):
+                sock = FakeSocket()
+                chat_server.CONNECTION_LIST.append(sock)
+                chat_server.accounts[sock] = chat_server.Session('')
+                chat_server.accounts[sock].username = 'user%d' % i
+                chat_server.USERS['user%d' % i] = sock
+                for c in range(args.channels):
+                    chat_server.joinchannel(
+                        sock, '#chan%d' % ((i + c * 7919) % channels))
+                socks.append(sock)
+
+            start = time.time()
+            for sock in socks:
+                joined = chat_server.accounts[sock].channels
+                for channel in joined[:]:
+                    chat_server.leavechannel(sock, channel)
+                    if scan:
+                        count_members_scan(chat_server, channel)
+                del chat_server.USERS[chat_server.accounts[sock].username]
+                chat_server.disconnect(sock)
+            timings.append(time.time() - start)
+
+        index, scan = timings
+        rows.append((count, index, index / count * 1e6, scan))
+
+    reset(chat_server)
+
+    report('Mass disconnect (%d channels per user, ~%d per channel)'
+           % (args.channels, args.channel_size),
+           ('users', 'index sec', 'usec/user', 'scan sec'), rows)
+
+
+def bench_shutdown(args):
+    """Benchmark logging everyone off at shutdown
+
+    logoff_many logs off all users at once. The loop column calls
+    logoff once per user the way the shutdown handler used to.
+    The split columns log off every other user with logoff_many,
+    like a netsplit, and count the messages the others are sent
+    """
+
+    import chat_server
+
+    chat_server.event_loop = NullLoop()
+    rows = []
+
+    for count in args.counts:
+        reset(chat_server)
+        socks = populate(chat_server, count, args.channel_size)
+        for sock in socks:
+            chat_server.accounts[sock].state = 'registered'
+
+        start = time.time()
+        chat_server.logoff_many(socks)
+        bulk = time.time() - start
+
+        # logoff is quadratic, don't wait forever
+        loop = '-'
+        if count <= args.loop_limit:
+            reset(chat_server)
+            socks = populate(chat_server, count, args.channel_size)
+            for sock in socks:
+                chat_server.accounts[sock].state = 'registered'
+
+            start = time.time()
+            for sock in socks:
+                chat_server.logoff(sock)
+            loop = time.time() - start
+
+        reset(chat_server)
+        socks = populate(chat_server, count, args.channel_size)
+        for sock in socks:
+            chat_server.accounts[sock].state = 'registered'
+
+        start = time.time()
+        chat_server.logoff_many(socks[::2])
+        split = time.time() - start
+        notices = sum(sock.sent for sock in socks[1::2])
+
+        rows.append((count, bulk * 1000, loop, split * 1000, notices))
+
+    reset(chat_server)
+
+    report('Logging off everyone (%d members per channel)'
+           % args.channel_size,
+           ('users', 'bulk msec', 'loop sec', 'split msec', 'notices'),
+           rows)
+
+
+def fanout(port, clients, channel_size, lines):
+    """Function runs a channel fan-out load against a running server
+
+    clients clients are split into channels of channel_size and every
+    client sends lines chat lines. We time how long until every member
+    has every line
+
+    :param port: server port
+    :param clients: number of clients
+    :param channel_size: clients per channel
+    :param lines: chat lines each client sends
+    :return: (seconds to connect, expected, delivered, seconds)
+    """
+
+    loop = EventLoop()
+    socks = []
+    state = {'received': 0}
+
+    def on_data(sock, events):
+        data = sock.recv(262144)
+        state['received'] += data.count(b'\n<')
+
+    try:
+        start = time.time()
+        for i in range(clients):
+            sock = connect(port, 'w%d' % i)
+            sock.send(b'/join #c%d\r\n' % (i // channel_size))
+            socks.append(sock)
+        connected = time.time() - start
+
+        # let everyone's join notices arrive and throw them away
+        for sock in socks:
+            drain(sock, 0.01)
+        time.sleep(0.5)
+        for sock in socks:
+            drain(sock)
+            sock.setblocking(0)
+            loop.register(sock, READ, on_data)
+
+        # members of the last channel may be fewer
+        expected = 0
+        for first in range(0, clients, channel_size):
+            members = min(channel_size, clients - first)
+            expected += members * (members - 1) * lines
+
+        data = b''.join(b'm%d\r\n' % i for i in range(lines))
+
+        start = time.time()
+        for sock in socks:
+            sock.setblocking(1)
+            sock.sendall(data)
+            sock.setblocking(0)
+            loop.run_once(0)
+
+        while state['received'] < expected:
+            if not loop.run_once(5):
+                break
+        elapsed = time.time() - start
+    finally:
+        loop.close()
+        for sock in socks:
+            sock.close()
+
+    return connected, expected, state['received'], elapsed
+
+
+def bench_workers(args):
+    """Benchmark channel fan-out through several worker processes
+
+    The kernel spreads the connections over the workers so most
+    channels have members on several workers and their messages
+    go through the hub
+    """
+
+    raise_fd_limit()
+    rows = []
+
+    for workers in args.workers:
+        server = start_server(args.port, '--workers', str(workers))
+        try:
+            connected, expected, received, elapsed = fanout(
+                args.port, args.clients, args.channel_size, args.lines)
+        finally:
+            stop_server(server)
+
+        rows.append((workers, expected, received, elapsed,
+                     received / elapsed))
+
+    report('Channel fan-out with worker processes '
+           '(%d clients, channels of %d, %d lines each)'
+           % (args.clients, args.channel_size, args.lines),
+           ('workers', 'expected', 'delivered', 'seconds', 'msgs/sec'), rows)
+
+
+def bench_servers(args):
+    """Benchmark the event loop server against the asyncio server
+
+    Runs the same fan-out load as the workers benchmark against
+    chat_server.py and chat_aio.py (on asyncio and on uvloop)
+    """
+
+    raise_fd_limit()
+    rows = []
+
+    servers = [('event loop', 'chat_server.py', [])]
+
+    # chat_aio.py needs python 3
+    if sys.version_info[0] >= 3:
+        servers.append(('asyncio', 'chat_aio.py', ['--loop', 'asyncio']))
+        try:
+            import uvloop  # noqa: F401
+            servers.append(('uvloop', 'chat_aio.py', ['--loop', 'uvloop']))
+        except ImportError:
+            pass
+
+    for name, script, options in servers:
+        server = start_script(script, args.port, *options)
+        try:
+            connected, expected, received, elapsed = fanout(
+                args.port, args.clients, args.channel_size, args.lines)
+        finally:
+            stop_server(server)
+
+        rows.append((name, args.clients / connected, received,
+                     elapsed, received / elapsed))
+
+    report('Event loop server vs asyncio server '
+           '(%d clients, channels of %d, %d lines each)'
+           % (args.clients, args.channel_size, args.lines),
+           ('server', 'connects/sec', 'delivered', 'seconds', 'msgs/sec'),
+           rows)
+    if len(servers) == 1:
+        print('(chat_aio.py needs python 3)')
+
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='chat server benchmarks')
+    sub = parser.add_subparsers(dest='benchmark')
+
+    p = sub.add_parser('loop', help='event loop latency vs connection count')
+    p.add_argument('--backends', nargs='*', default=None,
+                   choices=available_backends())
+    p.add_argument('--counts', nargs='*', type=int,
+                   default=[10, 100, 450, 1000, 5000, 9000])
+    p.add_argument('--rounds', type=int, default=2000)
+    p.set_defaults(func=bench_loop)
+
+    p = sub.add_parser('broadcast', help='channel fan-out cost')
+    p.add_argument('--counts', nargs='*', type=int,
+                   default=[1000, 10000, 50000])
+    p.add_argument('--channel-size', type=int, default=10)
+    p.add_argument('--messages', type=int, default=200)
+    p.set_defaults(func=bench_broadcast)
+
+    p = sub.add_parser('privmsg', help='/msg throughput')
+    p.add_argument('--counts', nargs='*', type=int, default=[1000, 20000])
+    p.add_argument('--messages', type=int, default=20000)
+    p.set_defaults(func=bench_privmsg)
+
+    p = sub.add_parser('pipeline', help='throughput of pipelined lines')
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--lines', type=int, default=20000)
+    p.add_argument('--batches', nargs='*', type=int,
+                   default=[1, 10, 100, 500])
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser('flood', help='flood control cost and protection')
+    p.add_argument('--clients', type=int, default=1000)
+    p.add_argument('--lines', type=int, default=100000)
+    p.add_argument('--size', type=int, default=80)
+    p.add_argument('--flooders', type=int, default=4)
+    p.add_argument('--probes', type=int, default=50)
+    p.add_argument('--limits', default='--flood-lines 20 --channel-lines 50')
+    p.add_argument('--port', type=int, default=6704)
+    p.set_defaults(func=bench_flood)
+
+    p = sub.add_parser('connect', help='client registration rate')
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--clients', type=int, default=5000)
+    p.add_argument('--silent', type=int, default=100)
+    p.add_argument('--concurrency', type=int, default=100)
+    p.set_defaults(func=bench_connect)
+
+    p = sub.add_parser('parse', help='command parser throughput')
+    p.add_argument('--rounds', type=int, default=200000)
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser('metrics', help='overhead of having metrics on')
+    p.add_argument('--rounds', type=int, default=20000)
+    p.add_argument('--repeats', type=int, default=5)
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--clients', type=int, default=400)
+    p.add_argument('--channel-size', type=int, default=20)
+    p.add_argument('--lines', type=int, default=50)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser('history', help='channel history memory and cost')
+    p.add_argument('--channels', type=int, default=5000)
+    p.add_argument('--messages', type=int, default=200)
+    p.add_argument('--size', type=int, default=80)
+    p.add_argument('--limits', nargs='*', type=lambda s: tuple(
+                       int(n) for n in s.split(':')),
+                   default=[(50, 8192), (200, 8192), (50, 2048),
+                            (1000, 32768)],
+                   help='lines:bytes pairs')
+    p.add_argument('--rounds', type=int, default=50000)
+    p.set_defaults(func=bench_history)
+
+    p = sub.add_parser('store', help='on-disk channel logs')
+    p.add_argument('--channels', type=int, default=1000)
+    p.add_argument('--appends', type=int, default=200000)
+    p.add_argument('--size', type=int, default=80)
+    p.add_argument('--messages', type=int, default=500000)
+    p.add_argument('--segment-bytes', type=int, default=4 * 1024 * 1024)
+    p.add_argument('--spans', nargs='*', type=float, default=[1, 60])
+    p.add_argument('--queries', type=int, default=200)
+    p.add_argument('--small', type=float, default=600)
+    p.set_defaults(func=bench_store)
+
+    p = sub.add_parser('snapshot', help='state snapshots and takeovers')
+    p.add_argument('--clients', type=int, default=20000)
+    p.add_argument('--channel-size', type=int, default=10)
+    p.add_argument('--messages', type=int, default=50)
+    p.add_argument('--size', type=int, default=80)
+    p.add_argument('--live', type=int, default=2000)
+    p.add_argument('--port', type=int, default=6704)
+    p.set_defaults(func=bench_snapshot)
+
+    p = sub.add_parser('logging', help='cost of the server log')
+    p.add_argument('--counts', nargs='*', type=int,
+                   default=[1000, 5000, 20000])
+    p.add_argument('--rounds', type=int, default=2000)
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--clients', type=int, default=5000)
+    p.add_argument('--concurrency', type=int, default=100)
+    p.set_defaults(func=bench_logging)
+
+    p = sub.add_parser('sessions', help='memory per idle connection')
+    p.add_argument('--count', type=int, default=50000)
+    p.add_argument('--rounds', type=int, default=20)
+    p.add_argument('--live', type=int, default=5000)
+    p.add_argument('--concurrency', type=int, default=100)
+    p.add_argument('--port', type=int, default=6704)
+    p.set_defaults(func=bench_sessions)
+
+    p = sub.add_parser('timers', help='connection timeouts, heap vs wheel')
+    p.add_argument('--timers', type=int, default=50000)
+    p.add_argument('--delay', type=float, default=120)
+    p.add_argument('--rounds', type=int, default=1000)
+    p.add_argument('--spread', type=float, default=2)
+    p.add_argument('--tick', type=float, default=0.1)
+    p.set_defaults(func=bench_timers)
+
+    p = sub.add_parser('frames', help='memory used by channel fan-out')
+    p.add_argument('--members', type=int, default=5000)
+    p.add_argument('--size', type=int, default=200)
+    p.set_defaults(func=bench_frames)
+
+    p = sub.add_parser('netsplit', help='everyone disconnecting at once')
+    p.add_argument('--counts', nargs='*', type=int,
+                   default=[1000, 2500, 5000, 10000])
+    p.add_argument('--channels', type=int, default=3)
+    p.add_argument('--channel-size', type=int, default=20)
+    p.add_argument('--scan-limit', type=int, default=5000)
+    p.set_defaults(func=bench_netsplit)
+
+    p = sub.add_parser('shutdown', help='logging everyone off at once')
+    p.add_argument('--counts', nargs='*', type=int,
+                   default=[1000, 5000, 20000])
+    p.add_argument('--channel-size', type=int, default=20)
+    p.add_argument('--loop-limit', type=int, default=5000)
+    p.set_defaults(func=bench_shutdown)
+
+    p = sub.add_parser('workers', help='fan-out with worker processes')
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--workers', nargs='*', type=int, default=[1, 2, 4])
+    p.add_argument('--clients', type=int, default=400)
+    p.add_argument('--channel-size', type=int, default=20)
+    p.add_argument('--lines', type=int, default=50)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser('client', help='client receive and send paths')
+    p.add_argument('--port', type=int, default=6705)
+    p.add_argument('--messages', type=int, default=100000)
+    p.add_argument('--lines', type=int, default=100000)
+    p.add_argument('--size', type=int, default=80)
+    p.set_defaults(func=bench_client)
+
+    p = sub.add_parser('multiplex', help='client process per user vs '
+                                         'sessions in one')
+    p.add_argument('--port', type=int, default=6706)
+    p.add_argument('--clients', type=int, default=100)
+    p.set_defaults(func=bench_multiplex)
+
+    p = sub.add_parser('servers', help='event loop vs asyncio server')
+    p.add_argument('--port', type=int, default=6767)
+    p.add_argument('--clients', type=int, default=400)
+    p.add_argument('--channel-size', type=int, default=20)
+    p.add_argument('--lines', type=int, default=50)
+    p.set_defaults(func=bench_servers)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+
+    args.func(args)
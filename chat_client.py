@@ -17,118 +17,1006 @@
     You should have received a copy of the GNU General Public License along
     with this program; if not, write to the Free Software Foundation, Inc.,
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ The client runs on the same event loop as the server (chat_events.py)
+ and can be used from other programs, bots and load tools:
+
+     import chat_client
+
+     def show(client, message):
+         print(message)
+
+     client = chat_client.connect('127.0.0.1', 6667, 'bot', show)
+     client.send('/join #bots')
+     client.run()
+
+ Several clients can share one EventLoop (loop=...), which then is
+ run by whoever created it. Sessions does that for a list of usernames
+ and sends each line to all of them, or to one with @username first
 """
+from __future__ import print_function
 
+import os       # for reading standard input
+import time     # for timestamps and pacing
+import random   # for spreading out reconnects
+import errno    # for socket error codes
 import socket   # for socket objects
-import select   # for select function
 import signal   # for signal interrupt
 import sys      # for handling command line arguments
+import argparse  # for command line options
 
+from collections import deque  # for the write buffer
 
-def signal_handler(signal, frame):
-    """Function handles signal interrupt (CTRL-C)
+from json.encoder import encode_basestring_ascii as quote_json  # for bots
 
-    :param signal: signal caught
-    :param frame: current stack frame
+from chat_events import EventLoop, READ, WRITE
+
+# bytes read from the server at a time
+RECV_BUFFER = 65536
+
+# bytes handed to one send()
+SEND_BATCH = 65536
+
+# bytes of a message without its CR-LF before it is handed over anyway
+MAX_MESSAGE = 65536
+
+# seconds between batches of paced lines
+TICK = 0.01
+
+# longest wait before the first reconnect, it doubles with every
+# failed one up to RECONNECT_MAX
+RECONNECT_FIRST = 1.0
+RECONNECT_MAX = 60.0
+
+# reconnects tried after quit() to deliver lines sent while offline
+QUIT_TRIES = 3
+
+# what quit() sends
+EXIT = b'/exit\r\n'
+
+
+def encode(text):
+    """Function turns text into bytes for the socket
+
+    :param text: text or bytes
+    :return: bytes
     """
-    s.send('/exit')
-    sys.exit(0)
 
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
 
-signal.signal(signal.SIGINT, signal_handler)
 
+class Backoff(object):
+    """Jittered exponential backoff between reconnects
 
-if __name__ == "__main__":
-    """Main function
+    The longest wait doubles with every try that fails, up to most,
+    and the wait itself is picked at random below it, so clients that
+    lost the same server don't all come back at the same moment
+    """
+
+    def __init__(self, first=RECONNECT_FIRST, most=RECONNECT_MAX):
+        """
+        :param first: longest wait before the first try, in seconds
+        :param most: longest wait ever, in seconds
+        """
+
+        self.first = first
+        self.most = most
+        self.tries = 0
 
+    def delay(self):
+        """Function picks the wait before the next try
+
+        :return: seconds
+        """
+
+        # capping the exponent keeps the float from overflowing
+        ceiling = min(self.most, self.first * 2 ** min(self.tries, 32))
+        self.tries += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        """The server took us back, start over"""
+
+        self.tries = 0
+
+
+class ChatClient(object):
+    """Connection to the chat server
+
+    Lines to send are queued and written whenever the socket takes
+    them, every line queued during one wakeup goes out in one send(),
+    so sending never blocks. What the server sends is kept until the
+    CR-LF that ends each message, so messages split over several reads
+    or packed into one arrive whole and one at a time. PINGs from the
+    server are answered here and never passed on
+
+    The server's replies are followed to keep track of the channels
+    we are in, the current one (where chat lines go and come from),
+    the channel whose history is being replayed and our username
+
+    Once connected the username goes first. Lines sent before the
+    server took it wait, so a username that is refused loses nothing
+
+    With a Backoff a lost connection is made again after a while.
+    Once the server took the username again the channels we were in
+    are joined and the current one made current again, and then the
+    lines sent in the meantime go out. Until then every failed try
+    keeps all of that for the next one
+
+    Callbacks:
+      on_message(client, message) for every message, as a string without
+                                  the blank line the server puts first
+      on_connect(client)          once connected and the username sent
+      on_close(client, reason)    once the connection is gone, with
+                                  client.retry set if we'll reconnect
+                                  (and again if quit() stops that)
     """
 
-    # user supplied the wrong amount of arguments
-    if(len(sys.argv) < 4):
-        # show proper usage and exit program
-        print 'Usage : python chat_client.py hostname port username'
-        sys.exit()
+    def __init__(self, host, port, username, on_message=None,
+                 on_connect=None, on_close=None, loop=None,
+                 backoff=None):
+        """
+        :param host: server address
+        :param port: server port
+        :param username: username to register
+        :param on_message: see above
+        :param on_connect: see above
+        :param on_close: see above
+        :param loop: EventLoop to run on, a new one when None
+        :param backoff: Backoff to reconnect with, None to stay closed
+        """
+
+        self.host = host
+        self.port = port
+        self.username = username
+        self.on_message = on_message
+        self.on_connect = on_connect
+        self.on_close = on_close
+        self.loop = loop or EventLoop()
+        self.backoff = backoff
+
+        self.sock = None
+        self.connected = False
+        self.closed = True
+
+        # timer for the next reconnect, None when there is none
+        self.retry = None
+
+        # set once we asked the server to log us off, and how many
+        # more reconnects that leaves us
+        self.quitting = False
+        self.quit_tries = 0
+
+        # a message that hasn't been completely received yet
+        self.inbuf = b''
+
+        # set once the server took our username
+        self.registered = False
+
+        # channels we are in, the current one and the one whose
+        # history is being sent (None for none), the first two are
+        # kept after the connection is lost to go back to them
+        self.channels = []
+        self.current = None
+        self.replaying = None
+
+        # lines waiting to be sent, and whether a flush is on its way
+        self.outbuf = deque()
+        self.flushing = False
+
+        # lines waiting for the server to take our username
+        self.later = deque()
+
+    def connect(self):
+        """Start connecting, the username goes first once connected"""
+
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.connected = False
+        self.closed = False
+        self.registered = False
+        self.inbuf = b''
+        self.replaying = None
+
+        error = self.sock.connect_ex((self.host, self.port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            self.closed = True
+            self.lost('Unable to connect')
+            return
+
+        # writable once connected
+        self.loop.register(self.sock, WRITE, self.ready)
+
+    def send(self, line):
+        """Queue a line for the server
+
+        Lines sent while not connected go out once we are. A line
+        always goes out as one line, one that is too long for the
+        server is thrown away there and we are told
+
+        :param line: text or bytes, without CR-LF
+        """
+
+        line = encode(line).rstrip(b'\r\n')
+
+        # a line break inside would make the rest a line of its own,
+        # a chat line or even a command
+        if b'\n' in line or b'\r' in line:
+            line = line.replace(b'\r', b' ').replace(b'\n', b' ')
+
+        if self.registered:
+            self.queue(line + b'\r\n')
+        else:
+            self.later.append(line + b'\r\n')
+
+    def queue(self, data):
+        """Queue data to go out now
+
+        :param data: bytes, whole lines with their CR-LF
+        """
+
+        self.outbuf.append(data)
+
+        # everything queued during this wakeup goes out together
+        if self.connected and not self.flushing:
+            self.flushing = True
+            self.loop.call_soon(self.flush)
+
+    def quit(self):
+        """Log off, the connection closes once the server has let go"""
+
+        self.quitting = True
+        self.quit_tries = QUIT_TRIES
+        self.send(EXIT)
+        if self.connected:
+            self.flush()
+
+        # waiting to reconnect with nothing to deliver, stop waiting
+        elif self.retry is not None and not self.pending():
+            self.retry.cancel()
+            self.retry = None
+            self.lost('Logged off')
+
+    def pending(self):
+        """Function checks for queued lines besides the /exit
+
+        :return: True or False
+        """
+
+        for line in self.later:
+            if line != EXIT:
+                return True
+        for line in self.outbuf:
+            if line != EXIT:
+                return True
+        return False
+
+    def flush(self):
+        """Send as much of the queue as the socket takes"""
+
+        self.flushing = False
+        if not self.connected:
+            return
+
+        outbuf = self.outbuf
+        while outbuf:
+
+            # join lines up to SEND_BATCH bytes
+            batch = [outbuf.popleft()]
+            size = len(batch[0])
+            while outbuf and size + len(outbuf[0]) <= SEND_BATCH:
+                size += len(outbuf[0])
+                batch.append(outbuf.popleft())
+            data = b''.join(batch)
+
+            try:
+                sent = self.sock.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    sent = 0
+                else:
+                    self.close('Disconnected from chat server')
+                    return
 
-    # get the IRC server address
-    host = sys.argv[1]
+            # the rest waits for the socket to be writable
+            if sent < len(data):
+                outbuf.appendleft(data[sent:])
+                break
 
-    # get the IRC server port
-    port = int(sys.argv[2])
+        self.loop.modify(self.sock, (READ | WRITE) if outbuf else READ)
 
-    # get the user's name
-    username = sys.argv[3]
+    def ready(self, sock, events):
+        """Event loop handler for the server socket
 
-    # protect against user names
-    # longer than 9 chars
-    if len(username) > 9:
-        print 'Username is too long. Max is 9 characters'
-        sys.exit()
+        :param sock: socket object
+        :param events: mask of ready events
+        """
 
-    # create TCP Socket
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connected:
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.close('Unable to connect')
+                return
+            self.connected = True
+            self.greet()
+            self.flush()
+            if self.on_connect is not None:
+                self.on_connect(self)
+            return
 
-    # set timeout to 2 seconds
-    s.settimeout(2)
+        if events & WRITE:
+            self.flush()
 
-    # connect to remote host
-    try:
-        s.connect((host, port))
-    except:
-        print 'Unable to connect'
-        sys.exit()
-    print 'Connected to IRC server'
+        if events & READ and not self.closed:
+            try:
+                data = sock.recv(RECV_BUFFER)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = b''
+
+            if not data:
+                self.close('Disconnected from chat server')
+                return
+
+            self.received(data)
+
+    def greet(self):
+        """Function sends the username, the first thing once connected"""
+
+        self.outbuf.appendleft(encode(self.username) + b'\r\n')
+
+    def welcomed(self):
+        """Function goes back to the channels we were in once the server
+        took our username, and sends the lines that waited for it
+
+        The channels and the current one are left as they are, the
+        server's replies to the joins only confirm them, so they
+        are still there if the connection is lost before that
+        """
+
+        self.registered = True
+
+        # the next lost connection starts the backoff over
+        if self.backoff is not None:
+            self.backoff.reset()
 
-    # send user's name to server
+        lines = ['/join ' + channel for channel in self.channels]
+
+        # the last one joined is current already
+        if self.current is not None and self.channels[-1:] != [self.current]:
+            lines.append('/current ' + self.current)
+
+        for line in lines:
+            self.queue(encode(line) + b'\r\n')
+
+        later, self.later = self.later, deque()
+        for line in later:
+            self.queue(line)
+
+    def received(self, data):
+        """Function hands every complete message in data over
+
+        :param data: bytes from the server
+        """
+
+        messages = (self.inbuf + data).split(b'\r\n')
+        self.inbuf = messages.pop()
+
+        # a message that never ends is passed on in pieces
+        if len(self.inbuf) > MAX_MESSAGE:
+            messages.append(self.inbuf)
+            self.inbuf = b''
+
+        for message in messages:
+            message = message.lstrip(b'\n')
+
+            # python 3 wants text, python 2 strings are bytes already
+            if not isinstance(message, str):
+                message = message.decode('utf-8', 'replace')
+
+            # keepalive from the server, answered before anything waiting
+            if message.startswith('PING '):
+                self.queue(encode('/pong ' + message[5:]) + b'\r\n')
+                continue
+
+            # chat lines start with the sender, the rest are replies
+            if message[:1] != '<':
+                self.track(message)
+
+            if message and self.on_message is not None:
+                self.on_message(self, message)
+
+            # a callback may have closed us
+            if self.closed:
+                return
+
+    def track(self, message):
+        """Function follows the server's replies that change our state
+
+        :param message: message from the server
+        """
+
+        words = message.split()
+        if not words:
+            return
+
+        # joining a channel makes it the current one
+        if words[0] == 'Joined' and len(words) == 2:
+            if words[1] not in self.channels:
+                self.channels.append(words[1])
+            self.current = words[1]
+
+        elif message.startswith('Current channel is now '):
+            self.current = words[-1]
+
+        elif words[:2] == ['You', 'left'] and len(words) == 3:
+            if words[2] in self.channels:
+                self.channels.remove(words[2])
+            if self.current == words[2]:
+                self.current = None
+
+        elif message.startswith('Last ') and message.endswith(':'):
+            self.replaying = words[-1][:-1]
+
+        elif message.startswith('End of history for '):
+            self.replaying = None
+
+        elif message.startswith('Now known as '):
+            self.username = words[-1]
+
+        elif message == 'Username authenticated!':
+            self.welcomed()
+
+    def close(self, reason='Closed'):
+        """Close the connection
+
+        Lines the server didn't get yet are thrown away, unless they
+        were waiting for it to take our username, ones sent after this
+        wait for the next connection too. With a backoff that is made
+        later on unless we logged off (set backoff to None to stop)
+
+        :param reason: what on_close is told
+        """
+
+        if self.closed:
+            return
+
+        # half sent lines, the ones still waiting are in later
+        self.outbuf.clear()
+
+        self.closed = True
+        self.connected = False
+        self.registered = False
+        self.loop.unregister(self.sock)
+        self.sock.close()
+        self.lost(reason)
+
+    def lost(self, reason):
+        """Function schedules the reconnect, if any, and tells on_close
+
+        :param reason: what on_close is told
+        """
+
+        retry = self.backoff is not None
+
+        # logging off, only lines sent while offline are worth
+        # coming back for, and only QUIT_TRIES times
+        if retry and self.quitting:
+            self.quit_tries -= 1
+            retry = self.quit_tries >= 0 and self.pending()
+
+        if retry:
+            self.retry = self.loop.call_later(self.backoff.delay(),
+                                              self.connect)
+
+        if self.on_close is not None:
+            self.on_close(self, reason)
+
+    def run(self):
+        """Run the event loop until the connection closes for good"""
+
+        while not self.closed or self.retry is not None:
+            self.loop.run_once()
+
+
+def connect(host, port, username, on_message=None, on_connect=None,
+            on_close=None, loop=None, backoff=None):
+    """Function connects a new client to the server
+
+    :param host: server address
+    :param port: server port
+    :param username: username to register
+    :param on_message: on_message(client, message), see ChatClient
+    :param on_connect: on_connect(client)
+    :param on_close: on_close(client, reason)
+    :param loop: EventLoop to run on, a new one when None
+    :param backoff: Backoff to reconnect with, None to stay closed
+    :return: ChatClient, connecting
+    """
+
+    client = ChatClient(host, port, username, on_message, on_connect,
+                        on_close, loop, backoff)
+    client.connect()
+    return client
+
+
+class Sessions(object):
+    """Many clients in one process, each its own username and socket
+
+    They all run on one EventLoop. Lines starting with @username go to
+    that session only (as what follows), the others to every session.
+    Messages are handed to on_message with the client they came from,
+    so one output can tell them apart
+    """
+
+    def __init__(self, host, port, usernames, on_message=None,
+                 on_connect=None, on_close=None, loop=None, backoff=None):
+        """
+        :param host: server address
+        :param port: server port
+        :param usernames: list of usernames, one session each
+        :param on_message: on_message(client, message), see ChatClient
+        :param on_connect: on_connect(client)
+        :param on_close: on_close(client, reason)
+        :param loop: EventLoop to run on, a new one when None
+        :param backoff: backoff() makes each session's Backoff (the
+                        class will do), None to stay closed
+        """
+
+        self.loop = loop or EventLoop()
+        self.on_close = on_close
+        self.quitting = False
+
+        self.clients = [ChatClient(host, port, username, on_message,
+                                   on_connect, self.closed, self.loop,
+                                   backoff() if backoff else None)
+                        for username in usernames]
+
+        # usernames change with /nick, see route()
+        self.names = {}
+
+        # sessions that didn't close for good yet
+        self.running = 0
+
+    def connect(self):
+        """Start connecting every session"""
+
+        self.running = len(self.clients)
+        for client in self.clients:
+            client.connect()
+
+    def closed(self, client, reason):
+        """on_close callback of every session"""
+
+        if client.retry is None:
+            self.running -= 1
+
+        if self.on_close is not None:
+            self.on_close(client, reason)
+
+    def route(self, name):
+        """Function finds the session with a username
+
+        :param name: username
+        :return: ChatClient, None if no session has it
+        """
+
+        client = self.names.get(name)
+        if client is None or client.username != name:
+            self.names = dict((c.username, c) for c in self.clients)
+            client = self.names.get(name)
+        return client
+
+    def send(self, line):
+        """Queue a line for one session, or for all of them
+
+        :param line: text or bytes, @username first for one session
+        """
+
+        line = encode(line)
+
+        if line[:1] != b'@':
+            for client in self.clients:
+                client.send(line)
+            return
+
+        name, _, line = line[1:].partition(b' ')
+
+        # usernames are text on python 3
+        if not isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+
+        client = self.route(name)
+        if client is None:
+            print('No session is called ' + name, file=sys.stderr)
+        else:
+            client.send(line)
+
+    def quit(self):
+        """Log every session off"""
+
+        self.quitting = True
+        for client in self.clients:
+            client.quit()
+
+    def run(self):
+        """Run the event loop until every session closed for good"""
+
+        while self.running:
+            self.loop.run_once()
+
+
+def parse_message(client, message):
+    """Function works out what kind of message it is and who sent it where
+
+    Chat lines only go to the members for whom the channel is current,
+    so a chat line came from our current channel, or from the one
+    whose history is being replayed
+
+    :param client: ChatClient the message came from
+    :param message: message from the server
+    :return: (kind, channel, sender, text), kind is chat, private or
+             server, channel and sender None when there is none
+    """
+
+    if message[:1] == '<':
+        end = message.find('> ')
+        if end > 0:
+            sender = message[1:end]
+            text = message[end + 2:]
+            if sender.startswith('private message from '):
+                return 'private', None, sender[21:], text
+            return 'chat', client.replaying or client.current, sender, text
+
+    return 'server', None, None, message
+
+
+class Terminal(object):
+    """Writes messages to the screen
+
+    Messages that arrive during one wakeup are written with one
+    write() and one flush() once it is done, so a burst of them
+    doesn't cost a system call each
+    """
+
+    def __init__(self, loop, stream=None, tagged=False):
+        """
+        :param loop: EventLoop the clients run on
+        :param stream: where to write (stdout)
+        :param tagged: say which client every message came from
+        """
+
+        self.loop = loop
+        self.tagged = tagged
+        stream = stream or sys.stdout
+
+        # python 3 text streams want text, we hand over bytes
+        self.stream = getattr(stream, 'buffer', stream)
+        self.pending = []
+
+    def show(self, client, message):
+        """on_message callback
+
+        :param client: ChatClient the message came from
+        :param message: text
+        """
+
+        if self.tagged:
+            message = '[%s] %s' % (client.username, message)
+        self.write(message)
+
+    def write(self, message):
+        """Queue a line of output
+
+        :param message: text
+        """
+
+        if not self.pending:
+            self.loop.call_soon(self.flush)
+        self.pending.append(message)
+
+    def flush(self):
+        """Write out what arrived during the last wakeup"""
+
+        if not self.pending:
+            return
+
+        data = '\n'.join(self.pending) + '\n'
+        del self.pending[:]
+
+        self.stream.write(encode(data))
+        self.stream.flush()
+
+
+def json_string(value):
+    """Function turns a string into JSON
+
+    :param value: string or None
+    :return: JSON string, or null for None
+    """
+
+    if value is None:
+        return 'null'
+
+    # python 2 strings are bytes and may not be UTF-8
     try:
-        s.send(username)
-    except:
-        # bad username, exit program
-        print 'Unable to authenticate username'
-        sys.exit()
+        return quote_json(value)
+    except UnicodeDecodeError:
+        return quote_json(value.decode('utf-8', 'replace'))
+
 
-    while 1:
-        socket_list = [sys.stdin, s]
+class JSONOutput(Terminal):
+    """Writes messages as JSON lines for other programs
 
-        # Get the list sockets which are readable
-        read_sockets, write_sockets, error_sockets = select.select(
-            socket_list, [], [])
+    Every message becomes {"ts": ..., "kind": ..., "channel": ...,
+    "sender": ..., "text": ...}, see parse_message, tagged ones get
+    the "session" (username) they came from too. They are written in
+    batches like the Terminal's
+    """
 
-        for sock in read_sockets:
+    def show(self, client, message):
+        kind, channel, sender, text = parse_message(client, message)
 
-            # incoming message from remote server
-            if sock == s:
+        # the same keys every time, so only the values go through json
+        line = '{"channel": %s, "kind": "%s", "sender": %s, ' % (
+            json_string(channel), kind, json_string(sender))
+        if self.tagged:
+            line += '"session": %s, ' % json_string(client.username)
 
-                # receive up to 512 bytes of data
-                data = sock.recv(512)
+        self.write(line + '"text": %s, "ts": %.6f}' % (
+            json_string(text), time.time()))
 
-                # if there is no data
-                # connection timed out
-                # close it
-                if not data:
-                    print '\nDisconnected from chat server'
-                    sock.close()
-                    sys.exit()
 
-                # we have data from the server
-                else:
+class Pacer(object):
+    """Hands lines to a client at no more than rate per second
+
+    Lines due in the same TICK go together, so high rates don't
+    need a timer per line
+    """
+
+    def __init__(self, loop, send, rate, on_done=None):
+        """
+        :param loop: EventLoop the client runs on
+        :param send: send(line), like ChatClient.send
+        :param rate: lines per second, 0 for as fast as they come
+        :param on_done: on_done() once the last line has been sent
+        """
+
+        self.loop = loop
+        self.send = send
+        self.rate = rate
+        self.on_done = on_done
+
+        self.lines = deque()
+        self.ending = False
+        self.timer = None
+        self.credit = 0.0
+        self.last = 0
+
+    def add(self, line):
+        """Queue a line
+
+        :param line: bytes or text
+        """
+
+        if not self.rate:
+            self.send(line)
+            return
+
+        self.lines.append(line)
+        if self.timer is None:
+            self.run()
+
+    def end(self):
+        """No more lines are coming"""
+
+        self.ending = True
+        if not self.lines and self.on_done is not None:
+            self.on_done()
+
+    def run(self):
+        """Send the lines that are due"""
 
-                    # check for carriage-return line-feed pair
-                    # as it represents the end of the message
-                    # from the server
-                    if data.find('\r\n') > -1:
+        now = time.time()
+        self.credit += (now - self.last) * self.rate
+        self.last = now
 
-                        # CR-LF pair is there so show message
-                        print data
+        # a pause doesn't earn more than a tick's worth
+        if self.credit > max(1.0, self.rate * TICK):
+            self.credit = max(1.0, self.rate * TICK)
 
-            # user entered message
-            else:
+        while self.lines and self.credit >= 1:
+            self.credit -= 1
+            self.send(self.lines.popleft())
 
-                # read 510 bytes
-                msg = sys.stdin.readline(510)
+        if self.lines:
+            self.timer = self.loop.call_later(
+                max(TICK, (1 - self.credit) / self.rate), self.run)
+        else:
+            self.timer = None
+            if self.ending and self.on_done is not None:
+                self.on_done()
 
-                # add carriage-return line-feed pair
-                # to terminate message
-                msg += '\r\n'
 
-                # send it
-                s.send(msg)
+class LineReader(object):
+    """Reads lines from a file descriptor without blocking the loop
+
+    Whatever is there is read at once, so pasted or piped lines are
+    handed over together and sent together
+    """
+
+    def __init__(self, loop, stream, on_line, on_eof=None):
+        """
+        :param loop: EventLoop to watch the stream on
+        :param stream: file to read, like sys.stdin
+        :param on_line: on_line(line) for every line, as bytes
+        :param on_eof: on_eof() once there is nothing more to read
+        """
+
+        self.loop = loop
+        self.stream = stream
+        self.on_line = on_line
+        self.on_eof = on_eof
+        self.inbuf = b''
+
+        try:
+            loop.register(stream, READ, self.ready)
+        except (IOError, OSError, ValueError):
+            # regular files can't be watched, they're always readable
+            loop.call_soon(self.read_all)
+
+    def ready(self, stream, events):
+        data = os.read(stream.fileno(), RECV_BUFFER)
+        if not data:
+            self.loop.unregister(stream)
+        self.received(data)
+
+    def read_all(self):
+        self.received(os.read(self.stream.fileno(), RECV_BUFFER))
+        if self.stream is not None:
+            self.loop.call_soon(self.read_all)
+
+    def received(self, data):
+        """Function hands every complete line over
+
+        :param data: bytes read, empty at the end
+        """
+
+        if not data:
+            self.stream = None
+            if self.inbuf:
+                self.on_line(self.inbuf)
+            if self.on_eof is not None:
+                self.on_eof()
+            return
+
+        lines = (self.inbuf + data).split(b'\n')
+        self.inbuf = lines.pop()
+        for line in lines:
+            self.on_line(line.rstrip(b'\r'))
+
+
+def signal_handler(signal, frame):
+    """Function handles signal interrupt (CTRL-C)
+
+    :param signal: signal caught
+    :param frame: current stack frame
+    """
+
+    # a second one doesn't wait for the server
+    if sessions.quitting or not sessions.running:
+        sys.exit(0)
+
+    sessions.quit()
+
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='IRC chat client')
+    parser.add_argument('hostname', help='IP address of the server')
+    parser.add_argument('port', type=int,
+                        help='port the server is listening on')
+    parser.add_argument('username', nargs='+',
+                        help='desired username, a session for each one')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='this many sessions per username, numbered '
+                             'from 1 when more than one '
+                             '(default: %(default)s)')
+    parser.add_argument('--bot', action='store_true',
+                        help='run without a person: write what arrives as '
+                             'JSON lines and nothing else to stdout')
+    parser.add_argument('--script', default=None,
+                        help='send the lines of this file instead of '
+                             'what is typed or piped in')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='most lines sent per second, 0 for no limit '
+                             '(default: %(default)s)')
+    parser.add_argument('--stay', action='store_true',
+                        help='stay connected once the input ends')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='connect again when the server goes away, '
+                             'back in the same channels')
+    parser.add_argument('--reconnect-max', type=float,
+                        default=RECONNECT_MAX,
+                        help='longest wait between reconnects in seconds '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    usernames = args.username
+    if args.sessions > 1:
+        usernames = ['%s%d' % (username, i + 1)
+                     for username in usernames
+                     for i in range(args.sessions)]
+
+    # protect against user names
+    # longer than 9 chars
+    for username in usernames:
+        if len(username) > 9:
+            print('Username %s is too long. Max is 9 characters' % username)
+            sys.exit()
+
+    loop = EventLoop()
+
+    # with more than one session every line says whose it is
+    tagged = len(usernames) > 1
+
+    # bots get JSON, anything else goes to stderr
+    if args.bot:
+        output = JSONOutput(loop, tagged=tagged)
+        notices = sys.stderr
+    else:
+        output = Terminal(loop, tagged=tagged)
+        notices = sys.stdout
+
+    def notice(client, text):
+        if tagged:
+            text = '[%s] %s' % (client.username, text)
+        print(text, file=notices)
+
+    def connected(client):
+        notice(client, 'Connected to IRC server')
+
+    def closed(client, reason):
+        output.flush()
+        print('', file=notices)
+        notice(client, reason)
+        if client.retry is not None:
+            notice(client, 'Reconnecting in %.1f seconds'
+                   % (client.retry.when - time.time()))
+
+    def backoff():
+        return Backoff(min(RECONNECT_FIRST, args.reconnect_max),
+                       args.reconnect_max)
+
+    sessions = Sessions(args.hostname, args.port, usernames, output.show,
+                        connected, closed, loop,
+                        backoff if args.reconnect else None)
+
+    # log off when the user hits CTRL-C or the input ends
+    signal.signal(signal.SIGINT, signal_handler)
+    pacer = Pacer(loop, sessions.send, args.rate,
+                  None if args.stay else sessions.quit)
+
+    if args.script is not None:
+        LineReader(loop, open(args.script, 'rb'), pacer.add, pacer.end)
+    else:
+        LineReader(loop, sys.stdin, pacer.add, pacer.end)
+
+    sessions.connect()
+    sessions.run()
+
+    # a bot that lost the server (rather than quit), or that gave up
+    # with lines it couldn't deliver, should say so
+    undelivered = [c for c in sessions.clients if c.pending()]
+    sys.exit(0 if sessions.quitting and not undelivered else 1)
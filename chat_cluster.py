@@ -0,0 +1,437 @@
+"""
+ Multi-process mode for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ In multi-process mode N worker processes each run the normal server
+ on their own SO_REUSEPORT listening socket and the kernel spreads new
+ connections across them. The parent process runs the hub, which the
+ workers talk to over a Unix socket pair (the bus). The hub knows which
+ worker owns each username and which workers have members in each
+ channel, and routes these records between workers:
+
+   worker -> hub                    hub -> worker
+   CLAIM <nick> <token>             CLAIMED <token> <1 or 0>
+   RELEASE <nick>                   CHAN <channel> <frame>
+   SUB <channel>                    PRIV <nick> <frame>
+   UNSUB <channel>                  NOUSER <sender nick> <nick>
+   CHAN <channel> <frame>
+   PRIV <nick> <sender nick> <frame>
+"""
+import os       # for fork
+import select   # for select.error
+import socket   # for socket objects
+import struct   # for record headers
+import signal   # for signal interrupts
+import errno    # for socket error codes
+import logging  # for logging
+
+from collections import deque  # for write buffers
+
+from chat_events import EventLoop, READ, WRITE
+
+# records and the fields in them start with their length
+HEADER = struct.Struct('!I')
+
+# linux value, older pythons don't have the constant
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def text(field):
+    """Function turns a field received from the bus back into a string
+
+    :param field: bytes
+    :return: string
+    """
+
+    if isinstance(field, str):
+        return field
+    return field.decode('utf-8')
+
+
+def pack_record(fields):
+    """Function turns a list of fields into a bus record
+
+    :param fields: list of strings or bytes
+    :return: record as bytes
+    """
+
+    parts = []
+    for field in fields:
+        if not isinstance(field, bytes):
+            field = field.encode('utf-8')
+        parts.append(HEADER.pack(len(field)))
+        parts.append(field)
+
+    payload = b''.join(parts)
+    return HEADER.pack(len(payload)) + payload
+
+
+def unpack_record(payload):
+    """Function splits a record's payload back into fields
+
+    :param payload: record without its own length header
+    :return: list of bytes
+    """
+
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        size, = HEADER.unpack_from(payload, offset)
+        offset += HEADER.size
+        fields.append(bytes(payload[offset:offset + size]))
+        offset += size
+
+    return fields
+
+
+class BusConnection(object):
+    """One end of the bus between a worker and the hub
+
+    Records are buffered both ways so neither side ever blocks.
+    on_record(conn, fields) is called for every record received
+    and on_close(conn) once the other end goes away
+    """
+
+    def __init__(self, sock, loop, on_record, on_close):
+        """
+        :param sock: connected Unix socket
+        :param loop: event loop to register with
+        :param on_record: function called for each record
+        :param on_close: function called when the bus closes
+        """
+
+        self.sock = sock
+        self.loop = loop
+        self.on_record = on_record
+        self.on_close = on_close
+
+        self.inbuf = bytearray()
+        self.outbuf = deque()
+        self.events = READ
+        self.closed = False
+
+        sock.setblocking(0)
+        loop.register(sock, READ, self.ready)
+
+    def send(self, *fields):
+        """Queue a record for the other end
+
+        :param fields: strings or bytes making up the record
+        """
+
+        if self.closed:
+            return
+
+        self.outbuf.append(pack_record(fields))
+
+        # nothing was waiting so try to send right away
+        if len(self.outbuf) == 1:
+            self.flush()
+
+    def flush(self):
+        """Write as much of the buffer as the socket takes"""
+
+        queue = self.outbuf
+
+        while queue:
+            try:
+                sent = self.sock.send(queue[0])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    break
+                self.loop.call_soon(self.close)
+                return
+
+            if sent < len(queue[0]):
+                queue[0] = queue[0][sent:]
+                break
+            queue.popleft()
+
+        # only ask for writable events while there is something to write
+        events = READ | WRITE if queue else READ
+        if events != self.events:
+            self.events = events
+            self.loop.modify(self.sock, events)
+
+    def ready(self, sock, events):
+        """Event loop handler for the bus socket
+
+        :param sock: bus socket
+        :param events: mask of ready events
+        """
+
+        if events & WRITE:
+            self.flush()
+
+        if events & READ and not self.closed:
+            self.read()
+
+    def read(self):
+        """Read records from the other end"""
+
+        try:
+            data = self.sock.recv(262144)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+
+        # other end went away
+        if not data:
+            self.close()
+            return
+
+        buf = self.inbuf
+        buf.extend(data)
+
+        # hand over every complete record
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            size, = HEADER.unpack_from(buf, offset)
+            end = offset + HEADER.size + size
+            if end > len(buf):
+                break
+
+            self.on_record(self, unpack_record(buf[offset + HEADER.size:end]))
+            offset = end
+
+            # the callback may have closed us
+            if self.closed:
+                return
+
+        del buf[:offset]
+
+    def close(self):
+        """Close the bus and tell the owner about it"""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.loop.unregister(self.sock)
+        self.sock.close()
+        self.on_close(self)
+
+
+class Hub(object):
+    """Routes records between workers
+
+    Keeps track of which worker owns each username and
+    which workers have members watching each channel
+    """
+
+    def __init__(self, loop):
+        """
+        :param loop: event loop to run the bus connections on
+        """
+
+        self.loop = loop
+
+        # every worker's bus connection
+        self.workers = []
+
+        # username key -> bus connection of the worker that has it
+        self.nicks = {}
+
+        # channel -> set of bus connections of workers watching it
+        self.channels = {}
+
+    def add_worker(self, sock):
+        """Start routing records for a worker
+
+        :param sock: hub end of the worker's socket pair
+        """
+
+        conn = BusConnection(sock, self.loop, self.on_record, self.on_close)
+        self.workers.append(conn)
+
+    def on_record(self, conn, fields):
+        """Route one record from a worker
+
+        :param conn: bus connection the record came in on
+        :param fields: list of fields, the first is the record type
+        """
+
+        kind = fields[0]
+
+        # a worker wants a username
+        if kind == b'CLAIM':
+            key, token = fields[1:]
+
+            if key in self.nicks:
+                conn.send(b'CLAIMED', token, b'0')
+            else:
+                self.nicks[key] = conn
+                conn.send(b'CLAIMED', token, b'1')
+
+        # a worker is done with a username
+        elif kind == b'RELEASE':
+            key = fields[1]
+            if self.nicks.get(key) is conn:
+                del self.nicks[key]
+
+        # a worker has its first member watching a channel
+        elif kind == b'SUB':
+            self.channels.setdefault(fields[1], set()).add(conn)
+
+        # a worker has no more members watching a channel
+        elif kind == b'UNSUB':
+            watchers = self.channels.get(fields[1])
+            if watchers is not None:
+                watchers.discard(conn)
+                if not watchers:
+                    del self.channels[fields[1]]
+
+        # channel message, pass it on to the other workers watching
+        elif kind == b'CHAN':
+            channel, frame = fields[1:]
+            for worker in self.channels.get(channel, ()):
+                if worker is not conn:
+                    worker.send(b'CHAN', channel, frame)
+
+        # private message, pass it on to the worker with the username
+        elif kind == b'PRIV':
+            key, sender, frame = fields[1:]
+            owner = self.nicks.get(key)
+
+            if owner is None:
+                conn.send(b'NOUSER', sender, key)
+            else:
+                owner.send(b'PRIV', key, frame)
+
+        else:
+            logging.error('Unknown bus record %r', kind)
+
+    def on_close(self, conn):
+        """Forget everything a worker had once its bus closes
+
+        :param conn: bus connection that closed
+        """
+
+        self.workers.remove(conn)
+
+        for key in [k for k, owner in self.nicks.items() if owner is conn]:
+            del self.nicks[key]
+
+        for channel in list(self.channels):
+            watchers = self.channels[channel]
+            watchers.discard(conn)
+            if not watchers:
+                del self.channels[channel]
+
+
+def open_listener(port, backlog, reuseport=False):
+    """Function creates the non-blocking listening socket
+
+    :param port: port to listen on
+    :param backlog: connections the kernel queues for us
+    :param reuseport: let other processes listen on the same port
+    :return: listening socket
+    """
+
+    # create TCP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    # set socket options
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+    # bind socket
+    sock.bind(("0.0.0.0", port))
+
+    # start listening, accept() must never block the event loop
+    sock.listen(backlog)
+    sock.setblocking(0)
+
+    return sock
+
+
+def run_workers(count, worker_main, backend=None):
+    """Function forks worker processes and runs the hub until they exit
+
+    Each worker calls worker_main(number, bus_socket) and should
+    open its listening socket with open_listener(..., reuseport=True)
+
+    :param count: number of worker processes
+    :param worker_main: function that runs a worker
+    :param backend: event loop backend for the hub
+    """
+
+    loop = EventLoop(backend)
+    hub = Hub(loop)
+    pids = []
+
+    for number in range(count):
+        hub_end, worker_end = socket.socketpair()
+
+        pid = os.fork()
+
+        if pid == 0:
+            # the child doesn't need any of the hub's sockets
+            hub_end.close()
+            for conn in hub.workers:
+                conn.sock.close()
+            loop.close()
+
+            # never return into the parent's code
+            status = 0
+            try:
+                worker_main(number, worker_end)
+            except SystemExit as e:
+                status = e.code or 0
+            except Exception:
+                logging.exception('Worker %d crashed', number)
+                status = 1
+
+            # os._exit skips atexit, write out what is still queued
+            logging.shutdown()
+            os._exit(status)
+
+        worker_end.close()
+        hub.add_worker(hub_end)
+        pids.append(pid)
+
+    def stop_workers(signum, frame):
+        # pass it on, the hub stops once every worker has gone
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    logging.info('Hub started with %d workers', count)
+
+    # a signal interrupts the wait on python 2, just go around again
+    while hub.workers:
+        try:
+            loop.run_once()
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    loop.close()
+    logging.info('Hub shutting down')
@@ -0,0 +1,548 @@
+"""
+ Event loop used by the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+import select   # for epoll, poll and select functions
+import heapq    # for the timer queue
+import time     # for timers
+import errno    # for interrupted system calls
+import math     # for rounding timeouts
+
+from collections import deque  # for queued callbacks
+
+try:
+    import selectors  # python 3.4+ only
+except ImportError:
+    selectors = None
+
+# event masks handed to handlers
+# (these match the values used by the selectors module)
+READ = 1
+WRITE = 2
+
+
+class SelectorsBackend(object):
+    """Backend built on the selectors module (python 3.4+)
+
+    selectors picks epoll/kqueue/devpoll for us when they are available
+    """
+
+    name = 'selectors'
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fd, events):
+        self.selector.register(fd, events)
+
+    def modify(self, fd, events):
+        self.selector.modify(fd, events)
+
+    def unregister(self, fd):
+        self.selector.unregister(fd)
+
+    def poll(self, timeout):
+        return [(key.fd, mask) for key, mask in self.selector.select(timeout)]
+
+    def close(self):
+        self.selector.close()
+
+
+class EpollBackend(object):
+    """Backend built on select.epoll (linux only)
+
+    Only ready sockets are returned on each wakeup so the cost
+    of a wakeup doesn't depend on how many idle sockets we have
+    """
+
+    name = 'epoll'
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+
+        # python 2 rounds down to milliseconds, which has
+        # us spin for the last one before every timer
+        elif timeout > 0:
+            timeout = math.ceil(timeout * 1000) / 1000.0
+
+        ready = []
+        for fd, mask in self.epoll.poll(timeout):
+            events = 0
+
+            # errors and hang ups are reported as readable and writable
+            # so the handler finds out about them on its next recv/send
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        self.epoll.close()
+
+
+class PollBackend(object):
+    """Backend built on select.poll
+
+    No FD_SETSIZE limit but still O(n) in the kernel per wakeup
+    """
+
+    name = 'poll'
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.poller.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        # poll wants milliseconds, rounded up so we don't
+        # wake up just before a timer is due
+        if timeout is not None:
+            timeout = math.ceil(timeout * 1000)
+
+        ready = []
+        for fd, mask in self.poller.poll(timeout):
+            events = 0
+            if mask & (select.POLLIN | select.POLLERR |
+                       select.POLLHUP | select.POLLNVAL):
+                events |= READ
+            if mask & (select.POLLOUT | select.POLLERR | select.POLLHUP):
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        pass
+
+
+class SelectBackend(object):
+    """Backend built on select.select
+
+    This is what the server originally used, it is kept around as
+    a fallback for platforms that have nothing better.
+    It can not handle file descriptors above FD_SETSIZE (usually 1024)
+    """
+
+    name = 'select'
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        if events & READ:
+            self.readers.add(fd)
+        else:
+            self.readers.discard(fd)
+
+        if events & WRITE:
+            self.writers.add(fd)
+        else:
+            self.writers.discard(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        readable, writable, errors = select.select(
+            self.readers, self.writers, [], timeout)
+
+        ready = {}
+        for fd in readable:
+            ready[fd] = READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return list(ready.items())
+
+    def close(self):
+        pass
+
+
+# backend name -> backend class
+BACKENDS = {
+    'selectors': SelectorsBackend,
+    'epoll': EpollBackend,
+    'poll': PollBackend,
+    'select': SelectBackend,
+}
+
+
+def available_backends():
+    """Function lists the backends that work on this platform
+
+    :return: list of backend names, best first
+    """
+
+    names = []
+
+    if selectors is not None:
+        names.append('selectors')
+    if hasattr(select, 'epoll'):
+        names.append('epoll')
+    if hasattr(select, 'poll'):
+        names.append('poll')
+    names.append('select')
+
+    return names
+
+
+def make_backend(name=None):
+    """Function creates an event backend
+
+    :param name: backend name, the best available one is used when None
+    :return: backend object
+    """
+
+    if name is None:
+        name = available_backends()[0]
+
+    if name not in available_backends():
+        raise ValueError('Event backend %s is not available' % name)
+
+    return BACKENDS[name]()
+
+
+class Timer(object):
+    """Handle for a function scheduled with EventLoop.call_later"""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        """Stop the function from being called
+
+        The timer stays in the queue until it is due
+        and is skipped then, which keeps cancel() cheap
+        """
+
+        self.cancelled = True
+        self.args = ()
+
+
+class TimerWheel(object):
+    """Hashed timer wheel for lots of timers that needn't be precise
+
+    Meant for per-connection timeouts: tens of thousands of them, nearly
+    all cancelled or put off before they are due. Timers go in one of
+    size slots by the tick they are due in, so adding and cancelling
+    are O(1) however many there are. Every tick seconds the wheel visits
+    one slot, runs the timers that are due and leaves the ones due on a
+    later turn. It runs off a single call_later of the loop, and only
+    while it has timers, so it costs nothing per tick but that slot.
+    Timers run up to one tick late
+    """
+
+    def __init__(self, loop, tick=1.0, size=512):
+        """
+        :param loop: EventLoop (or anything with call_later)
+        :param tick: seconds per slot
+        :param size: number of slots
+        """
+
+        self.loop = loop
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for i in range(size)]
+
+        # timers in the slots, cancelled ones included
+        self.count = 0
+
+        # next tick to visit and the loop timer that will, None when idle
+        self.next = 0
+        self.ticking = None
+
+    def call_later(self, delay, callback, *args):
+        """Call a function after about a number of seconds
+
+        :param delay: seconds to wait
+        :param callback: function to call
+        :param args: arguments for the function
+        :return: Timer object that can be cancelled
+        """
+
+        now = time.time()
+        timer = Timer(now + delay, callback, args)
+
+        if self.ticking is None:
+            self.next = int(now / self.tick) + 1
+            self.ticking = self.loop.call_later(
+                self.next * self.tick - now, self.advance)
+
+        # first tick after the timer is due, but never
+        # one that has been visited already
+        due = int(timer.when / self.tick) + 1
+        if due < self.next:
+            due = self.next
+
+        self.slots[due % self.size].append(timer)
+        self.count += 1
+        return timer
+
+    def advance(self):
+        """Visit the slots for every tick that has gone by"""
+
+        now = time.time()
+
+        # the loop runs this when tick next is due, but
+        # rounding can have it do so a hair early
+        last = int(now / self.tick)
+        if last < self.next:
+            last = self.next
+
+        while self.next <= last and self.count:
+            index = self.next % self.size
+            slot = self.slots[index]
+            self.slots[index] = later = []
+
+            # timers added by the callbacks go after this tick
+            self.next += 1
+            limit = self.next * self.tick
+
+            for timer in slot:
+                if timer.cancelled:
+                    self.count -= 1
+                elif timer.when < limit:
+                    self.count -= 1
+                    timer.callback(*timer.args)
+                else:
+                    later.append(timer)
+
+        if self.count:
+            self.ticking = self.loop.call_later(
+                self.next * self.tick - now, self.advance)
+        else:
+            self.ticking = None
+
+
+class EventLoop(object):
+    """Event loop with a per-socket handler registry
+
+    Each registered socket has a handler which is called
+    as handler(sock, events) whenever the socket is ready.
+    events is a mask of READ and WRITE
+    """
+
+    def __init__(self, backend=None):
+        """
+        :param backend: backend name or None for the best one available
+        """
+
+        self.backend = make_backend(backend)
+
+        # file descriptor -> (socket object, handler function)
+        self.handlers = {}
+
+        # (function, args) to call once the current wakeup is done
+        self.callbacks = deque()
+
+        # heap of Timer objects ordered by when they are due
+        self.timers = []
+
+        self.running = False
+
+    def register(self, sock, events, handler):
+        """Start watching a socket
+
+        :param sock: socket object
+        :param events: mask of READ and WRITE
+        :param handler: function called as handler(sock, events)
+        """
+
+        fd = sock.fileno()
+        self.backend.register(fd, events)
+        self.handlers[fd] = (sock, handler)
+
+    def modify(self, sock, events, handler=None):
+        """Change the events (and optionally the handler) for a socket
+
+        :param sock: socket object
+        :param events: mask of READ and WRITE
+        :param handler: new handler, the old one is kept when None
+        """
+
+        fd = sock.fileno()
+        self.backend.modify(fd, events)
+
+        if handler is not None:
+            self.handlers[fd] = (sock, handler)
+
+    def unregister(self, sock):
+        """Stop watching a socket
+
+        Must be called before the socket is closed
+
+        :param sock: socket object
+        """
+
+        fd = sock.fileno()
+
+        if fd in self.handlers:
+            del self.handlers[fd]
+            self.backend.unregister(fd)
+
+    def call_soon(self, callback, *args):
+        """Call a function once the current wakeup is done
+
+        Handy for work that must not happen in the middle of
+        dispatching, like closing a socket other handlers may touch
+
+        :param callback: function to call
+        :param args: arguments for the function
+        """
+
+        self.callbacks.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """Call a function after a number of seconds
+
+        :param delay: seconds to wait
+        :param callback: function to call
+        :param args: arguments for the function
+        :return: Timer object that can be cancelled
+        """
+
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def run_timers(self):
+        """Call the functions whose timers are due"""
+
+        timers = self.timers
+        now = time.time()
+
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def run_once(self, timeout=None):
+        """Wait for events once and dispatch them
+
+        :param timeout: seconds to wait, None waits forever
+        :return: number of events dispatched
+        """
+
+        # don't sleep past the next timer
+        if self.timers:
+            due = max(0, self.timers[0].when - time.time())
+            if timeout is None or due < timeout:
+                timeout = due
+
+        # don't sleep while there are callbacks waiting
+        if self.callbacks:
+            timeout = 0
+
+        try:
+            ready = self.backend.poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            # python 2 doesn't retry after a signal handler ran
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+
+        for fd, events in ready:
+
+            # handler may have gone away while
+            # dispatching an earlier event
+            entry = self.handlers.get(fd)
+            if entry is None:
+                continue
+
+            sock, handler = entry
+            handler(sock, events)
+
+        self.run_timers()
+
+        # run the callbacks queued so far, ones queued
+        # while doing so wait for the next wakeup
+        for i in range(len(self.callbacks)):
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+        return len(ready)
+
+    def run(self):
+        """Dispatch events until stop() is called"""
+
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        """Make run() return after the current wakeup"""
+
+        self.running = False
+
+    def close(self):
+        """Release the backend"""
+
+        self.handlers.clear()
+        self.callbacks.clear()
+        del self.timers[:]
+        self.backend.close()
@@ -0,0 +1,701 @@
+"""
+ Load generator for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ Simulated clients connect to a server on this machine, send their
+ username, /join their channel and then chat, /msg, /who and /exit
+ the way a scenario says, all from one event loop. Every chat line
+ carries the time it was sent, so the clients measuring latency
+ (--observers) can tell how long each line took to arrive. The rest
+ only count what they get, which keeps thousands of them cheap.
+
+ The result is one JSON object with the connect rate, throughput,
+ delivery latency percentiles and the server's resident memory.
+ --output saves it and --baseline compares it with a saved one, so
+ a change to the server can be measured against the code before it.
+
+ Usage: python chat_loadgen.py <scenario> [options]
+ Run python chat_loadgen.py --help for the scenarios and options
+"""
+from __future__ import print_function
+
+import os        # for cpu times
+import sys       # for sys calls
+import json      # for the report
+import math      # for percentiles
+import time      # for timing
+import errno     # for socket error codes
+import random    # for picking clients
+import shlex     # for server options
+import socket    # for socket objects
+import argparse  # for command line options
+
+from chat_events import EventLoop, READ, WRITE
+from chat_bench import start_script, stop_server, server_rss, raise_fd_limit
+
+# scenario -> settings, each one can be changed on the command line
+#   channel_size  clients per channel, 0 for everyone in one channel
+#   privmsg       share of the lines sent as /msg to a random client
+#   who           share of the lines that are /who
+#   churn         share of the clients that /exit and come back
+#                 under a new username every second
+SCENARIOS = {
+    'big-channel': {'channel_size': 0, 'privmsg': 0, 'who': 0,
+                    'churn': 0},
+    'small-channels': {'channel_size': 10, 'privmsg': 0, 'who': 0,
+                       'churn': 0},
+    'privmsg': {'channel_size': 10, 'privmsg': 0.9, 'who': 0,
+                'churn': 0},
+    'churn': {'channel_size': 10, 'privmsg': 0, 'who': 0.01,
+              'churn': 0.05},
+    'mixed': {'channel_size': 50, 'privmsg': 0.2, 'who': 0.01,
+              'churn': 0.01},
+}
+
+# seconds between rounds of sending
+TICK = 0.01
+
+# bytes a client may have waiting to go out before it skips a line
+MAX_QUEUED = 64 * 1024
+
+# the server listens here, we never test anything but this machine
+HOST = '127.0.0.1'
+
+
+class SimClient(object):
+    """One simulated client
+
+    state goes from connecting to registering to joining to ready,
+    and to leaving once it sent /exit. tail is what came after the
+    last complete line, outbuf what the socket didn't take yet
+    """
+
+    __slots__ = ('gen', 'sock', 'name', 'channel', 'state', 'tail',
+                 'outbuf', 'observer', 'started', 'slot')
+
+    def __init__(self, gen, name, channel, observer):
+        """
+        :param gen: LoadGenerator the client belongs to
+        :param name: username
+        :param channel: channel to join
+        :param observer: measure the latency of what arrives
+        """
+
+        self.gen = gen
+        self.name = name
+        self.channel = channel
+        self.observer = observer
+        self.state = 'connecting'
+        self.tail = b''
+        self.outbuf = b''
+        self.slot = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.started = time.time()
+        self.sock.connect_ex((HOST, gen.port))
+        gen.loop.register(self.sock, WRITE, self.ready)
+
+    def send(self, data):
+        """Send data, what the socket won't take waits for it to drain
+
+        :param data: bytes
+        """
+
+        if self.outbuf:
+            self.outbuf += data
+            return
+
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            sent = 0
+
+        if sent < len(data):
+            self.outbuf = data[sent:]
+            self.gen.loop.modify(self.sock, READ | WRITE)
+
+    def ready(self, sock, events):
+        """Event loop handler for the client's socket
+
+        :param sock: socket object
+        :param events: mask of ready events
+        """
+
+        if self.state == 'connecting':
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.gen.failed(self)
+                return
+            self.state = 'registering'
+            self.gen.loop.modify(sock, READ)
+            self.send(self.name + b'\r\n')
+            return
+
+        if events & WRITE and self.outbuf:
+            try:
+                sent = sock.send(self.outbuf)
+            except socket.error:
+                sent = 0
+            self.outbuf = self.outbuf[sent:]
+            if not self.outbuf:
+                self.gen.loop.modify(sock, READ)
+
+        if events & READ:
+            try:
+                data = sock.recv(262144)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = b''
+
+            if not data:
+                self.gen.closed(self)
+                return
+
+            self.received(data)
+
+    def received(self, data):
+        """Function handles data from the server
+
+        :param data: bytes
+        """
+
+        # only complete lines are looked at
+        data = self.tail + data
+        end = data.rfind(b'\n') + 1
+        self.tail = data[end:]
+        data = data[:end]
+
+        gen = self.gen
+
+        if self.state == 'ready':
+            gen.delivered += data.count(b'\n<')
+            if self.observer:
+                gen.observe(data)
+
+        elif self.state == 'registering':
+            # welcome message ends by pointing at /help
+            if b'/help' in data:
+                self.state = 'joining'
+                gen.welcomed(self)
+                self.send(b'/join ' + self.channel + b'\r\n')
+
+        elif self.state == 'joining':
+            if b'\nJoined ' in data:
+                self.state = 'ready'
+                gen.joined(self)
+
+        # answer keepalives so quiet clients stay connected
+        if b'PING ' in data:
+            for line in data.split(b'\n'):
+                if line.startswith(b'PING '):
+                    self.send(b'/pong ' + line[5:].strip() + b'\r\n')
+
+    def close(self):
+        self.gen.loop.unregister(self.sock)
+        self.sock.close()
+
+
+class LoadGenerator(object):
+    """Runs a scenario against the server and gathers the numbers"""
+
+    def __init__(self, port, settings, options):
+        """
+        :param port: server port
+        :param settings: scenario settings, see SCENARIOS
+        :param options: parsed command line options
+        """
+
+        self.port = port
+        self.settings = settings
+        self.options = options
+        self.loop = EventLoop()
+
+        # clients that finished joining, in no particular order
+        self.ready_list = []
+
+        # channel -> clients in it that are ready
+        self.members = {}
+
+        # usernames handed out so far
+        self.names = 0
+
+        # initial clients started, and how long each took to be welcomed
+        self.started = 0
+        self.connect_times = []
+
+        # counters for the report
+        self.sent = 0
+        self.who = 0
+        self.privmsg = 0
+        self.skipped = 0
+        self.expected = 0
+        self.delivered = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.latencies = []
+        self.rss = []
+
+        # set while the load is running
+        self.sending = False
+        self.credit = 0.0
+        self.churn_credit = 0.0
+        self.last = 0
+        self.next_sender = 0
+
+    def new_client(self, channel, observer=False):
+        """Function starts a client with a new username
+
+        :param channel: channel the client joins
+        :param observer: measure the latency of what it gets
+        :return: SimClient
+        """
+
+        name = ('lg%d' % self.names).encode()
+        self.names += 1
+        return SimClient(self, name, channel, observer)
+
+    def channel_for(self, index):
+        """Function picks the channel for the index'th client
+
+        :param index: client number
+        :return: channel name (bytes)
+        """
+
+        size = self.settings['channel_size']
+        if not size:
+            return b'#lg'
+        return ('#lg%d' % (index // size)).encode()
+
+    def welcomed(self, client):
+        # clients coming back during the load count as reconnects
+        if self.sending:
+            return
+
+        self.connect_times.append(time.time() - client.started)
+
+        # keep --concurrency clients registering until all are started
+        if self.started < self.options.clients:
+            self.start_next()
+
+    def start_next(self):
+        """Function starts the next of the initial clients"""
+
+        index = self.started
+        self.started += 1
+        observer = index % max(1, self.options.clients //
+                               max(1, self.options.observers)) == 0
+        self.new_client(self.channel_for(index), observer)
+
+    def joined(self, client):
+        client.slot = len(self.ready_list)
+        self.ready_list.append(client)
+        self.members[client.channel] = \
+            self.members.get(client.channel, 0) + 1
+
+    def leave(self, client):
+        """Function takes a client out of the ready list
+
+        :param client: SimClient
+        """
+
+        if client.slot is None:
+            return
+
+        # move the last one into its place
+        last = self.ready_list.pop()
+        if last is not client:
+            self.ready_list[client.slot] = last
+            last.slot = client.slot
+        client.slot = None
+        self.members[client.channel] -= 1
+
+    def failed(self, client):
+        self.connect_failures += 1
+        client.close()
+        self.replace()
+
+    def replace(self):
+        """Function starts another of the initial clients in place of
+        one that never got as far as joining"""
+
+        if self.started < self.options.clients and not self.sending:
+            self.start_next()
+
+    def closed(self, client):
+        """Function handles the server closing a client's connection
+
+        :param client: SimClient
+        """
+
+        if client.state != 'leaving':
+            self.disconnects += 1
+            if client.slot is None:
+                self.replace()
+            self.leave(client)
+        client.close()
+
+    def observe(self, data):
+        """Function measures the latency of the chat lines in data
+
+        :param data: complete lines received by an observer
+        """
+
+        now = time.time()
+        for line in data.split(b'\n'):
+            start = line.find(b'> t')
+            if start < 0:
+                continue
+            end = line.find(b' ', start + 3)
+            try:
+                self.latencies.append(now - float(line[start + 3:end]))
+            except ValueError:
+                pass
+
+    def tick(self):
+        """Send this round's share of the lines and reconnections"""
+
+        if not self.sending:
+            return
+        self.loop.call_later(TICK, self.tick)
+
+        now = time.time()
+        elapsed = now - self.last
+        self.last = now
+
+        # never owe more than a second of lines, if we fell that far
+        # behind the load generator is what's slow
+        self.credit += self.options.rate * len(self.ready_list) * elapsed
+        limit = self.options.rate * len(self.ready_list)
+        if self.credit > limit:
+            self.skipped += int(self.credit - limit)
+            self.credit = limit
+
+        ready = self.ready_list
+        settings = self.settings
+        stamp = b'%.6f' % now
+        padding = b'x' * max(0, self.options.size - 40)
+
+        while self.credit >= 1 and ready:
+            self.credit -= 1
+            self.next_sender = (self.next_sender + 1) % len(ready)
+            client = ready[self.next_sender]
+
+            if len(client.outbuf) > MAX_QUEUED:
+                self.skipped += 1
+                continue
+
+            roll = random.random()
+            if roll < settings['who']:
+                client.send(b'/who\r\n')
+                self.who += 1
+
+            elif roll < settings['who'] + settings['privmsg']:
+                target = ready[random.randrange(len(ready))]
+                if target is client:
+                    continue
+                client.send(b'/msg ' + target.name + b' t' + stamp + b' ' +
+                            padding + b'\r\n')
+                self.privmsg += 1
+                self.expected += 1
+
+            else:
+                client.send(b't' + stamp + b' ' + padding + b'\r\n')
+                self.expected += self.members[client.channel] - 1
+
+            self.sent += 1
+
+        # some clients leave and come straight back as someone else
+        self.churn_credit += settings['churn'] * len(ready) * elapsed
+        while self.churn_credit >= 1 and ready:
+            self.churn_credit -= 1
+            client = ready[random.randrange(len(ready))]
+            self.leave(client)
+            client.state = 'leaving'
+            client.send(b'/exit\r\n')
+            self.new_client(client.channel, client.observer)
+            self.reconnects += 1
+
+    def sample_rss(self):
+        """Note the server's memory every second while the load runs"""
+
+        if not self.sending:
+            return
+        self.loop.call_later(1, self.sample_rss)
+        self.rss.append(read_rss(self.options.pid))
+
+    def run_until(self, done, timeout):
+        """Function runs the event loop until done() or the timeout
+
+        :param done: function that says when to stop
+        :param timeout: seconds
+        :return: seconds taken
+        """
+
+        start = time.time()
+        while not done() and time.time() - start < timeout:
+            self.loop.run_once(0.1)
+        return time.time() - start
+
+    def run(self):
+        """Function runs the scenario
+
+        :return: report dictionary
+        """
+
+        options = self.options
+        cpu = sum(os.times()[:2])
+        rss_start = read_rss(options.pid)
+
+        # clients that never made it
+        def gone():
+            return self.connect_failures + self.disconnects
+
+        # everyone connects, registers and joins, --concurrency at a time
+        for i in range(min(options.concurrency, options.clients)):
+            self.start_next()
+
+        connect_time = self.run_until(
+            lambda: len(self.connect_times) + gone() >= options.clients,
+            options.connect_timeout)
+        self.run_until(lambda: len(self.ready_list) + gone() >=
+                       options.clients, options.connect_timeout)
+        rss_connected = read_rss(options.pid)
+
+        # the load itself
+        self.sending = True
+        self.last = time.time()
+        self.tick()
+        self.sample_rss()
+        load_time = self.run_until(lambda: False, options.duration)
+        self.sending = False
+
+        # give what is still on its way a chance to arrive
+        self.run_until(lambda: self.delivered >= self.expected,
+                       options.drain)
+        rss_end = read_rss(options.pid)
+
+        for client in self.ready_list[:]:
+            self.leave(client)
+            client.state = 'leaving'
+            client.send(b'/exit\r\n')
+        self.run_until(lambda: not self.loop.handlers, 2)
+        self.loop.close()
+
+        self.latencies.sort()
+        latency = {'samples': len(self.latencies)}
+        for name, share in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+            latency[name] = round(percentile(self.latencies, share) * 1e3, 3)
+        latency['max'] = round(percentile(self.latencies, 1) * 1e3, 3)
+
+        self.connect_times.sort()
+        welcomed = len(self.connect_times)
+        rss = [value for value in self.rss + [rss_end] if value is not None]
+
+        return {
+            'scenario': options.scenario,
+            'settings': dict(self.settings, clients=options.clients,
+                             rate=options.rate, size=options.size,
+                             duration=options.duration),
+            'connect': {
+                'clients': welcomed,
+                'failed': self.connect_failures,
+                'seconds': round(connect_time, 3),
+                'per_second': round(welcomed / connect_time, 1)
+                if connect_time else 0,
+                'p50_ms': round(percentile(self.connect_times, 0.5) * 1e3, 3),
+                'p99_ms': round(percentile(self.connect_times, 0.99) * 1e3,
+                                3),
+            },
+            'load': {
+                'seconds': round(load_time, 3),
+                'sent': self.sent,
+                'privmsg': self.privmsg,
+                'who': self.who,
+                'skipped': self.skipped,
+                'expected': self.expected,
+                'delivered': self.delivered,
+                'sent_per_second': round(self.sent / load_time, 1),
+                'delivered_per_second': round(self.delivered / load_time, 1),
+                'reconnects': self.reconnects,
+                'disconnects': self.disconnects,
+            },
+            'latency_ms': latency,
+            'server_rss': {
+                'start': rss_start,
+                'connected': rss_connected,
+                'peak': max(rss) if rss else None,
+                'end': rss_end,
+            },
+            'loadgen_cpu_seconds': round(sum(os.times()[:2]) - cpu, 3),
+        }
+
+
+def percentile(values, share):
+    """Function picks a percentile from sorted values (nearest rank)
+
+    :param values: sorted list
+    :param share: 0.5 for the median and so on
+    :return: the value, 0 if there are none
+    """
+
+    if not values:
+        return 0
+    rank = int(math.ceil(share * len(values))) - 1
+    return values[min(len(values) - 1, max(0, rank))]
+
+
+def read_rss(pid):
+    """Function reads the server's resident memory
+
+    :param pid: server process id, None if we don't know it
+    :return: bytes, None if it can't be read
+    """
+
+    if pid is None:
+        return None
+    try:
+        return server_rss(pid)
+    except (IOError, OSError):
+        return None
+
+
+def flatten(report, prefix=''):
+    """Function lists the numbers in a report
+
+    :param report: report dictionary
+    :param prefix: keys of the dictionaries it is in
+    :return: dictionary of dotted key -> number
+    """
+
+    numbers = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            numbers.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            numbers[prefix + key] = value
+    return numbers
+
+
+def compare(report, baseline):
+    """Function works out how much each number changed from a baseline
+
+    :param report: report dictionary
+    :param baseline: earlier report dictionary
+    :return: dotted key -> change as a share of the baseline
+    """
+
+    old = flatten(baseline)
+    changes = {}
+    for key, value in flatten(report).items():
+        if key.startswith('settings.') or not old.get(key):
+            continue
+        changes[key] = round(float(value - old[key]) / old[key], 4)
+    return changes
+
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='IRC chat load generator')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--port', type=int, default=6667,
+                        help='port of a server on this machine '
+                             '(default: %(default)s)')
+    parser.add_argument('--pid', type=int, default=None,
+                        help="that server's process id, for its memory")
+    parser.add_argument('--spawn', metavar='SCRIPT', default=None,
+                        help='start this server (chat_server.py or '
+                             'chat_aio.py) instead')
+    parser.add_argument('--server-options', default='',
+                        help="options for the started server, like "
+                             "'--flood-lines 20'")
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='simulated clients (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='clients registering at once '
+                             '(default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='lines per second per client '
+                             '(default: %(default)s)')
+    parser.add_argument('--size', type=int, default=80,
+                        help='bytes per chat line (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load (default: %(default)s)')
+    parser.add_argument('--observers', type=int, default=50,
+                        help='clients that measure latency '
+                             '(default: %(default)s)')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='seconds to wait for lines still on their '
+                             'way (default: %(default)s)')
+    parser.add_argument('--connect-timeout', type=float, default=60,
+                        help='seconds for everyone to connect and join '
+                             '(default: %(default)s)')
+    for setting in ('channel_size', 'privmsg', 'who', 'churn'):
+        parser.add_argument('--' + setting.replace('_', '-'),
+                            type=int if setting == 'channel_size' else float,
+                            default=None,
+                            help="override the scenario's %s" % setting)
+    parser.add_argument('--output', default=None,
+                        help='also write the report to this file')
+    parser.add_argument('--baseline', default=None,
+                        help='report to compare with')
+    args = parser.parse_args()
+
+    settings = dict(SCENARIOS[args.scenario])
+    for setting in settings:
+        if getattr(args, setting) is not None:
+            settings[setting] = getattr(args, setting)
+
+    # every client and the server's clients need a file descriptor
+    limit = raise_fd_limit()
+    if args.clients + 100 > limit:
+        parser.error('open file limit %d is too low for %d clients'
+                     % (limit, args.clients))
+
+    server = None
+    if args.spawn is not None:
+        server = start_script(args.spawn, args.port,
+                              *shlex.split(args.server_options))
+        args.pid = server.pid
+
+    try:
+        report = LoadGenerator(args.port, settings, args).run()
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report['change'] = compare(report, json.load(f))
+
+    output = json.dumps(report, sort_keys=True, indent=2)
+    print(output)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    sys.exit(0 if report['connect']['clients'] else 1)
@@ -0,0 +1,293 @@
+"""
+ Logging for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ The event loop only puts log records on a queue. A background thread
+ formats them and writes them out, so a slow terminal or disk never
+ holds up the server. Messages are passed as a format string and
+ arguments (logging.info('%s is offline', user)) so records that are
+ filtered out or dropped are never formatted at all. Since formatting
+ happens later on another thread the arguments must be values that
+ don't change, like strings and numbers, never lists or dictionaries
+"""
+import os         # for the process id
+import sys        # for stderr
+import json       # for JSON output
+import logging    # for logging
+import threading  # for the writer thread
+
+from collections import deque  # for the record queue
+
+# records waiting for the writer before new ones are dropped
+QUEUE_SIZE = 10000
+
+# seconds between the writer's batches
+WRITE_INTERVAL = 0.1
+
+# attributes every record has, anything else came from extra={...}
+RECORD_ATTRIBUTES = set(logging.LogRecord(
+    '', 0, '', 0, '', (), None).__dict__) | set(['message', 'asctime'])
+
+
+class QueueHandler(logging.Handler):
+    """Handler that hands records to a background writer thread
+
+    Records are appended to a deque, which needs no locking, and the
+    writer wakes up every WRITE_INTERVAL seconds to format whatever
+    is there and write it with one write() and one flush(). The queue
+    is bounded and never blocks, if the writer can't keep up records
+    are dropped and counted. The thread is started on the first record
+    so a process forked after setup gets its own
+    """
+
+    def __init__(self, target, size=QUEUE_SIZE):
+        """
+        :param target: StreamHandler that formats and writes the records
+        :param size: records the queue holds
+        """
+
+        logging.Handler.__init__(self)
+
+        self.target = target
+        self.size = size
+        self.records = deque()
+
+        # records dropped because the queue was full
+        self.dropped = 0
+
+        # writer thread, the process it belongs to and
+        # the event that stops it
+        self.thread = None
+        self.pid = None
+        self.stopping = None
+
+    def start(self):
+        """Start the writer thread for this process"""
+
+        # after a fork the parent's thread is gone and the
+        # target's lock may have been held, start over
+        if self.pid is not None:
+            self.target.createLock()
+            self.records.clear()
+
+        self.pid = os.getpid()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='log writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+
+        # the writer formats later, by then the arguments may have
+        # changed so exceptions are turned into text now
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        if len(self.records) >= self.size:
+            self.dropped += 1
+        else:
+            self.records.append(record)
+
+    def run(self):
+        """Writer thread, writes a batch every WRITE_INTERVAL seconds"""
+
+        while not self.stopping.is_set():
+            self.stopping.wait(WRITE_INTERVAL)
+            self.write()
+
+    def write(self):
+        """Format and write every queued record"""
+
+        records = self.records
+        lines = []
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.appendleft(logging.makeLogRecord({
+                'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': '%d log records dropped, the log writer fell behind',
+                'args': (dropped,)}))
+
+        while records:
+            record = records.popleft()
+            try:
+                lines.append(self.target.format(record))
+            except Exception:
+                self.target.handleError(record)
+
+        if not lines:
+            return
+
+        self.target.acquire()
+        try:
+            self.target.stream.write('\n'.join(lines) + '\n')
+            self.target.flush()
+        except Exception:
+            pass
+        finally:
+            self.target.release()
+
+    def close(self):
+        """Write everything queued and stop the writer"""
+
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.stopping.set()
+            self.thread.join(5)
+
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class RateLimit(logging.Filter):
+    """Filter that limits how often the same message is logged
+
+    Records are grouped by their format string, so every 'Client %s
+    connected' counts against the same limit no matter who connected.
+    Each group gets a token bucket of burst records refilled at rate
+    per second. Warnings and errors always get through. When a group
+    gets through again the number of records held back is added
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: records per second per message
+        :param burst: records that can go through at once (rate)
+        """
+
+        logging.Filter.__init__(self)
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+        # format string -> [tokens, last refill, records held back]
+        self.buckets = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = record.created
+        bucket = self.buckets.get(record.msg)
+        if bucket is None:
+            bucket = [self.burst, now, 0]
+            self.buckets[record.msg] = bucket
+
+        # refill for the time since the last record
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+
+        bucket[0] -= 1
+
+        # say how many like it were held back
+        if bucket[2]:
+            record.msg = '%s (%d more not logged)' % (record.msg, bucket[2])
+            bucket[2] = 0
+
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line
+
+    Every record has ts, level and msg, plus process when asked for.
+    Fields passed with extra={...} are added as they are
+    """
+
+    def __init__(self, process=False):
+        """
+        :param process: add the process id
+        """
+
+        logging.Formatter.__init__(self)
+        self.process = process
+
+    def format(self, record):
+        fields = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+
+        if self.process:
+            fields['process'] = record.process
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields['exc'] = record.exc_text
+
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                fields[key] = value
+
+        return json.dumps(fields, sort_keys=True, default=str)
+
+
+def setup_logging(json_output=False, process=False, rate=0, threaded=True,
+                  stream=None):
+    """Function sets up the root logger for the server
+
+    :param json_output: write JSON lines instead of text
+    :param process: add the process id, for several workers
+    :param rate: most records per second per message, 0 for no limit
+    :param threaded: write from a background thread
+    :param stream: where to write to (stderr)
+    """
+
+    if json_output:
+        formatter = JSONFormatter(process)
+    else:
+        if process:
+            log_format = '[%(asctime)s] %(process)d %(levelname)s: ' \
+                         '%(message)s'
+        else:
+            log_format = '[%(asctime)s] %(levelname)s: %(message)s'
+        formatter = logging.Formatter(log_format,
+                                      datefmt='%d/%m/%Y %I:%M:%S %p')
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(formatter)
+
+    if threaded:
+        handler = QueueHandler(handler)
+
+    # limit before the queue so held back records cost nothing more
+    if rate:
+        handler.addFilter(RateLimit(rate))
+
+    # records don't need to know where they came from, looking
+    # that up is most of the cost of a logging call
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    logging.logProcesses = process
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
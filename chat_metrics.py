@@ -0,0 +1,473 @@
+"""
+ Metrics for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ Metrics are kept in plain counters and bucket lists and only turned
+ into text (Prometheus text format 0.0.4) when someone asks for them,
+ so recording one costs a dictionary lookup and an addition
+"""
+import socket   # for socket objects
+import errno    # for socket error codes
+import time     # for timing
+import bisect   # for finding histogram buckets
+
+from chat_events import READ, WRITE
+
+# seconds, for command handler latency
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+# recipients of one broadcast
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+# seconds, for event loop lag
+LAG_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def format_value(value):
+    """Function formats a number the way Prometheus wants it
+
+    :param value: int or float
+    :return: string
+    """
+
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(label, value, extra=''):
+    """Function formats the {label="value"} part of a sample
+
+    :param label: label name or None
+    :param value: label value
+    :param extra: more label text, like le="0.5"
+    :return: string
+    """
+
+    labels = []
+    if label is not None:
+        labels.append('%s="%s"' % (label, value))
+    if extra:
+        labels.append(extra)
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(labels)
+
+
+class Counter(object):
+    """Number that only goes up, optionally one per label value
+
+    Counts are either kept here with inc() or, for counters on the
+    hot path, kept by the caller and read from function when
+    metrics are collected
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None, function=None):
+        """
+        :param name: metric name
+        :param help: description shown with the metric
+        :param label: label name, None for a single series
+        :param function: function returning {label value: count}
+        """
+
+        self.name = name
+        self.help = help
+        self.label = label
+        self.function = function
+
+        # label value -> count
+        self.values = {}
+
+    def inc(self, amount=1, value=''):
+        """Add to the counter
+
+        :param amount: how much to add
+        :param value: label value
+        """
+
+        values = self.values
+        values[value] = values.get(value, 0) + amount
+
+    def samples(self):
+        """Function lists the lines for this metric
+
+        :return: list of sample lines
+        """
+
+        if self.function is not None:
+            values = self.function()
+        else:
+            values = self.values
+
+        # a counter nobody touched yet still shows up as 0
+        if not values and self.label is None:
+            return ['%s 0' % self.name]
+
+        return ['%s%s %s' % (self.name, format_labels(self.label, value),
+                             format_value(count))
+                for value, count in sorted(values.items())]
+
+
+class Gauge(object):
+    """Number that is read from a function when metrics are collected"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        """
+        :param name: metric name
+        :param help: description shown with the metric
+        :param function: function returning the current value
+        """
+
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        return ['%s %s' % (self.name, format_value(self.function()))]
+
+
+class Histogram(object):
+    """Distribution of observed values, optionally one per label value"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, label=None):
+        """
+        :param name: metric name
+        :param help: description shown with the metric
+        :param buckets: sorted upper bounds of the buckets
+        :param label: label name, None for a single series
+        """
+
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+
+        # label value -> [count per bucket (+Inf last), sum, count]
+        self.series = {}
+
+    def get_series(self, value=''):
+        """Function finds the series for a label value
+
+        Callers on the hot path look their series up once
+        and update it directly like observe() does
+
+        :param value: label value
+        :return: [count per bucket (+Inf last), sum, count]
+        """
+
+        series = self.series.get(value)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0, 0]
+            self.series[value] = series
+        return series
+
+    def observe(self, amount, value=''):
+        """Record one value
+
+        :param amount: value observed
+        :param value: label value
+        """
+
+        series = self.get_series(value)
+
+        # counts are per bucket here and made cumulative when rendered
+        series[0][bisect.bisect_left(self.buckets, amount)] += 1
+        series[1] += amount
+        series[2] += 1
+
+    def samples(self):
+        lines = []
+
+        for value, (counts, total, count) in sorted(self.series.items()):
+            running = 0
+            bounds = tuple(self.buckets) + (float('inf'),)
+            for bound, hits in zip(bounds, counts):
+                running += hits
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.label, value,
+                                  'le="%s"' % format_value(float(bound))),
+                    running))
+            labels = format_labels(self.label, value)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+
+        return lines
+
+
+class Registry(object):
+    """Collection of metrics that can be rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Add a metric
+
+        :param metric: Counter, Gauge or Histogram
+        :return: the metric
+        """
+
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Function renders every metric in Prometheus text format
+
+        :return: text as bytes
+        """
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class ServerMetrics(Registry):
+    """The chat server's metrics
+
+    Gauges for the server's state are added by the server
+    with gauge() since only it knows where the state lives
+    """
+
+    def __init__(self):
+        Registry.__init__(self)
+
+        # plain numbers the server adds to directly, they are
+        # bumped for every send and recv so they must be cheap
+        self.invalid = 0
+        self.received = 0
+        self.sent = 0
+
+        self.latency = Histogram(
+            'chat_command_seconds', 'Time spent in command handlers',
+            LATENCY_BUCKETS, 'verb')
+
+        # the latency histogram already counts the calls
+        self.add(Counter(
+            'chat_commands_total', 'Commands dispatched, chat lines are '
+            'counted as verb "chat"', 'verb',
+            lambda: dict((verb, series[2]) for verb, series
+                         in self.latency.series.items())))
+        self.add(Counter(
+            'chat_invalid_commands_total', 'Unknown commands and commands '
+            'with the wrong number of arguments',
+            function=lambda: {'': self.invalid}))
+        self.add(self.latency)
+        self.fanout = self.add(Histogram(
+            'chat_broadcast_recipients', 'Local recipients per broadcast',
+            FANOUT_BUCKETS))
+        self.add(Counter(
+            'chat_received_bytes_total', 'Bytes received from clients',
+            function=lambda: {'': self.received}))
+        self.add(Counter(
+            'chat_sent_bytes_total', 'Bytes sent to clients',
+            function=lambda: {'': self.sent}))
+        self.lag = self.add(Histogram(
+            'chat_event_loop_lag_seconds', 'How late timers run, '
+            'which is how long the event loop was busy', LAG_BUCKETS))
+
+    def gauge(self, name, help, function):
+        """Add a gauge read from function when metrics are collected
+
+        :param name: metric name
+        :param help: description shown with the metric
+        :param function: function returning the current value
+        """
+
+        self.add(Gauge(name, help, function))
+
+    def counter(self, name, help, label, function):
+        """Add a counter the server keeps itself, read from function
+        when metrics are collected
+
+        :param name: metric name
+        :param help: description shown with the metric
+        :param label: label name
+        :param function: function returning {label value: count}
+        """
+
+        self.add(Counter(name, help, label, function))
+
+    def timed(self, verb, handler):
+        """Function wraps a command handler so its calls are counted and timed
+
+        :param verb: command word used as label
+        :param handler: command handler
+        :return: wrapped handler
+        """
+
+        series = self.latency.get_series(verb)
+        counts = series[0]
+        buckets = self.latency.buckets
+        find = bisect.bisect_left
+        clock = time.time
+
+        def timed_handler(*args):
+            start = clock()
+            handler(*args)
+            elapsed = clock() - start
+            counts[find(buckets, elapsed)] += 1
+            series[1] += elapsed
+            series[2] += 1
+
+        return timed_handler
+
+    def watch_loop(self, loop, interval=0.5):
+        """Start measuring event loop lag
+
+        A timer is set every interval seconds and how late
+        it runs is recorded
+
+        :param loop: event loop with call_later
+        :param interval: seconds between measurements
+        """
+
+        loop.call_later(interval, self.loop_lag, loop, interval,
+                        time.time() + interval)
+
+    def loop_lag(self, loop, interval, due):
+        """Timer callback for watch_loop
+
+        :param loop: event loop
+        :param interval: seconds between measurements
+        :param due: when the timer should have run
+        """
+
+        self.lag.observe(max(0.0, time.time() - due))
+        self.watch_loop(loop, interval)
+
+
+def http_response(request, registry):
+    """Function answers an HTTP request for the metrics
+
+    :param request: raw request bytes
+    :param registry: Registry to render
+    :return: raw response bytes
+    """
+
+    line = request.split(b'\r\n', 1)[0].split()
+
+    if len(line) >= 2 and line[0] == b'GET' and line[1] in (b'/', b'/metrics'):
+        status = '200 OK'
+        body = registry.render()
+    else:
+        status = '404 Not Found'
+        body = b'Not Found\n'
+
+    head = ('HTTP/1.0 %s\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: close\r\n\r\n' % (status, len(body)))
+
+    return head.encode('ascii') + body
+
+
+class MetricsServer(object):
+    """Minimal HTTP server for the metrics on the server's event loop
+
+    Answers one GET /metrics per connection and closes it
+    """
+
+    def __init__(self, loop, registry, port, host='127.0.0.1'):
+        """
+        :param loop: EventLoop to run on
+        :param registry: Registry to render
+        :param port: port to listen on
+        :param host: address to listen on, local only by default
+        """
+
+        self.loop = loop
+        self.registry = registry
+
+        # socket -> request received so far, or response left to send
+        self.buffers = {}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.sock.setblocking(0)
+
+        loop.register(self.sock, READ, self.accept)
+
+    def accept(self, sock, events):
+        try:
+            conn, addr = sock.accept()
+        except socket.error:
+            return
+
+        conn.setblocking(0)
+        self.buffers[conn] = b''
+        self.loop.register(conn, READ, self.read)
+
+    def read(self, conn, events):
+        try:
+            data = conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+
+        if not data:
+            self.close(conn)
+            return
+
+        request = self.buffers[conn] + data
+
+        # wait for the rest of the headers
+        if b'\r\n\r\n' not in request and len(request) < 8192:
+            self.buffers[conn] = request
+            return
+
+        self.buffers[conn] = http_response(request, self.registry)
+        self.loop.modify(conn, WRITE, self.write)
+
+    def write(self, conn, events):
+        response = self.buffers[conn]
+
+        try:
+            sent = conn.send(response)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            sent = len(response)
+
+        self.buffers[conn] = response[sent:]
+        if not self.buffers[conn]:
+            self.close(conn)
+
+    def close(self, conn):
+        del self.buffers[conn]
+        self.loop.unregister(conn)
+        conn.close()
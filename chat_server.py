@@ -19,11 +19,34 @@
     51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 import socket   # for socket objects
-import select   # for select function
 import logging  # for logging
 import signal   # for signal interrupts
 import sys      # for sys calls
 import random   # for random stuff
+import argparse  # for command line options
+import errno     # for socket error codes
+import time      # for flood control
+import threading  # for writing snapshots
+
+try:
+    from sys import intern  # for sharing strings (built in on python 2)
+except ImportError:
+    pass
+
+from collections import deque        # for write buffers
+from collections import OrderedDict  # for the channel list
+from itertools import islice    # for gathering frames to send
+from itertools import count     # for username claim tokens
+
+from chat_events import EventLoop, TimerWheel, READ, WRITE
+from chat_events import available_backends
+from chat_cluster import BusConnection, open_listener, run_workers, text
+from chat_metrics import ServerMetrics, MetricsServer
+from chat_logging import setup_logging
+from chat_store import MessageLog
+from chat_snapshot import SnapshotError, can_pass_sockets, encode_state
+from chat_snapshot import decode_state, write_snapshot, read_snapshot
+from chat_snapshot import request_takeover, open_handoff, hand_over
 
 
 def broadcast_data(sock, message):
@@ -34,242 +57,657 @@ def broadcast_data(sock, message):
     This means that only clients whose current channel is the same as
     The sender will receive the message
 
+    Recipients are the channel's watchers so only the sockets
+    actually watching the channel are touched. The message is turned
+    into a frame once and the same frame is queued for every recipient
+
     :param sock: socket object
     :param message: message to send
     """
 
-    # stores sockets that have a non-empty current field
-    valid_users = []
+    # sender isn't looking at any channel so nobody gets it
+    current = accounts[sock].current
+    if current == '':
+        return
+
+    message = make_frame(message)
+    channel = CHANNELS[current]
+    watchers = channel.watchers
+
+    # the sender waits while the channel is over its budget
+    if CHANNEL_LINES or CHANNEL_BYTES:
+        wait = spend(channel, 1, len(message), CHANNEL_LINES, CHANNEL_BYTES,
+                     time.time())
+        if wait:
+            defer_reads(sock, wait, 'channel')
+
+    # keep it for /history and people joining later
+    if HISTORY_LINES:
+        channel.remember(message)
+
+    # and on disk, the writer thread does the writing
+    if STORE is not None:
+        STORE.append(current, message)
+
+    # everyone watching but the sender
+    if METRICS is not None:
+        METRICS.fanout.observe(len(watchers) - 1)
+
+    # Only send to sockets who are looking at the same current channel
+    # send_to only queues the message so a slow reader can't hold us up
+    for s in watchers:
+
+        # do not send the message back to the sender
+        if s is not sock:
+            send_to(s, message)
+
+    # other workers deliver it to their own members
+    if BUS is not None:
+        BUS.send('CHAN', current, message)
+
+
+def make_frame(message):
+    """Function turns a message into the bytes that go on the wire
+
+    Frames are immutable so one frame can sit in any number
+    of write buffers without being copied
+
+    :param message: message string
+    :return: message as bytes (UTF-8)
+    """
+
+    if isinstance(message, bytes):
+        return message
+    return message.encode('utf-8')
+
+
+def send_to(sock, data):
+    """Function queues data to be sent to a client
+
+    Data is written straight away when nothing is queued and the socket
+    takes it, otherwise it waits in the client's write buffer until the
+    event loop says the socket is writable again.
+
+    When a client's buffer is above HIGH_WATERMARK it is a slow consumer
+    and SLOW_CONSUMER decides what happens:
+      drop       - new data is thrown away until the buffer drains
+                   below LOW_WATERMARK
+      disconnect - the client is logged off
+      pause      - data is still queued but we stop reading from the
+                   client until its buffer drains below LOW_WATERMARK
+
+    Errors are never raised from here, broken clients are
+    logged off by the event loop once the current wakeup is done
+
+    :param sock: socket object
+    :param data: string or frame to send
+    """
+
+    account = accounts[sock]
+    data = make_frame(data)
+
+    # client is on its way out, don't bother
+    if account.closing:
+        return
+
+    if account.outlen >= HIGH_WATERMARK or account.throttled:
+
+        # stays a slow consumer until it drains below LOW_WATERMARK
+        account.throttled = True
+
+        if SLOW_CONSUMER == 'drop':
+            account.dropped += 1
+            return
+
+        if SLOW_CONSUMER == 'disconnect':
+            logging.info('%s is too slow, disconnecting',
+                         account.username)
+            close_later(sock)
+            return
+
+        # pause: stop reading until the client catches up
+        account.paused = True
+
+    account.outlen += len(data)
+
+    # nothing was waiting so try to send right away
+    queue = account.outbuf
+    if queue is None:
+        account.outbuf = deque((data,))
+        flush(sock)
+    else:
+        queue.append(data)
+
+    update_events(sock)
+
+
+def flush(sock):
+    """Function writes as much of a client's buffer as the socket takes
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+    queue = account.outbuf
+
+    # sendmsg (python 3.3+) writes several frames
+    # in one system call without joining them first
+    gather = hasattr(sock, 'sendmsg')
+
+    while queue:
+
+        try:
+            if gather and len(queue) > 1:
+                sent = sock.sendmsg(islice(queue, IOV_MAX))
+            else:
+                sent = sock.send(queue[0])
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                break
+
+            # socket is broken, log it off from the event loop
+            close_later(sock)
+            break
+
+        account.outlen -= sent
+
+        if METRICS is not None:
+            METRICS.sent += sent
+
+        # drop the frames that were sent completely
+        while queue and sent >= len(queue[0]):
+            sent -= len(queue.popleft())
+
+        # partial send, keep the rest for later
+        # (a memoryview so the frame isn't copied)
+        if sent:
+            queue[0] = memoryview(queue[0])[sent:]
+            break
+
+    # everything went, idle clients don't keep a buffer
+    if not queue:
+        account.outbuf = None
+
+    # below the low watermark so the client is back to normal
+    if account.outlen <= LOW_WATERMARK:
+        account.throttled = False
+        account.paused = False
+
+
+def close_later(sock):
+    """Function logs a client off once the current wakeup is done
+
+    Used when a send fails or a client is too slow, since logging off
+    in the middle of a broadcast would change the sets being walked
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+
+    if not account.closing:
+        account.closing = True
+        event_loop.call_soon(drop_connection, sock)
+
+
+def drop_connection(sock):
+    """Function logs off a client marked by close_later
+
+    :param sock: socket object
+    """
+
+    # may have logged off on its own in the meantime
+    if sock in accounts:
+        logoff(sock)
+
+
+def update_events(sock):
+    """Function tells the event loop which events we want for a client
+
+    We want to read unless reads are paused for a slow consumer,
+    deferred for a flooding one or waiting for the hub to say whether
+    the client's username is ours, and we want to write while there
+    is something in the buffer
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+
+    if account.outbuf:
+        events = WRITE
+    else:
+        events = 0
+
+    if (not account.paused and account.resume is None and
+            account.state != 'claiming nick'):
+        events |= READ
+
+    if events != account.events:
+        account.events = events
+        event_loop.modify(sock, events)
+
+
+class Channel(object):
+    """A channel on the server
+
+    members holds every socket that has joined the channel and
+    watchers the ones whose current channel it is, which are the
+    ones that get its messages. A channel exists for as long as
+    it has members
+
+    line_tokens/byte_tokens/spent are its flood control budget,
+    see spend()
+
+    history holds the channel's last messages as the frames that
+    were sent, so remembering a message costs no copy. It is kept
+    within HISTORY_LINES lines and HISTORY_BYTES bytes (counting
+    HISTORY_LINE_COST per line for the frame and its slot), oldest
+    messages go first, and it is only created with the first message
+    so a quiet channel costs nothing
+    """
+
+    def __init__(self, name):
+        """
+        :param name: channel name, starts with #
+        """
+
+        self.name = name
+        self.members = set()
+        self.watchers = set()
+
+        # flood control budget, filled up on first use
+        self.line_tokens = 0
+        self.byte_tokens = 0
+        self.spent = 0
+
+        # recent frames, oldest first, and their size
+        self.history = None
+        self.history_bytes = 0
+
+    def __len__(self):
+        return len(self.members)
+
+    def remember(self, frame):
+        """Add a message to the history, dropping the oldest ones
+        once it is over HISTORY_LINES or HISTORY_BYTES
+
+        :param frame: message as sent
+        """
+
+        history = self.history
+        if history is None:
+            history = self.history = deque()
+
+        history.append(frame)
+        self.history_bytes += len(frame) + HISTORY_LINE_COST
+
+        while (len(history) > HISTORY_LINES or
+               self.history_bytes > HISTORY_BYTES):
+            self.history_bytes -= len(history.popleft()) + HISTORY_LINE_COST
+
+    def recent(self, count):
+        """Function lists the channel's last messages
+
+        :param count: most messages to list
+        :return: list of frames, oldest first
+        """
+
+        if not self.history or count <= 0:
+            return []
+        return [frame for frame in islice(
+            self.history, max(0, len(self.history) - count), None)]
+
+
+class Session(object):
+    """The account of a client connection, in accounts under its socket
+
+    state goes from accepted to awaiting nick to registered and
+    timer is the registration timeout while the username is awaited
+    and the keepalive afterwards, seen is when the client last sent
+    anything and pinged when it was last sent a PING (0 for never)
+    inbuf holds a line that hasn't been completely received yet
+    and skipline is set while we throw away the rest of a long line
+    outbuf/outlen hold data waiting to be sent, outbuf is None
+    while there is none so idle clients don't each hold a deque
+    events is what we asked the event loop to watch for
+    throttled/paused/closing/dropped track slow consumers
+    and sockets that are about to be logged off
+    line_tokens/byte_tokens/spent are the flood control budget (see
+    spend()), resume is the timer that starts reading again once a
+    flooding client is back within budget, held the lines it sent that
+    wait until then and deferrals how many times that happened
+
+    There is one for every connection so it has __slots__, which
+    keeps it small and its attributes quick to get at
+    """
+
+    __slots__ = ('username', 'ip', 'state', 'timer', 'seen', 'pinged',
+                 'channels', 'current', 'inbuf', 'skipline', 'outbuf',
+                 'outlen', 'events', 'throttled', 'paused', 'closing',
+                 'dropped',
+                 'line_tokens', 'byte_tokens', 'spent', 'resume', 'held',
+                 'deferrals')
+
+    def __init__(self, ip):
+        """
+        :param ip: client's IP address
+        """
+
+        self.username = ''
+
+        # clients often share an address so they share the string
+        self.ip = intern(str(ip))
+
+        self.state = 'accepted'
+        self.timer = None
+        self.seen = time.time()
+        self.pinged = 0
+        self.channels = []
+        self.current = ''
+        self.inbuf = ''
+        self.skipline = False
+        self.outbuf = None
+        self.outlen = 0
+        self.events = READ
+        self.throttled = False
+        self.paused = False
+        self.closing = False
+        self.dropped = 0
+        self.line_tokens = 0
+        self.byte_tokens = 0
+        self.spent = 0
+        self.resume = None
+        self.held = None
+        self.deferrals = 0
+
+
+def spend(budget, lines, size, line_rate, byte_rate, now):
+    """Function takes lines and bytes out of a client's or channel's
+    token buckets
+
+    Each bucket holds up to FLOOD_BURST seconds worth of its rate and
+    is topped up right here for the time since it was last used, so
+    there are no timers and idle budgets cost nothing. A bucket may go
+    below zero: a line that was already read is always handled and it
+    is whoever sent it that waits until the bucket is back above zero
+
+    :param budget: Session or Channel
+    :param lines: lines to take
+    :param size: bytes to take
+    :param line_rate: lines per second, 0 for no limit
+    :param byte_rate: bytes per second, 0 for no limit
+    :param now: current time
+    :return: seconds until the buckets are above zero again, 0 if they are
+    """
+
+    # this runs for every line so no min()/max() calls
+    elapsed = now - budget.spent
+    budget.spent = now
+    wait = 0
+
+    if line_rate:
+        tokens = budget.line_tokens + elapsed * line_rate
+        if tokens > line_rate * FLOOD_BURST:
+            tokens = line_rate * FLOOD_BURST
+        tokens -= lines
+        budget.line_tokens = tokens
+        if tokens < 0:
+            wait = -tokens / line_rate
+
+    if byte_rate:
+        tokens = budget.byte_tokens + elapsed * byte_rate
+        if tokens > byte_rate * FLOOD_BURST:
+            tokens = byte_rate * FLOOD_BURST
+        tokens -= size
+        budget.byte_tokens = tokens
+        if tokens < 0 and -tokens / byte_rate > wait:
+            wait = -tokens / byte_rate
+
+    return wait
+
+
+def defer_reads(sock, wait, reason):
+    """Function stops reading from a client that is over its budget
+
+    Reading starts again in wait seconds. Until then the client's
+    data stays in the kernel, where TCP slows the client down for us
+
+    :param sock: socket object
+    :param wait: seconds
+    :param reason: 'client' or 'channel', whose budget ran out
+    """
+
+    account = accounts[sock]
+
+    # already waiting
+    if account.resume is not None:
+        return
+
+    FLOOD_STATS[reason] += 1
+    account.deferrals += 1
+    if account.deferrals == 1:
+        logging.info('%s is over the %s flood budget, reads deferred',
+                     account.username or account.ip, reason)
+
+    account.held = []
+    account.resume = event_loop.call_later(wait, resume_reads, sock)
+    update_events(sock)
+
+
+def resume_reads(sock):
+    """Function starts reading from a client again once it is in budget
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+    account.resume = None
+
+    # the lines it sent before it was stopped come first
+    held, account.held = account.held, None
+    handle_lines(sock, held)
+
+    if sock in accounts:
+        update_events(sock)
+
+
+def set_current(sock, channel):
+    """Function changes a socket's current channel
+    and keeps the channels' watchers up to date
+
+    :param sock: socket object
+    :param channel: new current channel ('' for none)
+    """
+
+    old = accounts[sock].current
 
-    # go through sockets in connection list
-    for s in CONNECTION_LIST:
+    # stop watching the old channel
+    if old != '':
+        watchers = CHANNELS[old].watchers
+        watchers.discard(sock)
 
-        # do not store master socket or client who is sending message
-        if s != server_socket and s != sock:
+        # nobody here is watching it anymore
+        if not watchers and BUS is not None:
+            BUS.send('UNSUB', old)
 
-            # find sockets with non empty current channel
-            if accounts[s]['current'] != '':
+    # watch the new one
+    if channel != '':
+        watchers = CHANNELS[channel].watchers
 
-                # store them in array
-                valid_users.append(s)
+        # first one here watching it, ask the hub for its messages
+        if not watchers and BUS is not None:
+            BUS.send('SUB', channel)
 
-    # go through sockets in valid users
-    for s in valid_users:
+        watchers.add(sock)
 
-        # Only send to sockets who are looking at the same current channel
-        if accounts[s]['current'] == accounts[sock]['current']:
-            # try to send the message
-            # if we can't send socket timed out so log client off
-            try:
-                s.send(message)
-            except:
-                logoff(socket)
+    accounts[sock].current = channel
 
 
 def parse_data(sock, message):
     """Function to parse the data received and perform the appropriate action
 
-    This function really only takes care of
-    /PRIVMSG commands and /msg commands
-    Everything else is passed on to parse_data2
+    Lines that don't start with / are chat messages and go straight
+    to chatmessage, that's the hot path so it does no parsing at all.
+    Commands are looked up by their first word in COMMANDS and the
+    rest of the line is split into the arguments the handler takes
 
     :param sock: socket object
     :param message: message to parse
     """
 
-    # received PRIVMSG command
-    if message.find('/PRIVMSG') == 0:
+    # plain chat message
+    if message[0] != '/':
+        chatmessage(sock, message)
+        return
 
-        # user not in any channels
-        if len(accounts[sock]['channels']) == 0:
+    # split off the command word
+    verb, space, rest = message.partition(' ')
 
-            # notify bad user!
-            sock.send('\nMust join channel to send a message\r\n')
+    # look up the command
+    command = COMMANDS.get(verb)
 
-        # user in channel(s)
-        else:
+    # no such command
+    if command is None:
+        if METRICS is not None:
+            METRICS.invalid += 1
+        send_to(sock, '\nInvalid command\r\n')
+        return
 
-            # we have a message to send
-            if message[9]:
+    handler, min_args, max_args, takes_rest = command
 
-                # name of user sending message
-                user = accounts[sock]['username']
+    # the last argument of commands like /msg is the rest
+    # of the line and isn't split on whitespace
+    if takes_rest:
+        args = rest.split(None, max_args - 1)
+    else:
+        args = rest.split()
 
-                # message to send
-                msg = message[9:]
+    # check to make sure we have the right
+    # amount of arguments before we try
+    if min_args <= len(args) <= max_args:
+        handler(sock, *args)
+    else:
+        if METRICS is not None:
+            METRICS.invalid += 1
+        send_to(sock, '\nInvalid command\r\n')
 
-                # send message to current channel
-                broadcast_data(sock, '\n<%s> %s\r\n' % (user, msg))
 
-            # we didn't actually get a message
-            # ..this probably couldn't happen
-            # but better safe than sorry!
-            else:
+def register_command(verb, handler, min_args=0, max_args=0,
+                     takes_rest=False):
+    """Function adds a command to the dispatch table
 
-                # notify bad user!
-                sock.send('\nEmpty message, nothing has been sent\r\n')
+    The handler is called as handler(sock, *args)
+    with between min_args and max_args arguments
 
-    # received a msg command
-    elif message.find('/msg') == 0:
+    :param verb: command word including the /, like /join
+    :param handler: function that carries out the command
+    :param min_args: fewest arguments the command takes
+    :param max_args: most arguments the command takes
+    :param takes_rest: last argument is the rest of the line as is
+    """
 
-        # split message string up to do error checking
-        check_msg = message.split()
+    COMMANDS[verb] = (handler, min_args, max_args, takes_rest)
 
-        # check to make sure we have a sufficient
-        # amount of arguments before we try
-        if len(check_msg) >= 3:
-            privatemsg(sock, message)
-        else:
-            sock.send('\nInvalid command\r\n')
 
+def chatmessage(sock, msg):
+    """Function sends a chat message to the user's current channel
+
+    :param sock: socket object
+    :param msg: message to send
+    """
+
+    # user not in any channels
+    if len(accounts[sock].channels) == 0:
+
+        # notify bad user!
+        send_to(sock, '\nMust join channel to send a message\r\n')
+
+    # name of user sending message
     else:
-        # so for simplicity's sake we don't parse the
-        # /PRIVMSG command based on white space
-        # but everything else we do
-        message = message.split()
-        parse_data2(sock, message)
+        user = accounts[sock].username
+
+        # send message to current channel
+        broadcast_data(sock, '\n<%s> %s\r\n' % (user, msg))
 
 
-def privatemsg(sock, msg):
+def privatemsg(sock, user, msg):
     """Function handles msg command
     which allows user to send private messages
 
     :param sock: socket object
+    :param user: username to send the message to
     :param msg: message to send
     """
 
-    sender = accounts[sock]['username']
-
-    # split the msg string into array of strings
-    # then grab the piece at index 1
-    user = msg.split()[1]
+    # look up the socket that owns that username
+    target = USERS.get(nick_key(user))
 
     # user tried to send a private message
     # to themselves
-    if user == sender:
+    if target is sock:
 
         # notify bad user
-        sock.send('\nCan not private message yourself!\r\n')
+        send_to(sock, '\nCan not private message yourself!\r\n')
 
         # get outta here
         return
 
-    # take everything after the user name
-    # turn it into msg2send string
-    msg2send = msg[5+len(user):]
-
     # check to see if that username is
     # in the user list
-    if user in USER_LIST:
+    if target is not None:
 
-        # go through the accounts
-        for key in accounts:
+        sender = accounts[sock].username
 
-            # find the specified user
-            if accounts[key]['username'] == user:
+        # send the private message
+        send_to(target, '\n<private message from %s> %s\r\n'
+                % (sender, msg))
 
-                # try sending the private message
-                try:
-                    key.send('\n<private message from %s>%s\r\n'
-                             % (sender, msg2send))
-                    break  # to stop needless iterations
+    # user may be connected to another worker, the hub knows
+    elif BUS is not None:
 
-                # otherwise log that socket off
-                except:
-                    logoff(key)
+        sender = accounts[sock].username
+
+        BUS.send('PRIV', nick_key(user), nick_key(sender),
+                 make_frame('\n<private message from %s> %s\r\n'
+                            % (sender, msg)))
 
     # username wasn't in user list
     else:
-        sock.send('\nNo such user\r\n')
-
+        send_to(sock, '\nNo such user\r\n')
 
-def parse_data2(sock, message):
-    """Function receives data parsed based on
-    whitespace and takes the appropriate action
 
-    The majority of messages pass through this function
-    (the only exception being /PRIVMSG commands)
-    Therefore it is very important to server operation
+def nick_key(nick):
+    """Function turns a username into its key in USERS
 
-    :param sock: socket object
-    :param message: message to dictate action
+    :param nick: username
+    :return: key for the USERS dictionary
     """
 
-    # take action based on the length of the message
-    if len(message) == 1:
+    if CASEFOLD_NICKS:
+        return nick.lower()
+    return nick
 
-        # received help command
-        if message[0] == '/help':
-            # general help command, lists all commands
-            help(sock, command=None)
 
-        # received who command
-        elif message[0] == '/who':
-            who(sock, channel=None)
+def usernames():
+    """Function lists the usernames of everyone connected
 
-        # received list command
-        elif message[0] == '/list':
-            list(sock)
+    :return: list of usernames
+    """
 
-        # received exit command
-        elif message[0] == '/exit':
-            logoff(sock)
+    return [accounts[s].username for s in USERS.values()]
 
-        # received nick command
-        elif message[0] == '/nick':
-            changenick(sock, nick=None)
 
-        # everything else is invalid
-        else:
-            sock.send('\nInvalid command\r\n')
-
-    elif len(message) == 2:
-
-        # received help command
-        if message[0] == '/help':
-            command = message[1]
-            help(sock, command)
-
-        # receive a whois command
-        elif message[0] == '/whois':
-            username = message[1]
-            whois(sock, username)
-
-        # received a peek command
-        elif message[0] == '/who':
-            channel = message[1]
-            who(sock, channel)
-
-        # received a join command
-        elif message[0] == '/join':
-            channel = message[1]
-            joinchannel(sock, channel)
-
-        # received a leave command
-        elif message[0] == '/leave':
-            channel = message[1]
-            leavechannel(sock, channel)
-
-        # received a current command
-        elif message[0] == '/current':
-            channel = message[1]
-            switchcurrent(sock, channel)
-
-        # received a nick command
-        elif message[0] == '/nick':
-            nick = message[1]
-            changenick(sock, nick)
-
-        # everything else is invalid
-        else:
-            sock.send('\nInvalid command\r\n')
+def channel_names():
+    """Function lists the channels on the server
 
-    # everything else is invalid
-    else:
-        sock.send('\nInvalid command\r\n')
+    :return: list of channel names, oldest first
+    """
+
+    return [name for name in CHANNELS]
 
 
-def help(sock, command):
+def help(sock, command=None):
     """Function processes help command which shows user list of commands
     If command is supplied, specific info about command is sent to client
 
@@ -278,172 +716,185 @@ def help(sock, command):
     """
 
     if command is None:
-        sock.send('\nList of commands\n')
-        sock.send('/help -- shows valid commands\n')
-        sock.send('/nick <nickname> -- show/change username\n')
-        sock.send('/who <channel> -- shows users\n')
-        sock.send('/list -- shows channels on server\n')
-        sock.send('/exit -- logoff\n')
-        sock.send('/whois <username> -- info about user\n')
-        sock.send('/join <channel> -- join channel\n')
-        sock.send('/leave <channel> -- leave channel\n')
-        sock.send('/current <channel> -- change current channel\n')
-        sock.send('/msg <user> <message> -- send user private message\n')
-        sock.send('/help <command> -- more info on command\r\n')
+        send_to(sock, '\nList of commands\n')
+        send_to(sock, '/help -- shows valid commands\n')
+        send_to(sock, '/nick <nickname> -- show/change username\n')
+        send_to(sock, '/who <channel> -- shows users\n')
+        send_to(sock, '/list -- shows channels on server\n')
+        send_to(sock, '/exit -- logoff\n')
+        send_to(sock, '/whois <username> -- info about user\n')
+        send_to(sock, '/join <channel> -- join channel\n')
+        send_to(sock, '/leave <channel> -- leave channel\n')
+        send_to(sock, '/current <channel> -- change current channel\n')
+        send_to(sock, '/history <channel> <lines> -- recent messages\n')
+        send_to(sock, '/msg <user> <message> -- send user private message\n')
+        send_to(sock, '/help <command> -- more info on command\r\n')
 
     else:
         if command == 'nick':
-            sock.send('\nCommand: /nick\n')
-            sock.send('Arguments: <nickname> (optional)\n')
-            sock.send('Description: The nick command will'
-                      ' change your username to <nickname>\n')
-            sock.send('If <nickname> is not provided,'
-                      ' current username is echoed\r\n')
+            send_to(sock, '\nCommand: /nick\n')
+            send_to(sock, 'Arguments: <nickname> (optional)\n')
+            send_to(sock, 'Description: The nick command will'
+                          ' change your username to <nickname>\n')
+            send_to(sock, 'If <nickname> is not provided,'
+                          ' current username is echoed\r\n')
 
         elif command == 'who':
-            sock.send('\nCommand: /who\n')
-            sock.send('Arguments: <channel> (optional)\n')
-            sock.send('Description: The who command will show'
-                      'you all the users on the server\n')
-            sock.send('when channel is not provided.'
-                      'When channel provided it will show you\n')
-            sock.send('the users in that channel\r\n')
+            send_to(sock, '\nCommand: /who\n')
+            send_to(sock, 'Arguments: <channel> (optional)\n')
+            send_to(sock, 'Description: The who command will show'
+                          'you all the users on the server\n')
+            send_to(sock, 'when channel is not provided.'
+                          'When channel provided it will show you\n')
+            send_to(sock, 'the users in that channel\r\n')
 
         elif command == 'list':
-            sock.send('\nCommand: /list\n')
-            sock.send('Arguments: none\n')
-            sock.send('Description: The list command will show'
-                      'you a list of the current channels on the server\r\n')
+            send_to(sock, '\nCommand: /list\n')
+            send_to(sock, 'Arguments: none\n')
+            send_to(sock, 'Description: The list command will show'
+                          'you a list of the current channels'
+                          ' on the server\r\n')
 
         elif command == 'exit':
-            sock.send('\nCommand: /exit\n')
-            sock.send('Arguments: none\n')
-            sock.send('Description: The exit command will log'
-                      'you off the server\r\n')
+            send_to(sock, '\nCommand: /exit\n')
+            send_to(sock, 'Arguments: none\n')
+            send_to(sock, 'Description: The exit command will log'
+                          'you off the server\r\n')
 
         elif command == 'whois':
-            sock.send('\nCommand: /whois\n')
-            sock.send('Arguments: <username> (required)\n')
-            sock.send('Description: The whois command will display basic'
-                      'info about the user specified with <username>\n')
-            sock.send('Ex: /whois billy\r\n')
+            send_to(sock, '\nCommand: /whois\n')
+            send_to(sock, 'Arguments: <username> (required)\n')
+            send_to(sock, 'Description: The whois command will display basic'
+                          'info about the user specified with <username>\n')
+            send_to(sock, 'Ex: /whois billy\r\n')
 
         elif command == 'join':
-            sock.send('\nCommand: /join\n')
-            sock.send('Arguments: <channel> (required)\n')
-            sock.send('Description: The join command will place'
-                      'you in the channel specified with <channel>\n')
-            sock.send('If the channel does not exist yet,'
-                      'it will be created\n')
-            sock.send('By default the most recent channel you have'
-                      'joined becomes your current channel\n')
-            sock.send('Channel names must start with # and '
-                      'contain no spaces or other illegal characters\n')
-            sock.send('Ex: /join #channel_one\r\n')
+            send_to(sock, '\nCommand: /join\n')
+            send_to(sock, 'Arguments: <channel> (required)\n')
+            send_to(sock, 'Description: The join command will place'
+                          'you in the channel specified with <channel>\n')
+            send_to(sock, 'If the channel does not exist yet,'
+                          'it will be created\n')
+            send_to(sock, 'By default the most recent channel you have'
+                          'joined becomes your current channel\n')
+            send_to(sock, 'Channel names must start with # and '
+                          'contain no spaces or other illegal characters\n')
+            send_to(sock, 'Ex: /join #channel_one\r\n')
 
         elif command == 'leave':
-            sock.send('\nCommand: /leave\n')
-            sock.send('Arguments: <channel> (required)\n')
-            sock.send('Description: The leave command will take you out '
-                      'of the channel specified by <channel>\n')
-            sock.send('You must be in a channel in order to leave it.\n')
-            sock.send('If you are the last person in the channel, '
-                      'once you leave it will be deleted\n')
-            sock.send('Ex: /leave #channel_one\r\n')
+            send_to(sock, '\nCommand: /leave\n')
+            send_to(sock, 'Arguments: <channel> (required)\n')
+            send_to(sock, 'Description: The leave command will take you out '
+                          'of the channel specified by <channel>\n')
+            send_to(sock, 'You must be in a channel in order to leave it.\n')
+            send_to(sock, 'If you are the last person in the channel, '
+                          'once you leave it will be deleted\n')
+            send_to(sock, 'Ex: /leave #channel_one\r\n')
 
         elif command == 'current':
-            sock.send('\nCommand: /current\n')
-            sock.send('Arguments: <channel> (required)\n')
-            sock.send('Description: The current command will switch your '
-                      'current channel\n')
-            sock.send('You must be in the channel specified by <channel>\n')
-            sock.send('Ex: /current #channel_one\r\n')
+            send_to(sock, '\nCommand: /current\n')
+            send_to(sock, 'Arguments: <channel> (required)\n')
+            send_to(sock, 'Description: The current command will switch your '
+                          'current channel\n')
+            send_to(sock, 'You must be in the channel'
+                          ' specified by <channel>\n')
+            send_to(sock, 'Ex: /current #channel_one\r\n')
+
+        elif command == 'history':
+            send_to(sock, '\nCommand: /history\n')
+            send_to(sock, 'Arguments: <channel> (required), '
+                          '<lines> (optional)\n')
+            send_to(sock, 'Description: The history command will show '
+                          'the last <lines> messages sent to <channel>\n')
+            send_to(sock, 'or all the ones the server still has '
+                          'when <lines> is not provided\n')
+            send_to(sock, 'You must be in the channel'
+                          ' specified by <channel>\n')
+            send_to(sock, 'Ex: /history #channel_one 20\r\n')
 
         elif command == 'msg':
-            sock.send('\nCommand: /msg\n')
-            sock.send('Arguments: <user>, <message> (required)\n')
-            sock.send('Description: Send private message '
-                      '<message> to <user>\n')
-            sock.send('Ex: /msg billy hi billybob!\r\n')
+            send_to(sock, '\nCommand: /msg\n')
+            send_to(sock, 'Arguments: <user>, <message> (required)\n')
+            send_to(sock, 'Description: Send private message '
+                          '<message> to <user>\n')
+            send_to(sock, 'Ex: /msg billy hi billybob!\r\n')
 
         else:
-            sock.send('\nSpecified command does not exist.')
-            sock.send(' Type /help for list of commands\r\n')
+            send_to(sock, '\nSpecified command does not exist.')
+            send_to(sock, ' Type /help for list of commands\r\n')
 
 
-def who(sock, channel):
+def who(sock, channel=None):
     """Function processes who command which shows
     user other users connected to server
 
     :param sock: socket object
+    :param channel: only show users in this channel (optional)
     """
 
     if channel is None:
         # prompt
-        sock.send('\nUsers currently connected to server\r\n')
+        send_to(sock, '\nUsers currently connected to server\r\n')
 
-        # make string out of USER_LIST array
-        user_list = ", ".join(USER_LIST)
+        # make string out of the list of usernames
+        user_list = ", ".join(usernames())
 
         # send string
-        sock.send('%s\r\n' % user_list)
+        send_to(sock, '%s\r\n' % user_list)
 
     else:
         users_in_channel = []
 
         # No channels yet
-        if len(CHANNEL_LIST) == 0:
-            sock.send('\nNo channels currently on server\r\n')
+        if len(CHANNELS) == 0:
+            send_to(sock, '\nNo channels currently on server\r\n')
 
         # We have channels to peek at
         else:
             # check if channel is in the list
-            if channel in CHANNEL_LIST:
+            if channel in CHANNELS:
 
                 # it is so tell the user who is in there
-                sock.send("\nUsers in %s\r\n" % channel)
+                send_to(sock, "\nUsers in %s\r\n" % channel)
 
-                # go through the accounts
-                for key in accounts:
-
-                    # if channel listed in account, store it in array
-                    if channel in accounts[key]['channels']:
-                        users_in_channel.append(accounts[key]['username'])
+                # go through the channel's members
+                for key in CHANNELS[channel].members:
+                    users_in_channel.append(accounts[key].username)
 
                 # turn array into string
                 users_in_channel = ", ".join(users_in_channel)
 
                 # send info to client who requested it
-                sock.send('%s\r\n' % users_in_channel)
+                send_to(sock, '%s\r\n' % users_in_channel)
 
             # uh oh channel not in the list
             else:
-                sock.send('\nNo channel named %s\r\n' % channel)
+                send_to(sock, '\nNo channel named %s\r\n' % channel)
 
 
 def list(sock):
     """Function processes list command which shows user list of channels on server
     If no channels are currently on the server then the user is prompted
-    Otherwise, each channel in CHANNEL_LIST is sent to the user
+    Otherwise, each channel in CHANNELS is sent to the user
 
     :param sock: socket object
     """
 
     # channel list is 0 so no channels
-    if len(CHANNEL_LIST) == 0:
-        sock.send('\nNo channels currently on server\r\n')
+    if len(CHANNELS) == 0:
+        send_to(sock, '\nNo channels currently on server\r\n')
 
     # channel list is not 0 so send the list
     else:
         # prompt the client
-        sock.send('\nList of channels on server\r\n')
+        send_to(sock, '\nList of channels on server\r\n')
 
-        # grab the channel list which is an array
-        # and turn it a string
-        channel_list = ", ".join(CHANNEL_LIST)
+        # grab the channel names
+        # and turn them into a string
+        channel_list = ", ".join(CHANNELS)
 
         # send string off to client
-        sock.send('%s\r\n' % channel_list)
+        send_to(sock, '%s\r\n' % channel_list)
 
 
 def logoff(sock):
@@ -457,8 +908,13 @@ def logoff(sock):
     :param sock: socket object
     """
 
-    user = accounts[sock]['username']
-    channels = accounts[sock]['channels']
+    # never finished registering so nobody knows about them
+    if accounts[sock].state != 'registered':
+        disconnect(sock)
+        return
+
+    user = accounts[sock].username
+    channels = accounts[sock].channels
 
     # tell everyone that someone is leaving
     broadcast_data(sock, '\n%s has gone offline\r\n' % user)
@@ -466,23 +922,155 @@ def logoff(sock):
     # Remove user from all the channels that they are currently in
     # this is a nifty trick right here and necessary in this case!
     # iterate over the list backwards, removing channels 1 at a time!
-    for i in xrange(len(channels) - 1, -1, -1):
+    for i in range(len(channels) - 1, -1, -1):
         leavechannel(sock, channels[i])
 
     # for the server log
-    logging.info('%s is offline' % user)
+    logging.info('%s is offline', user)
 
     # remove client from user list
-    USER_LIST.remove(user)
+    del USERS[nick_key(user)]
 
-    logging.info('Updated user list: %s' % USER_LIST)
+    # username is free for the other workers too
+    if BUS is not None:
+        BUS.send('RELEASE', nick_key(user))
 
-    # close the socket
-    sock.close()
+    logging.info('%d users online', len(USERS))
+
+    disconnect(sock)
+
+
+def logoff_many(socks):
+    """Function logs a whole group of clients off at once
+
+    Used for shutdown and for dropping many clients together. Instead
+    of one "has gone offline" message per client per channel, everyone
+    who stays gets one message naming everybody that left, and the
+    connection list is only rebuilt once. The clients that leave
+    aren't sent anything. The message goes into the channel's history
+    and log like any broadcast_data message, though it isn't charged
+    to the channel's flood budget
+
+    :param socks: iterable of socket objects
+    """
+
+    leaving = set(s for s in socks if s in accounts)
+
+    # channel -> usernames watching it
+    gone = {}
+
+    for sock in leaving:
+        account = accounts[sock]
+
+        # never finished registering so nobody knows about them
+        if account.state != 'registered':
+            continue
+
+        user = account.username
+        current = account.current
+
+        # same channel broadcast_data would have told
+        if current != '':
+            gone.setdefault(current, []).append(user)
+
+        # take the user out of every channel it is in
+        for name in account.channels:
+            channel = CHANNELS.get(name)
+            if channel is None:
+                continue
+
+            channel.members.discard(sock)
+            channel.watchers.discard(sock)
+
+            # no one in channel
+            if len(channel) == 0:
+                del CHANNELS[name]
+
+                # nobody here is watching it anymore
+                if BUS is not None:
+                    BUS.send('UNSUB', name)
+
+        account.channels = []
+        account.current = ''
+
+        # remove client from user list
+        del USERS[nick_key(user)]
+
+        # username is free for the other workers too
+        if BUS is not None:
+            BUS.send('RELEASE', nick_key(user))
+
+    # one message per channel for everyone who stays
+    for name, names in gone.items():
+        message = make_frame(offline_notice(names))
+
+        # gone if everyone in it left, there is nobody to tell then
+        channel = CHANNELS.get(name)
+        if channel is not None:
+            if HISTORY_LINES:
+                channel.remember(message)
+            for s in channel.watchers:
+                send_to(s, message)
+
+        # kept on disk and sent to the other workers as broadcast_data does
+        if STORE is not None:
+            STORE.append(name, message)
+        if BUS is not None:
+            BUS.send('CHAN', name, message)
+
+    # close the sockets and rebuild the connection list once
+    for sock in leaving:
+        close_connection(sock)
+    CONNECTION_LIST[:] = [s for s in CONNECTION_LIST if s not in leaving]
+
+    # for the server log
+    logging.info('%d clients logged off, %d users and %d channels left',
+                 len(leaving), len(USERS), len(CHANNELS))
+
+
+def offline_notice(names):
+    """Function builds the message that tells people users went offline
+
+    :param names: list of usernames
+    :return: message string
+    """
+
+    if len(names) == 1:
+        return '\n%s has gone offline\r\n' % names[0]
+    return '\n%s have gone offline\r\n' % ', '.join(names)
+
+
+def disconnect(sock):
+    """Function closes a client's socket and throws away its account
+
+    :param sock: socket object
+    """
+
+    close_connection(sock)
 
     # remove socket from connection list
     CONNECTION_LIST.remove(sock)
 
+
+def close_connection(sock):
+    """Function closes a client's socket and removes its account
+    but leaves CONNECTION_LIST alone
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+
+    # registration, keepalive and flood timers are no longer needed
+    if account.timer is not None:
+        account.timer.cancel()
+    if account.resume is not None:
+        account.resume.cancel()
+
+    # stop watching the socket and close it
+    event_loop.unregister(sock)
+    sock.close()
+
     # remove account
     del accounts[sock]
 
@@ -495,19 +1083,17 @@ def whois(sock, username):
     :param username: user to look up
     """
 
+    # find the socket that is associated with that username
+    key = USERS.get(nick_key(username))
+
     # check to see if username exists
-    if username in USER_LIST:
+    if key is not None:
 
-        # it does so lets find the socket
-        # that is associated with that username
-        for key in accounts:
-            if accounts[key]['username'] == username:
-                ip = accounts[key]['ip']  # store ip
-                channels = accounts[key]['channels']  # store channel array
-                break  # break out of for loop
+        ip = accounts[key].ip  # store ip
+        channels = accounts[key].channels  # store channel array
 
         # send client some info on this socket
-        sock.send('\nUser: %s [%s]\r\n' % (username, ip))
+        send_to(sock, '\nUser: %s [%s]\r\n' % (username, ip))
 
         # check to see if this socket is in any channels
         if len(channels) > 0:
@@ -517,15 +1103,16 @@ def whois(sock, username):
             channel_list = ",".join(channels)
 
             # send client the channels
-            sock.send('\nChannels: %s\r\n' % channel_list)
+            send_to(sock, '\nChannels: %s\r\n' % channel_list)
 
         # socket is not in any channels
         else:
-            sock.send('\n%s is currently not in any channels\r\n' % username)
+            send_to(sock, '\n%s is currently not in any channels\r\n'
+                    % username)
 
     # username doesn't exist
     else:
-        sock.send('\n%s not currently connected to server\r\n' % username)
+        send_to(sock, '\n%s not currently connected to server\r\n' % username)
 
 
 def joinchannel(sock, channel):
@@ -535,29 +1122,34 @@ def joinchannel(sock, channel):
     :param channel: channel name
     """
 
-    user = accounts[sock]['username']
-    num_channels = len(accounts[sock]['channels'])
+    user = accounts[sock].username
+    num_channels = len(accounts[sock].channels)
 
-    if channel in CHANNEL_LIST:
+    if channel in CHANNELS:
 
         # make sure channel limit not reached
         if num_channels < 10:
 
             # add channel to user's channels
-            accounts[sock]['channels'].append(channel)
+            accounts[sock].channels.append(channel)
+            CHANNELS[channel].members.add(sock)
 
             # make channel the user's current channel
-            accounts[sock]['current'] = channel
+            set_current(sock, channel)
 
             # notify client
-            sock.send('\nJoined %s\r\n' % channel)
+            send_to(sock, '\nJoined %s\r\n' % channel)
+
+            # catch up on what was said before
+            if HISTORY_REPLAY:
+                send_history(sock, CHANNELS[channel], HISTORY_REPLAY)
 
             # tell everyone someone has arrived
             broadcast_data(sock, ('\n%s joined %s\r\n') % (user, channel))
 
         else:
             # notify user that limit reached
-            sock.send('\nChannel limit reached\r\n')
+            send_to(sock, '\nChannel limit reached\r\n')
 
     else:
 
@@ -568,32 +1160,42 @@ def joinchannel(sock, channel):
             if channel.find('#') == 0:
 
                 # create channel by adding it to the channel list
-                CHANNEL_LIST.append(channel)
+                CHANNELS[channel] = Channel(channel)
+
+                # pick up its history from before a restart
+                for frame in RESTORED_HISTORY.pop(channel, ()):
+                    CHANNELS[channel].remember(frame)
 
                 # add channel to user's channels
-                accounts[sock]['channels'].append(channel)
+                accounts[sock].channels.append(channel)
+                CHANNELS[channel].members.add(sock)
 
                 # make channel the user's current channel
-                accounts[sock]['current'] = channel
+                set_current(sock, channel)
 
                 # notify client
-                sock.send('\nJoined %s\r\n' % channel)
+                send_to(sock, '\nJoined %s\r\n' % channel)
+
+                # catch up on what was said before a restart
+                # (a channel that is really new has nothing to replay)
+                if HISTORY_REPLAY and CHANNELS[channel].history:
+                    send_history(sock, CHANNELS[channel], HISTORY_REPLAY)
 
                 # tell everyone someone has arrived
                 broadcast_data(sock, ('\n%s joined %s\r\n') % (user, channel))
 
                 # for the server logs
-                logging.info('New channel: %s' % channel)
-                logging.info('Updated channel list: %s' % CHANNEL_LIST)
+                logging.info('New channel: %s, %d channels',
+                             channel, len(CHANNELS))
 
             # invalid channel name, no bueno
             else:
-                sock.send('\nInvalid channel name\r\n')
-                sock.send('\nSee /help join\r\n')
+                send_to(sock, '\nInvalid channel name\r\n')
+                send_to(sock, '\nSee /help join\r\n')
 
         else:
             # notify user that limit reached
-            sock.send('\nChannel limit reached\r\n')
+            send_to(sock, '\nChannel limit reached\r\n')
 
 
 def leavechannel(sock, channel):
@@ -603,8 +1205,8 @@ def leavechannel(sock, channel):
     :param channel: channel to leave
     """
 
-    user = accounts[sock]['username']
-    channels = accounts[sock]['channels']
+    user = accounts[sock].username
+    channels = accounts[sock].channels
 
     # check to see if user is even in that channel
     if channel in channels:
@@ -614,68 +1216,111 @@ def leavechannel(sock, channel):
 
         # user has the channel in their channel list
         # check to see if its their current channel
-        if accounts[sock]['current'] == channel:
+        if accounts[sock].current == channel:
 
             # reset current channel
-            accounts[sock]['current'] = ''
+            set_current(sock, '')
 
             # remove channel from user's
             # channel list
-            accounts[sock]['channels'].remove(channel)
+            accounts[sock].channels.remove(channel)
 
             # notify user
-            sock.send('\nYou left %s\r\n' % channel)
+            send_to(sock, '\nYou left %s\r\n' % channel)
 
             # update channels variable
-            channels = accounts[sock]['channels']
+            channels = accounts[sock].channels
 
             # update current channel by
             # randomly selecting a channel from their list
             if len(channels) > 0:
                 current = random.choice(channels)
-                accounts[sock]['current'] = current
-                sock.send('\nCurrent channel is now %s\r\n' % current)
+                set_current(sock, current)
+                send_to(sock, '\nCurrent channel is now %s\r\n' % current)
 
         # not user's current channel
         else:
             # remove channel from user's
             # channel list
-            accounts[sock]['channels'].remove(channel)
+            accounts[sock].channels.remove(channel)
 
             # notify user
-            sock.send('\nYou left %s\r\n' % channel)
+            send_to(sock, '\nYou left %s\r\n' % channel)
 
         # Now we need to check to
         # see if we should remove that channel
         # from the channel list
 
-        # counter variable
-        count = 0
-
-        # go through the accounts
-        for key in accounts:
+        # (a user who joined twice is still in it)
+        if channel not in channels:
+            CHANNELS[channel].members.discard(sock)
 
-            # found accounts in channel
-            if channel in accounts[key]['channels']:
-
-                # count em up
-                count += 1
-
-        # count is equal to 0 so no one in channel
-        if count == 0:
+        # no one in channel
+        if len(CHANNELS[channel]) == 0:
 
             # remove from channel list
-            CHANNEL_LIST.remove(channel)
+            del CHANNELS[channel]
 
             # log info for server
-            logging.info('%s removed from channel list' % channel)
-            logging.info('Updated channel list: %s' % CHANNEL_LIST)
+            logging.info('%s removed from channel list, %d channels',
+                         channel, len(CHANNELS))
 
     # user isn't in that channel
     else:
 
         # tell user they are stupid
-        sock.send('\nNot in channel\nMust be in a channel to leave\r\n')
+        send_to(sock, '\nNot in channel\nMust be in a channel to leave\r\n')
+
+
+def channelhistory(sock, channel, lines=None):
+    """Function processes a history command which shows
+    the last messages sent to a channel
+
+    :param sock: socket object
+    :param channel: channel name
+    :param lines: how many messages (optional, all we have)
+    """
+
+    # only members get to read along
+    if channel not in accounts[sock].channels:
+        send_to(sock, '\nCurrently not in %s\nMust be in channel\r\n'
+                % channel)
+        return
+
+    if lines is None:
+        count = HISTORY_LINES
+    else:
+        try:
+            count = int(lines)
+        except ValueError:
+            count = 0
+
+        if count <= 0:
+            send_to(sock, '\nNumber of lines must be a positive number\r\n')
+            return
+
+    send_history(sock, CHANNELS[channel], count)
+
+
+def send_history(sock, channel, count):
+    """Function sends a client a channel's last messages
+
+    :param sock: socket object
+    :param channel: Channel object
+    :param count: most messages to send
+    """
+
+    frames = channel.recent(count)
+
+    if not frames:
+        send_to(sock, '\nNo history for %s\r\n' % channel.name)
+        return
+
+    send_to(sock, '\nLast %d messages in %s:\r\n' % (len(frames),
+                                                     channel.name))
+    for frame in frames:
+        send_to(sock, frame)
+    send_to(sock, '\nEnd of history for %s\r\n' % channel.name)
 
 
 def switchcurrent(sock, channel):
@@ -687,25 +1332,26 @@ def switchcurrent(sock, channel):
     """
 
     # as long as they are in that channel
-    if channel in accounts[sock]['channels']:
+    if channel in accounts[sock].channels:
 
         # switch current channel
-        accounts[sock]['current'] = channel
+        set_current(sock, channel)
 
         # store current channel
-        current = accounts[sock]['current']
+        current = accounts[sock].current
 
         # notify of successful switch
-        sock.send('\nCurrent channel is now %s\r\n' % current)
+        send_to(sock, '\nCurrent channel is now %s\r\n' % current)
 
     # otherwise, no bueno bruh
     else:
 
         # tell user whats up bruh
-        sock.send('\nCurrently not in %s\nMust be in channel\r\n' % channel)
+        send_to(sock, '\nCurrently not in %s\nMust be in channel\r\n'
+                % channel)
 
 
-def changenick(sock, nick):
+def changenick(sock, nick=None):
     """Function processes a nick command
     which changes the user's username
 
@@ -716,189 +1362,1246 @@ def changenick(sock, nick):
     # nick argument not provided
     # echo back username
     if nick is None:
-        sock.send('\nCurrent username: %s\r\n' % accounts[sock]['username'])
+        send_to(sock, '\nCurrent username: %s\r\n'
+                % accounts[sock].username)
 
         # get outta here
         return
 
+    # store old username
+    old = accounts[sock].username
+
     # nick argument provided
-    # check to see if its in the list
-    if nick in USER_LIST:
+    # check to see if that is already
+    # their username!
+    if nick == old:
+        send_to(sock, '\nThats already your username\r\n')
+
+    # check to see if someone else has it
+    # (with case folding on, changing only the case of
+    # your own username is allowed)
+    elif USERS.get(nick_key(nick), sock) is not sock:
+        send_to(sock, '\nUsername already in use\r\n')
+
+    # only the case changed, it is still our username
+    elif nick_key(nick) == nick_key(old):
+        rename_user(sock, nick, True)
+
+    # make sure no other worker has it
+    else:
+        claim_nick(sock, nick, rename_user)
 
-        # its in the list, now
-        # check to see if that is already
-        # their username!
-        if nick == accounts[sock]['username']:
-            sock.send('\nThats already your username\r\n')
 
-        # nope its not but its in use!
-        else:
-            sock.send('\nUsername already in use\r\n')
-    else:
+def rename_user(sock, nick, ok):
+    """Function finishes a nick command once the username is claimed
 
-        # store old username
-        old = accounts[sock]['username']
+    :param sock: socket object
+    :param nick: new username
+    :param ok: False if the username turned out to be in use
+    """
 
-        # remove the old username
-        USER_LIST.remove(old)
+    if not ok:
+        send_to(sock, '\nUsername already in use\r\n')
+        return
 
-        # set new username
-        accounts[sock]['username'] = nick
+    # store old username
+    old = accounts[sock].username
 
-        # update the USER_LIST
-        USER_LIST.append(nick)
+    # remove the old username
+    del USERS[nick_key(old)]
 
-        # tell everyone about the change
-        broadcast_data(sock, '\n%s is now know as %s\r\n' % (old, nick))
-        sock.send('\nNow known as %s\r\n' % nick)
+    # let the other workers have the old one
+    if BUS is not None and nick_key(old) != nick_key(nick):
+        BUS.send('RELEASE', nick_key(old))
 
+    # set new username
+    accounts[sock].username = nick
 
-def signal_handler(signal, frame):
-    """Function handles signal interrupt (CTRL-C)
+    # update the user index
+    USERS[nick_key(nick)] = sock
 
-    :param signal: signal caught
-    :param frame: current stack frame
+    # tell everyone about the change
+    broadcast_data(sock, '\n%s is now know as %s\r\n' % (old, nick))
+    send_to(sock, '\nNow known as %s\r\n' % nick)
+
+
+def claim_nick(sock, nick, callback):
+    """Function makes sure a username isn't in use on another worker
+
+    Callers check USERS first. With a single process that is all
+    there is to it and callback runs straight away, otherwise the
+    hub is asked and callback runs when its answer arrives
+
+    :param sock: socket object
+    :param nick: username wanted
+    :param callback: function called as callback(sock, nick, ok)
     """
 
-    for s in CONNECTION_LIST:
-        if s != server_socket:
-            logoff(s)
-    server_socket.close()
+    if BUS is None:
+        callback(sock, nick, True)
+        return
 
-    logging.info('Server shutting down')
-    sys.exit(0)
+    token = str(next(CLAIM_TOKENS))
+    CLAIMS[token] = (sock, nick, callback)
+    BUS.send('CLAIM', nick_key(nick), token)
 
 
-# initialize signal handler
-signal.signal(signal.SIGINT, signal_handler)
+def accept_connection(sock, events):
+    """Function handles new connections on the server socket
 
-if __name__ == "__main__":
-    """Main function
+    Up to ACCEPT_BATCH waiting connections are accepted per wakeup.
+    Nothing here waits on the client, the username is read later
+    by read_client like any other data
 
+    :param sock: server socket object
+    :param events: mask of ready events
     """
 
-    # for logging information on the server
-    logging.basicConfig(level=logging.INFO,
-                        format='[%(asctime)s] %(levelname)s: %(message)s',
-                        datefmt='%d/%m/%Y %I:%M:%S %p')
+    for i in range(ACCEPT_BATCH):
 
-    # to keep track of user information
-    accounts = {}
+        # Handle the case in which there is
+        # a new connection recieved through server_socket
+        try:
+            sockfd, addr = sock.accept()
+        except socket.error as e:
+            # no more connections waiting
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
 
-    # list to keep track of usernames
-    USER_LIST = []
+            # out of file descriptors and the like, try again next time
+            logging.error('accept failed: %s', str(e))
+            return
 
-    # list to keep track of socket descriptors
-    CONNECTION_LIST = []
+        # nothing may block the event loop
+        sockfd.setblocking(0)
 
-    # array to keep track of channels
-    CHANNEL_LIST = []
+        # Add to connection list
+        CONNECTION_LIST.append(sockfd)
 
-    # receiving buffer size
-    RECV_BUFFER = 512
+        # create an account, in the accounts dictionary
+        accounts[sockfd] = Session(addr[0])
 
-    # server port number
-    PORT = 6667
+        # start listening for the client's username
+        event_loop.register(sockfd, READ, client_ready)
+        accounts[sockfd].state = 'awaiting nick'
 
-    # create TCP socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # give up on clients that never send a username
+        accounts[sockfd].timer = timer_wheel.call_later(
+            REGISTRATION_TIMEOUT, registration_expired, sockfd)
 
-    # set socket options
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # bind socket
-    server_socket.bind(("0.0.0.0", PORT))
+def register_user(sock, data):
+    """Function takes a client's username from the first data it sends
 
-    # start listening with backlog of 10
-    server_socket.listen(10)
+    The username is the first line the client sends. Older clients
+    send it without CR-LF, so data without one is the username when it
+    is short enough to be theirs (OLD_NICK_LENGTH), anything longer is
+    the start of a line and waits in inbuf for the rest of it. A line
+    longer than MAX_LINE is no username and the client is let go
 
-    # Add server socket to the list of readable connections
-    CONNECTION_LIST.append(server_socket)
+    :param sock: socket object
+    :param data: data just received
+    :return: data received after the username
+    """
 
-    server_ip = socket.gethostbyname(socket.gethostname())
-    server_port = str(PORT)
+    account = accounts[sock]
 
-    # information that might be useful to clients
-    logging.info('Chat server started [%s:%s]' % (server_ip, server_port))
+    data = account.inbuf + data
+    account.inbuf = ''
 
-    while 1:
-        # Get the list sockets which are ready to be read through select
-        read_sockets, write_sockets, error_sockets = select.select(
-            CONNECTION_LIST, [], [])
+    if '\n' in data:
+        name, data = data.split('\n', 1)
 
-        for sock in read_sockets:
+    # an older client's username, all of it
+    elif len(data.strip()) <= OLD_NICK_LENGTH:
+        name, data = data, ''
 
-            # New connection
-            if sock == server_socket:
+    # start of a line, wait for the rest
+    elif len(data) + 1 <= MAX_LINE:
+        account.inbuf = data
+        return ''
 
-                # Handle the case in which there is
-                # a new connection recieved through server_socket
-                sockfd, addr = server_socket.accept()
+    else:
+        name, data = data, ''
 
-                # Add to connection list
-                CONNECTION_LIST.append(sockfd)
+    # same limit as any other line (see split_lines)
+    if len(name) + 1 > MAX_LINE:
+        send_to(sock, '\nUsername too long, max is %d characters\r\n'
+                % (MAX_LINE - 2))
+        close_later(sock)
+        return ''
 
-                # create an account, in the account dictionary
-                accounts[sockfd] = {
-                    'username': '',
-                    'ip': '',
-                    'channels': [],
-                    'current': ''
-                }
+    name = name.strip()
 
-                # store IP address
-                accounts[sockfd]['ip'] = addr[0]
+    # nothing but whitespace, keep waiting
+    if not name:
+        return ''
 
-                # get the client's username
-                name = sockfd.recv(RECV_BUFFER)
+    # check to see if its already being used
+    if nick_key(name) in USERS:
 
-                # check to see if its already being used
-                if name in USER_LIST:
+        send_to(sock, '\nUsername already in use\r\n')
+        close_later(sock)
+        return ''
 
-                    sockfd.send('\nUsername already in use\r\n')
-                    sockfd.close()
-                    CONNECTION_LIST.remove(sockfd)
+    # data after the username waits until the username is ours
+    account.state = 'claiming nick'
+    account.inbuf = data
 
-                else:
+    claim_nick(sock, name, welcome_user)
 
-                    # welcome new user!
-                    sockfd.send('Username authenticated!\r\n')
-                    sockfd.send('Welcome to Internet Relay Chat!!\r\n')
-                    sockfd.send('type /help for list of commands\r\n')
-                    # set the username in the account
-                    accounts[sockfd]['username'] = name
+    return ''
 
-                    # add to user list
-                    USER_LIST.append(name)
 
-                    # log some info for the server
-                    logging.info('Client (%s, %s) connected' % addr)
-                    logging.info('Client is know as %s' % name)
-                    logging.info('Updated user list: %s' % USER_LIST)
+def welcome_user(sock, name, ok):
+    """Function finishes registering a client once its username is claimed
 
-            # Some incoming message from a client
-            else:
-                # Data recieved from client, process it
-                try:
+    Lines the client sent after its username are handled from here
+
+    :param sock: socket object
+    :param name: username
+    :param ok: False if the username turned out to be in use
+    """
+
+    account = accounts[sock]
+
+    if not ok:
+        send_to(sock, '\nUsername already in use\r\n')
+        close_later(sock)
+        return
+
+    # registration is done, from now on the client is kept alive
+    account.state = 'registered'
+    account.timer.cancel()
+    account.timer = start_keepalive(sock)
+
+    # welcome new user!
+    send_to(sock, 'Username authenticated!\r\n')
+    send_to(sock, 'Welcome to Internet Relay Chat!!\r\n')
+    send_to(sock, 'type /help for list of commands\r\n')
+    # set the username in the account
+    account.username = name
+
+    # add to user list
+    USERS[nick_key(name)] = sock
+
+    # log some info for the server
+    logging.info('Client %s is known as %s, %d users online',
+                 account.ip, name, len(USERS))
+
+    # handle what the client sent after its username
+    data = account.inbuf
+    account.inbuf = ''
+    if data:
+        handle_data(sock, data)
+
+    # and read the rest
+    if sock in accounts:
+        update_events(sock)
+
+
+def registration_expired(sock):
+    """Function disconnects a client that took too long to send a username
+
+    :param sock: socket object
+    """
+
+    # the timer is cancelled once the client registers
+    # or disconnects so the client is still waiting
+    account = accounts[sock]
+    account.timer = None
+
+    logging.info('Client %s never sent a username', account.ip)
+    TIMEOUTS['registration'] += 1
+
+    send_to(sock, '\nRegistration timed out\r\n')
+    close_later(sock)
+
+
+def start_keepalive(sock):
+    """Function starts checking that a registered client is still there
+
+    :param sock: socket object
+    :return: keepalive timer, None if PING_INTERVAL is 0
+    """
+
+    if not PING_INTERVAL:
+        return None
+
+    return timer_wheel.call_later(PING_INTERVAL, keepalive, sock)
+
+
+def keepalive(sock):
+    """Function pings a client that has been quiet for PING_INTERVAL
+    seconds and disconnects it if it is still quiet PING_TIMEOUT later
+
+    The timer isn't touched when data comes in, that would cost every
+    read a cancel and a new timer. Instead every read sets seen and
+    this works out when the client was last heard from once it runs.
+    Any line counts as an answer, /pong is just the cheapest one
+
+    :param sock: socket object
+    """
+
+    account = accounts[sock]
+    account.timer = None
+
+    # about to be logged off anyway
+    if account.closing:
+        return
+
+    now = time.time()
+
+    # pinged and nothing since, the other end is gone
+    if account.pinged and account.seen < account.pinged:
+        logging.info('%s timed out, no answer to PING in %d seconds',
+                     account.username, now - account.pinged)
+        TIMEOUTS['ping'] += 1
+        send_to(sock, '\nPing timeout\r\n')
+        close_later(sock)
+        return
+
+    account.pinged = 0
+    idle = now - account.seen
+
+    # heard from it since the timer was set, wait out the rest
+    if idle < PING_INTERVAL:
+        account.timer = timer_wheel.call_later(PING_INTERVAL - idle,
+                                               keepalive, sock)
+        return
+
+    send_to(sock, 'PING %d\r\n' % now)
+    account.pinged = now
+    account.timer = timer_wheel.call_later(PING_TIMEOUT, keepalive, sock)
+
+
+def pong(sock, token=None):
+    """Function processes the pong command clients answer a PING with
+
+    Nothing to do, receive() already noted that the client is there
+
+    :param sock: socket object
+    :param token: whatever followed PING
+    """
+
+
+def client_ready(sock, events):
+    """Function handles a client socket that the event loop says is ready
+
+    :param sock: socket object
+    :param events: mask of ready events
+    """
+
+    account = accounts[sock]
+
+    # socket is writable so drain the write buffer
+    if events & WRITE:
+        flush(sock)
+        update_events(sock)
+
+    # socket broke or client was too slow, it is about to be logged off
+    if account.closing:
+        return
+
+    # reads are paused until the client catches up
+    # or deferred until it is back within its flood budget
+    if events & READ and not account.paused and account.resume is None:
+        read_client(sock)
+
+
+def split_lines(sock, data):
+    """Function adds received data to a client's receive buffer
+    and takes the complete lines back out
+
+    Lines end with CR-LF but a bare LF is accepted too.
+    Lines longer than MAX_LINE (CR-LF included) are thrown away
+    and the client is told about it, once per line
+
+    :param sock: socket object
+    :param data: data just received
+    :return: list of complete lines (without the LF)
+    """
+
+    account = accounts[sock]
+
+    # rest of a line that was too long, throw it away up to its LF
+    # (the client was told when we started to)
+    if account.skipline:
+        end = data.find('\n')
+        if end < 0:
+            return []
+        account.skipline = False
+        data = data[end + 1:]
+
+    lines = (account.inbuf + data).split('\n')
+
+    # last piece is an incomplete line (or '' if data ended with LF)
+    account.inbuf = lines.pop()
+
+    complete = []
+    for line in lines:
+        if len(line) + 1 > MAX_LINE:
+            send_to(sock, '\nLine too long, max is %d characters\r\n'
+                    % (MAX_LINE - 2))
+        else:
+            complete.append(line)
+
+    # incomplete line is already too long, stop buffering it
+    if len(account.inbuf) + 1 > MAX_LINE:
+        send_to(sock, '\nLine too long, max is %d characters\r\n'
+                % (MAX_LINE - 2))
+        account.inbuf = ''
+        account.skipline = True
+
+    return complete
+
+
+def read_client(sock):
+    """Function handles an incoming message from a client
+
+    :param sock: socket object
+    """
+
+    # Data recieved from client, process it
+    try:
+
+        # receive whatever the client has sent
+        data = sock.recv(RECV_BUFFER)
+
+        # no data means the client hung up
+        if not data:
+            logoff(sock)
+            return
+
+        receive(sock, data)
+
+    except socket.error as e:
+        # spurious wakeup, nothing to read after all
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return
+        if sock in accounts:
+            logoff(sock)
+
+    except:
+        if sock in accounts:
+            logoff(sock)
+
+
+def receive(sock, data):
+    """Function handles data received from a client
+
+    Doesn't care where the data came from, read_client
+    and the asyncio server (chat_aio.py) both hand it over here
+
+    :param sock: socket object
+    :param data: data received
+    """
+
+    if METRICS is not None:
+        METRICS.received += len(data)
+
+    # anything at all shows the client is still there
+    accounts[sock].seen = time.time()
+
+    # python 3 sockets give us bytes
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+
+    state = accounts[sock].state
+
+    # still waiting to hear if the username is ours (the asyncio
+    # server may still have had a read going when reads stopped)
+    if state == 'claiming nick':
+        accounts[sock].inbuf += data
+
+    # first thing a client sends is its username
+    elif state != 'registered':
+        register_user(sock, data)
+
+        # the rest stays in the kernel until we know
+        if sock in accounts and accounts[sock].state == 'claiming nick':
+            update_events(sock)
+
+    else:
+        handle_data(sock, data)
+
+
+def handle_data(sock, data):
+    """Function handles every complete line in the data from a client
+
+    :param sock: socket object
+    :param data: data received
+    """
+
+    lines = split_lines(sock, data)
+
+    # over its flood budget (the asyncio server may
+    # still have had a read going), wait in line
+    held = accounts[sock].held
+    if held is not None:
+        held.extend(lines)
+        return
+
+    handle_lines(sock, lines)
+
+
+def handle_lines(sock, lines):
+    """Function handles complete lines from a client
+
+    With flood control on every line is charged to the client's
+    budget and once it is used up the rest of the lines are held
+    back until the client is within budget again
+
+    :param sock: socket object
+    :param lines: list of lines
+    """
+
+    account = accounts[sock]
+    flood_control = FLOOD_LINES or FLOOD_BYTES
+    if flood_control:
+        now = time.time()
+
+    for i, line in enumerate(lines):
+
+        # stripping makes parsing easier (I guess)
+        line = line.strip()
+
+        # we have data
+        if line:
+            if flood_control:
+                wait = spend(account, 1, len(line), FLOOD_LINES,
+                             FLOOD_BYTES, now)
+                if wait:
+                    defer_reads(sock, wait, 'client')
+
+            parse_data(sock, line)
+
+        # client logged off (/exit) so the rest is moot
+        if sock not in accounts:
+            return
+
+        # over budget (its own or its channel's), the rest waits
+        if account.resume is not None:
+            account.held.extend(lines[i + 1:])
+            return
+
+
+def bus_record(bus, fields):
+    """Function handles a record the hub sent this worker
+
+    :param bus: bus connection to the hub
+    :param fields: list of fields, the first is the record type
+    """
+
+    kind = fields[0]
+
+    # answer to claim_nick
+    if kind == b'CLAIMED':
+        sock, nick, callback = CLAIMS.pop(text(fields[1]))
+        ok = fields[2] == b'1'
+
+        # client left while we waited, give the username back
+        if sock not in accounts:
+            if ok:
+                BUS.send('RELEASE', nick_key(nick))
+            return
+
+        callback(sock, nick, ok)
+
+    # channel message from another worker
+    elif kind == b'CHAN':
+        channel = CHANNELS.get(text(fields[1]))
+        if channel is not None:
+            if HISTORY_LINES:
+                channel.remember(fields[2])
+            for s in channel.watchers:
+                send_to(s, fields[2])
+
+    # private message from another worker
+    elif kind == b'PRIV':
+        target = USERS.get(text(fields[1]))
+        if target is not None:
+            send_to(target, fields[2])
+
+    # private message to a username no worker has
+    elif kind == b'NOUSER':
+        sender = USERS.get(text(fields[1]))
+        if sender is not None:
+            send_to(sender, '\nNo such user\r\n')
+
+
+def bus_closed(bus):
+    """Function shuts the worker down when the hub goes away
+
+    :param bus: bus connection to the hub
+    """
+
+    logging.error('Lost connection to the hub')
+    signal_handler(signal.SIGTERM, None)
+
+
+def start_server(backend=None, reuseport=False, listener=None):
+    """Function opens the server socket and creates the event loop
+
+    :param backend: event loop backend name
+    :param reuseport: share the port with other worker processes
+    :param listener: listening socket taken over from another process
+    """
+
+    global server_socket, event_loop, timer_wheel
+
+    # create the listening socket
+    if listener is None:
+        listener = open_listener(PORT, LISTEN_BACKLOG, reuseport)
+    server_socket = listener
+
+    # Add server socket to the list of connections
+    CONNECTION_LIST.append(server_socket)
+
+    # create the event loop and watch the server socket for new connections
+    event_loop = EventLoop(backend)
+    event_loop.register(server_socket, READ, accept_connection)
+
+    # connection timeouts don't need to be precise and there
+    # is one per connection so they go on a timer wheel
+    timer_wheel = TimerWheel(event_loop)
+
+
+def enable_metrics():
+    """Function turns metrics on
+
+    Every command handler (and chatmessage for plain chat lines) is
+    wrapped so it is counted and timed, which means nothing is added
+    to the hot path while metrics are off. Whoever calls this serves
+    METRICS.render() to whoever asks
+    """
+
+    global METRICS, chatmessage
+
+    METRICS = ServerMetrics()
+
+    # state is read when metrics are collected, not kept up to date
+    METRICS.gauge('chat_connections', 'Open client connections',
+                  lambda: len(accounts))
+    METRICS.gauge('chat_users', 'Registered users', lambda: len(USERS))
+    METRICS.gauge('chat_channels', 'Channels with members',
+                  lambda: len(CHANNELS))
+    METRICS.gauge('chat_queued_bytes', 'Bytes waiting in write buffers',
+                  lambda: sum(a.outlen for a in accounts.values()))
+    METRICS.gauge('chat_slow_consumers', 'Clients above the high watermark',
+                  lambda: sum(1 for a in accounts.values() if a.throttled))
+    METRICS.gauge('chat_flood_deferred_clients', 'Clients whose reads are '
+                  'deferred for going over a flood budget',
+                  lambda: sum(1 for a in accounts.values()
+                              if a.resume is not None))
+    METRICS.counter('chat_flood_deferrals_total', 'Times reads were '
+                    'deferred, by whose budget ran out', 'budget',
+                    lambda: FLOOD_STATS)
+    METRICS.counter('chat_timeouts_total', 'Clients disconnected for '
+                    'going quiet, by which timeout', 'kind',
+                    lambda: TIMEOUTS)
+
+    # count and time every command
+    for verb, (handler, min_args, max_args, takes_rest) in COMMANDS.items():
+        COMMANDS[verb] = (METRICS.timed(verb, handler),
+                          min_args, max_args, takes_rest)
+
+    # parse_data calls chatmessage directly for plain chat lines
+    chatmessage = METRICS.timed('chat', chatmessage)
+
+    METRICS.watch_loop(event_loop)
+
+
+def enable_store(writer=0):
+    """Function starts writing channel messages to STORE_DIR
+
+    :param writer: number for this process' segments
+    """
+
+    global STORE
+
+    STORE = MessageLog(STORE_DIR, writer, STORE_RETENTION)
+    logging.info('Channel logs in %s', STORE_DIR)
+
+
+def snapshot_state(clients=()):
+    """Function takes a snapshot of the channels and their histories
+
+    Histories restored for channels nobody has joined again go in too
+
+    :param clients: sockets whose connections go in too, in that order
+    :return: snapshot bytes
+    """
+
+    channels = [(name, channel.history or ())
+                for name, channel in CHANNELS.items()]
+    channels.extend((name, frames)
+                    for name, frames in RESTORED_HISTORY.items()
+                    if name not in CHANNELS)
+
+    return encode_state(channels, [accounts[sock] for sock in clients])
+
+
+def save_snapshot():
+    """Function writes a snapshot to SNAPSHOT_PATH every SNAPSHOT_INTERVAL
+
+    The snapshot is taken here but written and synced to disk
+    on a thread of its own so the event loop doesn't wait on the disk
+    """
+
+    global snapshot_writer
+
+    event_loop.call_later(SNAPSHOT_INTERVAL, save_snapshot)
+
+    # still writing the last one, the disk can't keep up
+    if snapshot_writer is not None and snapshot_writer.is_alive():
+        logging.warning('Snapshot skipped, the last one is still '
+                        'being written')
+        return
+
+    snapshot_writer = threading.Thread(
+        target=write_snapshot, args=(SNAPSHOT_PATH, snapshot_state()),
+        name='snapshot writer')
+    snapshot_writer.daemon = True
+    snapshot_writer.start()
+
+
+def load_snapshot():
+    """Function reads the channel histories back from SNAPSHOT_PATH
+
+    A channel only exists while it has members, so histories are
+    kept in RESTORED_HISTORY until someone joins their channel again
+    """
+
+    data = read_snapshot(SNAPSHOT_PATH)
+    if data is None:
+        return
+
+    try:
+        channels, clients = decode_state(data)
+    except SnapshotError as e:
+        logging.warning('Ignoring snapshot %s: %s', SNAPSHOT_PATH, e)
+        return
+
+    for name, frames in channels:
+        if frames:
+            RESTORED_HISTORY[text(name)] = frames
+
+    logging.info('Restored %d channel histories from %s',
+                 len(RESTORED_HISTORY), SNAPSHOT_PATH)
+
+
+def restore_state(data, socks):
+    """Function rebuilds the channels and clients of a server taken over
+
+    :param data: snapshot bytes
+    :param socks: client sockets in the snapshot's order
+    """
+
+    channels, clients = decode_state(data)
+
+    for name, frames in channels:
+        name = text(name)
+        CHANNELS[name] = Channel(name)
+        for frame in frames:
+            CHANNELS[name].remember(frame)
+
+    for sock, client in zip(socks, clients):
+
+        sock.setblocking(0)
+        CONNECTION_LIST.append(sock)
+
+        account = accounts[sock] = Session(text(client['ip']))
+        account.username = text(client['username'])
+        account.state = text(client['state'])
+        account.inbuf = text(client['inbuf'])
+        account.skipline = client['skipline']
+
+        # timeouts start over, with the full time
+        if account.state == 'registered':
+            USERS[nick_key(account.username)] = sock
+            account.timer = start_keepalive(sock)
+        else:
+            account.timer = timer_wheel.call_later(
+                REGISTRATION_TIMEOUT, registration_expired, sock)
+
+        for name in client['channels']:
+            name = text(name)
+            account.channels.append(name)
+            CHANNELS[name].members.add(sock)
+        set_current(sock, text(client['current']))
+
+        # whatever the old process had yet to send
+        if client['outbuf']:
+            account.outbuf = deque(client['outbuf'])
+            account.outlen = sum(len(frame) for frame in account.outbuf)
+        if account.outlen >= HIGH_WATERMARK:
+            account.throttled = True
+            account.paused = SLOW_CONSUMER == 'pause'
+
+        # lines held back from a flooding client are handled once
+        # everyone is restored, reading waits until then
+        if client['held']:
+            account.held = [text(line) for line in client['held']]
+            account.resume = event_loop.call_later(0, resume_reads, sock)
+
+        event_loop.register(sock, READ, client_ready)
+        update_events(sock)
+
+    # channels nobody is in only kept their history
+    for name in [name for name, channel in CHANNELS.items()
+                 if not channel.members]:
+        RESTORED_HISTORY[name] = CHANNELS.pop(name).history or ()
+
+    logging.info('Took over %d connections, %d channels and %d bytes '
+                 'waiting to be sent', len(accounts), len(CHANNELS),
+                 sum(a.outlen for a in accounts.values()))
+
+
+def take_over(backend=None):
+    """Function starts the server on the listening socket and clients
+    of the server listening on TAKEOVER_PATH
+
+    :param backend: event loop backend name
+    """
+
+    data, listener, socks = request_takeover(TAKEOVER_PATH)
+    start_server(backend, listener=listener)
+    restore_state(data, socks)
+
+
+def handoff_ready(sock, events):
+    """Function hands everything over to a new process and exits
+
+    :param sock: handoff socket
+    :param events: mask of ready events
+    """
+
+    try:
+        conn, addr = sock.accept()
+    except socket.error:
+        return
+
+    # clients on their way out are left to close with this process
+    clients = [s for s in CONNECTION_LIST
+               if s is not server_socket and not accounts[s].closing]
+
+    try:
+        hand_over(conn, snapshot_state(clients), [server_socket] + clients)
+    except SnapshotError as e:
+        logging.error('Takeover failed, carrying on: %s', e)
+        conn.close()
+        return
+
+    logging.info('Handed %d connections over, shutting down', len(clients))
+
+    # write out the rest of the channel logs before the new process
+    # appends to them, it starts once this one is gone
+    if STORE is not None:
+        STORE.close()
+
+    sys.exit(0)
+
+
+def run_worker(number, bus_socket, backend=None):
+    """Function runs one worker process in multi-process mode
+
+    :param number: worker number
+    :param bus_socket: socket connected to the hub
+    :param backend: event loop backend name
+    """
+
+    global BUS
+
+    start_server(backend, reuseport=True)
+
+    BUS = BusConnection(bus_socket, event_loop, bus_record, bus_closed)
+
+    # every worker serves its own metrics on the next port up
+    if METRICS_PORT is not None:
+        enable_metrics()
+        MetricsServer(event_loop, METRICS, METRICS_PORT + number)
+
+    # and writes its own segments of the channel logs
+    if STORE_DIR is not None:
+        enable_store(number)
+
+    # shut down cleanly when the hub passes a signal on
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    logging.info('Worker %d started', number)
+
+    # dispatch ready sockets to their handlers forever
+    event_loop.run()
+
+
+def signal_handler(signum, frame):
+    """Function handles signal interrupt (CTRL-C)
+
+    :param signum: signal caught
+    :param frame: current stack frame
+    """
+
+    # one shutdown is enough
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # keep the channel histories for the next start
+    # (before logging everyone off takes the channels away),
+    # once the periodic one is out of the way so this one is last
+    if SNAPSHOT_PATH is not None:
+        if snapshot_writer is not None:
+            snapshot_writer.join()
+        try:
+            write_snapshot(SNAPSHOT_PATH, snapshot_state())
+        except (IOError, OSError) as e:
+            logging.error('Unable to write snapshot %s: %s',
+                          SNAPSHOT_PATH, e)
+
+    # log everyone off in one go
+    logoff_many([s for s in CONNECTION_LIST if s is not server_socket])
+    event_loop.close()
+    server_socket.close()
+
+    # write out the rest of the channel logs
+    if STORE is not None:
+        STORE.close()
+
+    logging.info('Server shutting down')
+    sys.exit(0)
+
+
+# command word -> (handler, min args, max args, last arg is rest of line)
+COMMANDS = {}
+
+register_command('/help', help, 0, 1)
+register_command('/who', who, 0, 1)
+register_command('/list', list)
+register_command('/exit', logoff)
+register_command('/nick', changenick, 0, 1)
+register_command('/whois', whois, 1, 1)
+register_command('/join', joinchannel, 1, 1)
+register_command('/leave', leavechannel, 1, 1)
+register_command('/current', switchcurrent, 1, 1)
+register_command('/history', channelhistory, 1, 2)
+register_command('/msg', privatemsg, 2, 2, takes_rest=True)
+register_command('/PRIVMSG', chatmessage, 1, 1, takes_rest=True)
+register_command('/pong', pong, 0, 1)
+
+# to keep track of user information
+accounts = {}
+
+# username -> socket, the one place usernames are tracked
+# keys go through nick_key() so lookups honour CASEFOLD_NICKS
+USERS = {}
+
+# treat usernames that only differ in case as the same user
+CASEFOLD_NICKS = False
+
+# list to keep track of socket descriptors
+CONNECTION_LIST = []
+
+# channel name -> Channel object, oldest channel first
+CHANNELS = OrderedDict()
+
+# receiving buffer size
+# several lines can arrive in one read so this is bigger than a line
+RECV_BUFFER = 16384
+
+# longest line a client may send, CR-LF included (see the RFC)
+MAX_LINE = 512
+
+# longest username older clients send without CR-LF (the
+# client won't take more), longer data without one is a line
+# that hasn't completely arrived yet
+OLD_NICK_LENGTH = 9
+
+# a client with more than HIGH_WATERMARK bytes waiting to be sent is
+# a slow consumer until its buffer drains below LOW_WATERMARK
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+# what to do with slow consumers: 'drop', 'disconnect' or 'pause'
+SLOW_CONSUMER = 'disconnect'
+
+# most frames handed to sendmsg in one call
+IOV_MAX = 64
+
+# server port number
+PORT = 6667
+
+# connections the kernel queues for us before we accept them
+LISTEN_BACKLOG = 128
+
+# most connections accepted in one wakeup
+ACCEPT_BATCH = 128
+
+# seconds a new connection has to send its username
+REGISTRATION_TIMEOUT = 30
+
+# seconds a registered client may be quiet before it is sent a PING,
+# 0 to never ping, and seconds it then has to answer
+PING_INTERVAL = 120
+PING_TIMEOUT = 60
+
+# clients disconnected by each timeout
+TIMEOUTS = {'registration': 0, 'ping': 0}
+
+# number of processes sharing the port
+WORKERS = 1
+
+# bus to the hub when running as one of several workers, None otherwise
+BUS = None
+
+# token -> (socket, username, callback) for claims the hub hasn't answered
+CLAIMS = {}
+
+# numbers claims so answers can be matched up
+CLAIM_TOKENS = count()
+
+# local port to serve metrics on, None turns metrics off
+METRICS_PORT = None
+
+# ServerMetrics object while metrics are on, None otherwise
+METRICS = None
+
+# most messages each channel keeps for /history, 0 keeps none
+HISTORY_LINES = 50
+
+# most bytes each channel's history may use, counting
+# HISTORY_LINE_COST for every line besides its text
+HISTORY_BYTES = 8 * 1024
+HISTORY_LINE_COST = 48
+
+# messages sent to someone joining a channel, 0 sends none
+HISTORY_REPLAY = 0
+
+# lines and bytes per second each client may send, 0 for no limit
+FLOOD_LINES = 0
+FLOOD_BYTES = 0
+
+# lines and bytes per second sent to each channel, 0 for no limit
+CHANNEL_LINES = 0
+CHANNEL_BYTES = 0
+
+# seconds worth of lines and bytes that can be sent in one go
+FLOOD_BURST = 2
+
+# 'client'/'channel' -> times reads were deferred for that budget
+FLOOD_STATS = {'client': 0, 'channel': 0}
+
+# directory for the channel logs, None to keep no logs
+STORE_DIR = None
+
+# seconds channel logs are kept, 0 keeps them forever
+STORE_RETENTION = 0
+
+# MessageLog writing the channel logs, None when there are none
+STORE = None
+
+# file the channel histories are saved to, None to save none
+SNAPSHOT_PATH = None
+
+# seconds between snapshots
+SNAPSHOT_INTERVAL = 60
+
+# thread writing the last snapshot
+snapshot_writer = None
+
+# channel name -> history frames read from the snapshot,
+# for channels nobody has joined since the restart
+RESTORED_HISTORY = {}
+
+# Unix socket a new process can take this one over on, None for none
+HANDOFF_PATH = None
+
+# Unix socket of the server to take over on start, None to start fresh
+TAKEOVER_PATH = None
+
+# listening socket, created in main
+server_socket = None
+
+# event loop that dispatches ready sockets, created in main
+event_loop = None
+
+# TimerWheel on event_loop for the connection timeouts
+timer_wheel = None
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='IRC chat server')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--backend', choices=available_backends(),
+                        default=None,
+                        help='event loop backend (default: best available)')
+    parser.add_argument('--casefold-nicks', action='store_true',
+                        help='usernames differing only in case clash')
+    parser.add_argument('--registration-timeout', type=float,
+                        default=REGISTRATION_TIMEOUT,
+                        help='seconds a client has to send its username '
+                             '(default: %(default)s)')
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help='seconds a client may be quiet before it is '
+                             'pinged, 0 to never ping (default: %(default)s)')
+    parser.add_argument('--ping-timeout', type=float, default=PING_TIMEOUT,
+                        help='seconds a client has to answer a ping '
+                             '(default: %(default)s)')
+    parser.add_argument('--high-watermark', type=int, default=HIGH_WATERMARK,
+                        help='bytes queued before a client is a slow '
+                             'consumer (default: %(default)s)')
+    parser.add_argument('--low-watermark', type=int, default=LOW_WATERMARK,
+                        help='bytes queued before a slow consumer is back '
+                             'to normal (default: %(default)s)')
+    parser.add_argument('--slow-consumer', default=SLOW_CONSUMER,
+                        choices=['drop', 'disconnect', 'pause'],
+                        help='what to do with slow consumers '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes sharing the port with SO_REUSEPORT '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on this local port '
+                             '(workers use the ports after it)')
+    parser.add_argument('--log-format', choices=['text', 'json'],
+                        default='text',
+                        help='server log format (default: %(default)s)')
+    parser.add_argument('--log-rate', type=float, default=0,
+                        help='most times per second the same kind of '
+                             'message is logged, 0 for no limit')
+    parser.add_argument('--log-sync', action='store_true',
+                        help='write the log from the event loop instead '
+                             'of a background thread')
+    parser.add_argument('--history-lines', type=int, default=HISTORY_LINES,
+                        help='messages each channel keeps for /history '
+                             '(default: %(default)s)')
+    parser.add_argument('--history-bytes', type=int, default=HISTORY_BYTES,
+                        help='bytes each channel may use for them '
+                             '(default: %(default)s)')
+    parser.add_argument('--history-replay', type=int,
+                        default=HISTORY_REPLAY,
+                        help='messages replayed to someone joining a channel '
+                             '(default: %(default)s)')
+    parser.add_argument('--store-dir', default=STORE_DIR,
+                        help='write channel logs to this directory')
+    parser.add_argument('--store-retention', type=float,
+                        default=STORE_RETENTION,
+                        help='seconds channel logs are kept, 0 for ever '
+                             '(default: %(default)s)')
+    parser.add_argument('--flood-lines', type=float, default=FLOOD_LINES,
+                        help='lines per second each client may send, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--flood-bytes', type=float, default=FLOOD_BYTES,
+                        help='bytes per second each client may send, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--channel-lines', type=float, default=CHANNEL_LINES,
+                        help='lines per second sent to each channel, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--channel-bytes', type=float, default=CHANNEL_BYTES,
+                        help='bytes per second sent to each channel, '
+                             '0 for no limit (default: %(default)s)')
+    parser.add_argument('--flood-burst', type=float, default=FLOOD_BURST,
+                        help='seconds worth of those limits that may be '
+                             'used at once (default: %(default)s)')
+    parser.add_argument('--snapshot', default=SNAPSHOT_PATH,
+                        help='save channel histories to this file and '
+                             'load them on start')
+    parser.add_argument('--snapshot-interval', type=float,
+                        default=SNAPSHOT_INTERVAL,
+                        help='seconds between snapshots '
+                             '(default: %(default)s)')
+    parser.add_argument('--handoff', default=HANDOFF_PATH,
+                        help='let a new server take the port and clients '
+                             'over on this Unix socket')
+    parser.add_argument('--takeover', default=TAKEOVER_PATH,
+                        help='take the port and clients over from the '
+                             'server with this --handoff socket')
+    args = parser.parse_args()
+
+    if args.workers > 1 and (args.snapshot or args.handoff or
+                             args.takeover):
+        parser.error('snapshots and takeovers need a single process')
+    if (args.handoff or args.takeover) and not can_pass_sockets():
+        parser.error('takeovers need python 3.3 or newer')
+
+    PORT = args.port
+    CASEFOLD_NICKS = args.casefold_nicks
+    REGISTRATION_TIMEOUT = args.registration_timeout
+    PING_INTERVAL = args.ping_interval
+    PING_TIMEOUT = args.ping_timeout
+    HIGH_WATERMARK = args.high_watermark
+    LOW_WATERMARK = args.low_watermark
+    SLOW_CONSUMER = args.slow_consumer
+    WORKERS = args.workers
+    METRICS_PORT = args.metrics_port
+    HISTORY_LINES = args.history_lines
+    HISTORY_BYTES = args.history_bytes
+    HISTORY_REPLAY = args.history_replay
+    STORE_DIR = args.store_dir
+    STORE_RETENTION = args.store_retention
+    FLOOD_LINES = args.flood_lines
+    FLOOD_BYTES = args.flood_bytes
+    CHANNEL_LINES = args.channel_lines
+    CHANNEL_BYTES = args.channel_bytes
+    FLOOD_BURST = args.flood_burst
+    SNAPSHOT_PATH = args.snapshot
+    SNAPSHOT_INTERVAL = args.snapshot_interval
+    HANDOFF_PATH = args.handoff
+    TAKEOVER_PATH = args.takeover
+
+    # for logging information on the server
+    # (with several workers the process id tells them apart)
+    setup_logging(json_output=args.log_format == 'json',
+                  process=WORKERS > 1, rate=args.log_rate,
+                  threaded=not args.log_sync)
+
+    server_ip = socket.gethostbyname(socket.gethostname())
+    server_port = str(PORT)
+
+    # information that might be useful to clients
+    logging.info('Chat server started [%s:%s]', server_ip, server_port)
+
+    # each worker listens on the port and the hub routes between them
+    if WORKERS > 1:
+        run_workers(WORKERS, lambda number, bus_socket:
+                    run_worker(number, bus_socket, args.backend),
+                    args.backend)
+        sys.exit(0)
+
+    # initialize signal handler, SIGTERM too so the log is written out
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # take over from a running server, or start fresh
+    if TAKEOVER_PATH is not None:
+        take_over(args.backend)
+    else:
+        start_server(args.backend)
+
+        if SNAPSHOT_PATH is not None:
+            load_snapshot()
 
-                    # receive and strip data
-                    # stripping makes parsing easier (I guess)
-                    data = sock.recv(RECV_BUFFER).strip()
+    if SNAPSHOT_PATH is not None:
+        event_loop.call_later(SNAPSHOT_INTERVAL, save_snapshot)
 
-                    # we have data
-                    if data:
+    # wait for the next version of the server
+    if HANDOFF_PATH is not None:
+        event_loop.register(open_handoff(HANDOFF_PATH), READ, handoff_ready)
+        logging.info('Handoff on %s', HANDOFF_PATH)
 
-                        # look to see if its a command
-                        if data.find('/') == 0:
+    if METRICS_PORT is not None:
+        enable_metrics()
+        MetricsServer(event_loop, METRICS, METRICS_PORT)
+        logging.info('Metrics on http://127.0.0.1:%d/metrics', METRICS_PORT)
 
-                            # it is so lets parse the message as is
-                            parse_data(sock, data)
+    if STORE_DIR is not None:
+        enable_store()
 
-                        # no command probably intended to be
-                        # normal chat message
-                        else:
-                            parse_data(sock, '/PRIVMSG ' + data)
+    logging.info('Event backend: %s', event_loop.backend.name)
 
-                except:
-                    logoff(sock)
-                    continue
+    # dispatch ready sockets to their handlers forever
+    event_loop.run()
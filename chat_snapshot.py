@@ -0,0 +1,435 @@
+"""
+ State snapshots for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ A snapshot is MAGIC followed by the channels and then the clients:
+
+   count, then per channel:  name, count, frames of its history
+   count, then per client:   username, ip, state, current, inbuf,
+                             skipline ('1' or ''), count, channels,
+                             count, queued frames, count, held lines
+
+ where a count is a COUNT and a string (a name, a frame...) is a COUNT
+ length followed by its bytes. Clients are in the order their sockets
+ are handed over, which is what ties them to their socket on takeover.
+
+ For a takeover the new process connects to the old one's Unix socket
+ (--handoff) and sends TAKEOVER. The old one answers with the snapshot
+ and then the listening socket and every client socket, passed with
+ SCM_RIGHTS in batches of FD_BATCH, and exits once the new one says OK.
+ The new one starts serving once the old one is gone, so the two never
+ write to the same client or channel log. Connections never notice,
+ the kernel keeps them open in between.
+ Passing sockets needs sendmsg/recvmsg, which means python 3.3+
+"""
+import os      # for files
+import array   # for file descriptor lists
+import socket  # for socket objects
+import struct  # for counts
+import tempfile  # for snapshots being written
+
+# first bytes of every snapshot, the last one is the format version
+MAGIC = b'CHATSNP2'
+
+# version 1 is read too, it had no held lines
+OLD_MAGIC = b'CHATSNP1'
+
+# counts and string lengths
+COUNT = struct.Struct('!I')
+
+# a client's fields before its channels and queued frames
+CLIENT_FIELDS = ('username', 'ip', 'state', 'current', 'inbuf', 'skipline')
+
+# file descriptors per SCM_RIGHTS message (the kernel allows 253)
+FD_BATCH = 200
+
+
+class SnapshotError(Exception):
+    """Snapshot is damaged, of another version, or the takeover failed"""
+
+
+def can_pass_sockets():
+    """Function checks if sockets can be handed to another process here
+
+    :return: True or False
+    """
+
+    return hasattr(socket.socket, 'sendmsg') and hasattr(socket, 'AF_UNIX')
+
+
+class Encoder(object):
+    """Builds a snapshot from counts and strings"""
+
+    def __init__(self):
+        self.parts = [MAGIC]
+
+    def count(self, value):
+        self.parts.append(COUNT.pack(value))
+
+    def string(self, value):
+        """Add a string
+
+        :param value: bytes, or text which is stored as UTF-8
+        """
+
+        self.strings((value,), False)
+
+    def strings(self, values, counted=True):
+        """Add a list of strings
+
+        :param values: list of strings, see string()
+        :param counted: add how many there are first
+        """
+
+        # this is most of the work so it is kept tight
+        append = self.parts.append
+        pack = COUNT.pack
+
+        if counted:
+            append(pack(len(values)))
+
+        for value in values:
+            if not isinstance(value, bytes):
+                if isinstance(value, memoryview):
+                    value = value.tobytes()
+                else:
+                    value = value.encode('utf-8')
+            append(pack(len(value)))
+            append(value)
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class Decoder(object):
+    """Reads counts and strings back out of a snapshot"""
+
+    def __init__(self, data):
+        """
+        :param data: snapshot bytes
+        """
+
+        if data[:len(MAGIC)] not in (MAGIC, OLD_MAGIC):
+            raise SnapshotError('not a snapshot or another version')
+
+        self.data = data
+        self.version = int(data[len(MAGIC) - 1:len(MAGIC)])
+        self.offset = len(MAGIC)
+
+    def count(self):
+        try:
+            value, = COUNT.unpack_from(self.data, self.offset)
+        except struct.error:
+            raise SnapshotError('snapshot is cut short')
+        self.offset += COUNT.size
+        return value
+
+    def string(self):
+        """Function reads a string
+
+        :return: bytes
+        """
+
+        return self.strings(1)[0]
+
+    def strings(self, count=None):
+        """Function reads a list of strings
+
+        :param count: how many, None if the count comes first
+        :return: list of bytes
+        """
+
+        data = self.data
+        unpack = COUNT.unpack_from
+        size = COUNT.size
+        values = []
+
+        offset = self.offset
+        try:
+            if count is None:
+                count, = unpack(data, offset)
+                offset += size
+            for i in range(count):
+                length, = unpack(data, offset)
+                offset += size
+                values.append(data[offset:offset + length])
+                offset += length
+        except struct.error:
+            raise SnapshotError('snapshot is cut short')
+
+        if offset > len(data):
+            raise SnapshotError('snapshot is cut short')
+
+        self.offset = offset
+        return values
+
+
+def encode_state(channels, clients):
+    """Function builds a snapshot
+
+    :param channels: list of (name, list of history frames)
+    :param clients: list of server Sessions (username, ip, state,
+                    current, inbuf, skipline, channels, outbuf and
+                    held)
+    :return: snapshot bytes
+    """
+
+    out = Encoder()
+
+    out.count(len(channels))
+    for name, frames in channels:
+        out.string(name)
+        out.strings(frames)
+
+    out.count(len(clients))
+    for client in clients:
+        out.strings([client.username, client.ip, client.state,
+                     client.current, client.inbuf,
+                     '1' if client.skipline else ''], False)
+        out.strings(client.channels)
+        out.strings(client.outbuf or ())
+        out.strings(client.held or ())
+
+    return out.getvalue()
+
+
+def decode_state(data):
+    """Function reads a snapshot
+
+    :param data: snapshot bytes
+    :return: (channels, clients) as given to encode_state but with
+             the clients as dictionaries and every string as bytes
+    """
+
+    snap = Decoder(data)
+
+    channels = []
+    for i in range(snap.count()):
+        name = snap.string()
+        channels.append((name, snap.strings()))
+
+    clients = []
+    for i in range(snap.count()):
+        client = dict(zip(CLIENT_FIELDS, snap.strings(len(CLIENT_FIELDS))))
+        client['skipline'] = client['skipline'] == b'1'
+        client['channels'] = snap.strings()
+        client['outbuf'] = snap.strings()
+        client['held'] = snap.strings() if snap.version > 1 else []
+        clients.append(client)
+
+    return channels, clients
+
+
+def write_snapshot(path, data):
+    """Function writes a snapshot file, replacing the old one in one go
+
+    Every write gets a temporary file of its own next to the snapshot,
+    so two writers never mix their bytes, the last rename wins
+
+    :param path: snapshot file
+    :param data: snapshot bytes
+    :raises OSError: the snapshot couldn't be written, the old one is kept
+    """
+
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                               suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(path):
+    """Function reads a snapshot file
+
+    :param path: snapshot file
+    :return: snapshot bytes, None if there is no snapshot
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def send_all(sock, data):
+    """Function sends a length-prefixed message on a blocking socket
+
+    :param sock: Unix socket
+    :param data: bytes
+    """
+
+    sock.sendall(COUNT.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    """Function receives exactly size bytes from a blocking socket
+
+    :param sock: Unix socket
+    :param size: number of bytes
+    :return: bytes
+    """
+
+    parts = []
+    while size:
+        data = sock.recv(min(size, 1 << 20))
+        if not data:
+            raise SnapshotError('takeover connection closed')
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def recv_message(sock):
+    """Function receives a message sent with send_all
+
+    :param sock: Unix socket
+    :return: bytes
+    """
+
+    size, = COUNT.unpack(recv_exactly(sock, COUNT.size))
+    return recv_exactly(sock, size)
+
+
+def send_fds(sock, fds):
+    """Function passes file descriptors to the other end of a Unix socket
+
+    :param sock: Unix socket
+    :param fds: list of file descriptors
+    """
+
+    for start in range(0, len(fds), FD_BATCH):
+        batch = array.array('i', fds[start:start + FD_BATCH])
+        sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               batch.tobytes())])
+
+
+def recv_fds(sock, count):
+    """Function receives file descriptors passed with send_fds
+
+    :param sock: Unix socket
+    :param count: number of file descriptors
+    :return: list of file descriptors
+    """
+
+    fds = array.array('i')
+    space = socket.CMSG_LEN(FD_BATCH * fds.itemsize)
+
+    while len(fds) < count:
+        data, ancillary, flags, addr = sock.recvmsg(1, space)
+        if not data:
+            raise SnapshotError('takeover connection closed')
+
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                whole = len(payload) - len(payload) % fds.itemsize
+                fds.frombytes(payload[:whole])
+
+    return list(fds)
+
+
+def request_takeover(path):
+    """Function takes the listening socket and clients over from a
+    running server
+
+    :param path: the running server's --handoff socket
+    :return: (snapshot bytes, listening socket, list of client sockets)
+    """
+
+    if not can_pass_sockets():
+        raise SnapshotError('passing sockets needs python 3.3 or newer')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        send_all(sock, b'TAKEOVER')
+
+        data = recv_message(sock)
+        count, = COUNT.unpack(recv_message(sock))
+        fds = recv_fds(sock, count)
+
+        socks = [socket.socket(fileno=fd) for fd in fds]
+        send_all(sock, b'OK')
+
+        # the old process is gone once the connection closes
+        sock.recv(1)
+    except (socket.error, struct.error) as e:
+        raise SnapshotError('takeover failed: %s' % e)
+    finally:
+        sock.close()
+
+    return data, socks[0], socks[1:]
+
+
+def open_handoff(path):
+    """Function opens the Unix socket a new process asks for a takeover on
+
+    :param path: socket path
+    :return: listening Unix socket
+    """
+
+    if not can_pass_sockets():
+        raise SnapshotError('passing sockets needs python 3.3 or newer')
+
+    # the old process' socket is left behind after a takeover
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(0)
+    return sock
+
+
+def hand_over(conn, data, socks):
+    """Function gives the listening socket and clients to a new process
+
+    :param conn: accepted connection on the handoff socket
+    :param data: snapshot bytes
+    :param socks: listening socket followed by the client sockets
+
+    Once this returns the sockets belong to the new process, which
+    waits for this one to exit before it touches them
+    """
+
+    conn.setblocking(1)
+    conn.settimeout(30)
+
+    try:
+        if recv_message(conn) != b'TAKEOVER':
+            raise SnapshotError('unknown handoff request')
+
+        send_all(conn, data)
+        send_all(conn, COUNT.pack(len(socks)))
+        send_fds(conn, [s.fileno() for s in socks])
+
+        if recv_message(conn) != b'OK':
+            raise SnapshotError('new process did not take over')
+    except (socket.error, struct.error) as e:
+        raise SnapshotError('handoff failed: %s' % e)
@@ -0,0 +1,662 @@
+"""
+ Channel logs for the IRC server programmed in python for a CS494 project
+ Note: code has been tested with python version 2.7.9
+
+ Copyright (C) 2015  William Harringt, Portland State University
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation; either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along
+    with this program; if not, write to the Free Software Foundation, Inc.,
+    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+ Every channel gets a directory of append-only segment files:
+
+   <dir>/<channel, %-escaped>/<first timestamp in usec>-<writer>.log
+   <dir>/<channel, %-escaped>/<first timestamp in usec>-<writer>.idx
+
+ Segments merged by compaction are named <first>-<writer>-<last>, last
+ being the first timestamp of the newest segment merged into it. The
+ ones it covers are left out of listings from the moment its .log is
+ renamed into place, so readers never see a record twice or miss one.
+
+ A .log file is a run of records, a RECORD header (timestamp, length)
+ followed by the frame that was sent. The .idx file next to it has an
+ INDEX entry (timestamp, offset) for the first record written after the
+ segment was opened and for every INDEX_EVERY-th record after that, so
+ a query finds its first record with a binary search over the index and
+ a short scan. Both files are read through mmap so a query only touches
+ the pages it needs.
+
+ Timestamps only go up within one writer's segments of a channel. Each
+ worker process is a writer of its own (the number in the file name) so
+ workers never write to the same file, queries merge their segments.
+
+ The event loop only appends to a queue, a background thread does the
+ writing, rotating (segments over SEGMENT_BYTES or older than
+ SEGMENT_SECONDS are closed and a new one started) and compacting
+ (dropping segments past the retention time and merging small ones).
+
+ Usage: python chat_store.py <dir> <channel> [--since T] [--until T]
+"""
+from __future__ import print_function
+
+import os         # for files and directories
+import mmap       # for reading segments
+import time       # for timestamps
+import heapq      # for merging writers
+import struct     # for records and index entries
+import logging    # for logging
+import argparse   # for command line options
+import threading  # for the writer thread
+
+from collections import deque, OrderedDict
+
+try:
+    from urllib import quote        # python 2
+except ImportError:
+    from urllib.parse import quote  # python 3
+
+# timestamp, length of the frame that follows
+RECORD = struct.Struct('!dI')
+
+# timestamp, offset of the record in the .log file
+INDEX = struct.Struct('!dQ')
+
+# records between index entries
+INDEX_EVERY = 32
+
+# a segment is closed and a new one started after this many bytes...
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+# ...or once its first record is this old
+SEGMENT_SECONDS = 24 * 60 * 60
+
+# segments kept open for writing, least recently used are closed first
+OPEN_SEGMENTS = 256
+
+# seconds between the writer's batches and between compactions
+WRITE_INTERVAL = 0.1
+COMPACT_INTERVAL = 60
+
+
+def channel_path(directory, channel):
+    """Function finds the directory of a channel's segments
+
+    :param directory: log directory
+    :param channel: channel name
+    :return: path
+    """
+
+    if not isinstance(channel, bytes):
+        channel = channel.encode('utf-8')
+    return os.path.join(directory, quote(channel, safe=''))
+
+
+def segment_name(first, writer, last=None):
+    """Function names a segment
+
+    :param first: timestamp of its first record in usec
+    :param writer: writer number
+    :param last: for a merged segment, the first timestamp in usec of
+                 the newest segment merged into it
+    :return: file name without .log/.idx
+    """
+
+    if last is None:
+        return '%020d-%d' % (first, writer)
+    return '%020d-%d-%020d' % (first, writer, last)
+
+
+def parse_name(name):
+    """Function reads a segment's file name
+
+    :param name: file name without .log/.idx
+    :return: (first, writer, last) as given to segment_name, last is
+             first for a segment that wasn't merged
+    :raises ValueError: not a segment
+    """
+
+    parts = [int(part) for part in name.split('-')]
+    if len(parts) == 2:
+        return parts[0], parts[1], parts[0]
+    first, writer, last = parts
+    return first, writer, last
+
+
+def list_segments(path, covered=None):
+    """Function lists a channel's segments
+
+    Segments a merged one covers are left out, their files are
+    only there until the merge has removed them
+
+    :param path: channel directory
+    :param covered: list to add the paths of those left out to
+    :return: {writer: [(first timestamp, base path), ...] oldest first}
+    """
+
+    found = {}
+
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return found
+
+    for name in names:
+        if not name.endswith('.log'):
+            continue
+
+        try:
+            first, writer, last = parse_name(name[:-4])
+        except ValueError:
+            continue
+
+        # the segment covering the most goes first
+        found.setdefault(writer, []).append(
+            (first, -last, os.path.join(path, name[:-4])))
+
+    writers = {}
+    for writer, segments in found.items():
+        segments.sort()
+        kept = writers[writer] = []
+        until = -1
+        for first, last, base in segments:
+            if first <= until:
+                if covered is not None:
+                    covered.append(base)
+                continue
+            kept.append((first / 1e6, base))
+            until = -last
+
+    return writers
+
+
+class Segment(object):
+    """A segment open for appending"""
+
+    def __init__(self, base, first):
+        """
+        :param base: path without .log/.idx
+        :param first: timestamp of the segment's first record
+        """
+
+        self.base = base
+        self.first = first
+        self.log = open(base + '.log', 'ab')
+        self.idx = open(base + '.idx', 'ab')
+
+        # appending, so tell() is the end of the file
+        self.log.seek(0, 2)
+        self.size = self.log.tell()
+
+        # the first record we write gets an index entry
+        self.unindexed = INDEX_EVERY
+        self.closed = False
+
+    def append(self, timestamp, frame):
+        """Add a record
+
+        :param timestamp: when the message was sent
+        :param frame: message as sent
+        """
+
+        if self.unindexed >= INDEX_EVERY:
+            self.idx.write(INDEX.pack(timestamp, self.size))
+            self.unindexed = 0
+        self.unindexed += 1
+
+        self.log.write(RECORD.pack(timestamp, len(frame)))
+        self.log.write(frame)
+        self.size += RECORD.size + len(frame)
+
+    def flush(self):
+        # records first so the index never points past them
+        if not self.closed:
+            self.log.flush()
+            self.idx.flush()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.idx.close()
+        self.closed = True
+
+
+class MessageLog(object):
+    """Writes channel messages to disk from a background thread
+
+    append() only adds to a queue so it is cheap enough for
+    broadcast_data, the writer thread takes everything appended
+    every WRITE_INTERVAL seconds and writes it out
+    """
+
+    def __init__(self, directory, writer=0, retention=0,
+                 segment_bytes=SEGMENT_BYTES, segment_seconds=SEGMENT_SECONDS):
+        """
+        :param directory: log directory, created if needed
+        :param writer: number that tells this process' segments apart
+        :param retention: seconds messages are kept, 0 keeps them forever
+        :param segment_bytes: size a segment is closed at
+        :param segment_seconds: age a segment is closed at
+        """
+
+        self.directory = directory
+        self.writer = writer
+        self.retention = retention
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+
+        # (channel, timestamp, frame) waiting for the writer,
+        # deque appends and pops need no lock
+        self.pending = deque()
+
+        # channel -> open Segment, least recently used first
+        self.segments = OrderedDict()
+
+        # channel -> timestamp of its last record
+        self.last = {}
+
+        # totals, for the benchmark
+        self.records = 0
+        self.bytes = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='log store')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, channel, frame):
+        """Queue a message for the channel's log
+
+        :param channel: channel name
+        :param frame: message as sent
+        """
+
+        self.pending.append((channel, time.time(), frame))
+
+    def run(self):
+        """Writer thread, writes a batch every WRITE_INTERVAL seconds"""
+
+        compacted = time.time()
+
+        while not self.stopping.is_set():
+            self.stopping.wait(WRITE_INTERVAL)
+
+            try:
+                self.write()
+
+                if time.time() - compacted >= COMPACT_INTERVAL:
+                    compacted = time.time()
+                    self.compact()
+            except (IOError, OSError) as e:
+                logging.error('Channel log: %s', str(e))
+
+        self.write()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+    def write(self):
+        """Write everything appended so far"""
+
+        pending = self.pending
+
+        # group by channel so each segment is looked up once
+        batch = OrderedDict()
+        while pending:
+            channel, timestamp, frame = pending.popleft()
+            batch.setdefault(channel, []).append((timestamp, frame))
+
+        for channel, records in batch.items():
+            segment = self.segment(channel, records[0][0])
+            last = self.last.get(channel, 0)
+
+            for timestamp, frame in records:
+
+                # the clock may go backwards, our timestamps may not
+                if timestamp < last:
+                    timestamp = last
+                last = timestamp
+
+                if (segment.size >= self.segment_bytes or
+                        timestamp - segment.first >= self.segment_seconds):
+                    segment = self.segment(channel, timestamp)
+
+                segment.append(timestamp, frame)
+                self.records += 1
+                self.bytes += RECORD.size + len(frame)
+
+            self.last[channel] = last
+            segment.flush()
+
+    def segment(self, channel, timestamp):
+        """Function finds the segment a channel's next record goes in
+
+        Opens the channel's newest segment of ours or starts a new one
+        when there is none or it's full or too old
+
+        :param channel: channel name
+        :param timestamp: timestamp of the record
+        :return: Segment
+        """
+
+        segment = self.segments.pop(channel, None)
+
+        if segment is None:
+            path = channel_path(self.directory, channel)
+            ours = list_segments(path).get(self.writer)
+            if ours:
+                first, base = ours[-1]
+                segment = Segment(base, first)
+
+                # carry on after the records already there
+                if channel not in self.last:
+                    self.last[channel] = last_timestamp(base)
+            elif not os.path.isdir(path):
+                os.makedirs(path)
+
+        if segment is not None and (
+                segment.size >= self.segment_bytes or
+                timestamp - segment.first >= self.segment_seconds):
+            segment.close()
+            segment = None
+
+        # names must sort in the order the records were written
+        if segment is None:
+            timestamp = max(timestamp, self.last.get(channel, 0))
+            path = channel_path(self.directory, channel)
+            segment = Segment(os.path.join(path, segment_name(
+                int(timestamp * 1e6), self.writer)), timestamp)
+
+        # most recently used goes last
+        self.segments[channel] = segment
+        while len(self.segments) > OPEN_SEGMENTS:
+            self.segments.popitem(last=False)[1].close()
+
+        return segment
+
+    def compact(self, now=None):
+        """Drop segments past the retention time and merge small ones
+
+        Only our own segments are touched and never the ones open for
+        writing, though segments of channels quiet for longer than the
+        retention time are closed first. Neighbouring segments that
+        together are under half of segment_bytes are merged into one
+
+        :param now: current time
+        """
+
+        now = now or time.time()
+
+        if self.retention:
+            for channel in [channel for channel in self.segments
+                            if self.last.get(channel, 0) <
+                            now - self.retention]:
+                self.segments.pop(channel).close()
+
+        active = set(segment.base for segment in self.segments.values())
+
+        try:
+            channels = os.listdir(self.directory)
+        except OSError:
+            return
+
+        for name in channels:
+            path = os.path.join(self.directory, name)
+
+            # left behind by a merge that didn't finish
+            covered = []
+            segments = list_segments(path, covered).get(self.writer, [])
+            for base in covered:
+                if parse_name(os.path.basename(base))[1] == self.writer:
+                    remove_segment(base)
+
+            # a segment only has records older than the next one's
+            # first, the last one is as old as its last record
+            if self.retention:
+                while segments and segments[0][1] not in active:
+                    if len(segments) > 1:
+                        newest = segments[1][0]
+                    else:
+                        newest = last_timestamp(segments[0][1])
+                    if newest >= now - self.retention:
+                        break
+                    remove_segment(segments.pop(0)[1])
+
+            # runs of neighbours that fit in half a segment
+            runs = [[]]
+            total = 0
+            for first, base in segments:
+                if base in active:
+                    runs.append([])
+                    continue
+
+                size = os.path.getsize(base + '.log')
+                if runs[-1] and total + size > self.segment_bytes // 2:
+                    runs.append([])
+                    total = 0
+                runs[-1].append(base)
+                total += size
+
+            for run in runs:
+                if len(run) > 1:
+                    merge_segments(run)
+
+    def close(self):
+        """Write everything appended and stop the writer"""
+
+        if self.thread.is_alive():
+            self.stopping.set()
+            self.thread.join()
+
+
+def remove_segment(base):
+    """Function deletes a segment
+
+    :param base: path without .log/.idx
+    """
+
+    for suffix in ('.log', '.idx'):
+        try:
+            os.remove(base + suffix)
+        except OSError:
+            pass
+
+
+def merge_segments(bases):
+    """Function merges neighbouring segments into a new one
+
+    The merged segment is named after the first and last of them (see
+    list_segments) and its .log renamed into place after its .idx,
+    which is when readers switch over to it from the old segments, all
+    at once. Those are removed afterwards
+
+    :param bases: segments oldest first, paths without .log/.idx
+    :return: path of the merged segment without .log/.idx
+    """
+
+    first, writer, last = parse_name(os.path.basename(bases[0]))
+    last = parse_name(os.path.basename(bases[-1]))[2]
+    merged = os.path.join(os.path.dirname(bases[0]),
+                          segment_name(first, writer, last))
+
+    tmp = merged + '.tmp'
+    remove_segment(tmp)
+    segment = Segment(tmp, 0)
+    try:
+        for base in bases:
+            for timestamp, frame in read_segment(base):
+                segment.append(timestamp, frame)
+    finally:
+        segment.close()
+
+    os.rename(tmp + '.idx', merged + '.idx')
+    os.rename(tmp + '.log', merged + '.log')
+    for base in bases:
+        if base != merged:
+            remove_segment(base)
+
+    return merged
+
+
+def map_file(path):
+    """Function memory maps a file for reading
+
+    :param path: file path
+    :return: mmap, or b'' for an empty or missing file
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError):
+        return b''
+
+
+def last_timestamp(base):
+    """Function finds the timestamp of a segment's last record
+
+    :param base: path without .log/.idx
+    :return: timestamp, 0 for an empty segment
+    """
+
+    # scan from the last index entry
+    idx = map_file(base + '.idx')
+    start = None
+    if len(idx) >= INDEX.size:
+        start = INDEX.unpack_from(idx, len(idx) - INDEX.size)[0]
+
+    last = 0
+    for timestamp, frame in read_segment(base, start):
+        last = timestamp
+    return last
+
+
+def read_segment(base, start=None, end=None):
+    """Generator yields a segment's records between two times
+
+    :param base: path without .log/.idx
+    :param start: earliest timestamp (None from the first record)
+    :param end: latest timestamp (None up to the last record)
+    :return: iterator of (timestamp, frame)
+    """
+
+    log = map_file(base + '.log')
+    offset = 0
+
+    if start is not None:
+        idx = map_file(base + '.idx')
+
+        # last index entry before start, the records
+        # between it and the next entry are scanned
+        lo, hi = 0, len(idx) // INDEX.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INDEX.unpack_from(idx, mid * INDEX.size)[0] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            offset = INDEX.unpack_from(idx, (lo - 1) * INDEX.size)[1]
+
+    # the writer may be half way through a record at the end
+    while offset + RECORD.size <= len(log):
+        timestamp, length = RECORD.unpack_from(log, offset)
+        offset += RECORD.size
+        if offset + length > len(log):
+            break
+
+        if end is not None and timestamp > end:
+            break
+        if start is None or timestamp >= start:
+            yield timestamp, log[offset:offset + length]
+
+        offset += length
+
+
+def query(directory, channel, start=None, end=None, limit=None):
+    """Function finds a channel's messages between two times
+
+    :param directory: log directory
+    :param channel: channel name
+    :param start: earliest timestamp (None for the first message)
+    :param end: latest timestamp (None for the last message)
+    :param limit: most messages to return, the earliest ones
+    :return: list of (timestamp, frame), oldest first
+    """
+
+    streams = []
+
+    for segments in list_segments(channel_path(directory, channel)).values():
+        wanted = []
+        for i, (first, base) in enumerate(segments):
+
+            # segments only have records up to the next one's first
+            if (start is not None and i + 1 < len(segments) and
+                    segments[i + 1][0] < start):
+                continue
+            if end is not None and first > end:
+                break
+            wanted.append(base)
+
+        streams.append(record for base in wanted
+                       for record in read_segment(base, start, end))
+
+    messages = []
+    for record in heapq.merge(*streams):
+        messages.append(record)
+        if limit is not None and len(messages) >= limit:
+            break
+
+    return messages
+
+
+def parse_time(value):
+    """Function turns a command line time into a timestamp
+
+    :param value: seconds since the epoch, or negative for seconds ago
+    :return: timestamp
+    """
+
+    value = float(value)
+    if value < 0:
+        return time.time() + value
+    return value
+
+
+if __name__ == "__main__":
+    """Main function
+
+    """
+
+    parser = argparse.ArgumentParser(description='read channel logs')
+    parser.add_argument('directory', help='log directory (--store-dir)')
+    parser.add_argument('channel', help='channel name, like #general')
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help='seconds since the epoch, negative for '
+                             'that many seconds ago')
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help='seconds since the epoch, negative for '
+                             'that many seconds ago')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='most messages to show')
+    args = parser.parse_args()
+
+    for timestamp, frame in query(args.directory, args.channel,
+                                  args.since, args.until, args.limit):
+        print('[%s] %s' % (time.strftime('%d/%m/%Y %I:%M:%S %p',
+                                         time.localtime(timestamp)),
+                           frame.decode('utf-8').strip()))